@@ -1,20 +1,33 @@
 """
 A script to quickly list all instruments connected to the computer that can communicate via the VISA library.
-Can be used to find instrument addresses for the probestation_MAIN application.
+Can be used to find instrument addresses (or model and serial number) for the probestation_MAIN application.
+All resources are queried concurrently, each with a timeout.
+
+python list_instruments.py [--timeout SECONDS]
 """
 
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'probestation'))
+from instruments import InstrumentRegistry, DISCOVERY_TIMEOUT
+
+
+parser = argparse.ArgumentParser(description="List the VISA instruments connected to this computer.")
+parser.add_argument('--timeout', type=float, default=DISCOVERY_TIMEOUT, help="seconds per instrument to answer *IDN?")
+args = parser.parse_args()
 
-from pyvisa import ResourceManager
-rm = ResourceManager()
-instrument_list = rm.list_resources()
+registry = InstrumentRegistry(timeout=args.timeout)
+instruments = registry.discover(refresh=True)
 
-if len(instrument_list)==0:
+if len(instruments)==0:
     print("no instruments found")
 else:
-    for entry in instrument_list:
-        print(entry)
-        try:
-            inst = rm.open_resource(entry)
-            print(inst.query("*IDN?"), "\n")
-        except:
+    for resource, identity in sorted(instruments.items()):
+        print(resource)
+        if identity is None:
             print("not identified\n")
+        else:
+            print(identity.manufacturer, identity.model, "serial", identity.serial, "firmware", identity.firmware, "\n")
+print("discovery took %.2f s" % registry.discovery_time)
@@ -0,0 +1,280 @@
+# streaming extraction of device figures of merit
+# a DeviceAnalysis is attached to the Worker of a measurement (Worker.results_listeners) and feeds
+# the emitted data points in chunks to a set of metrics, each of which keeps O(1) state per device
+
+import os
+import csv
+import threading
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+CURRENT_FLOOR = 1e-13       # currents below this are treated as noise (A)
+
+
+class Metric(object):
+    '''
+    Base class of streaming metrics. update() is called with NumPy arrays of consecutive data
+    points (x: voltage, y: current), result() returns a dictionary {column name: value}.
+    Subclasses must keep bounded state; they never see all points of a measurement at once.
+    '''
+    def update(self, x, y):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+
+class MaxCurrent(Metric):
+    def __init__(self):
+        self.max_current = np.nan
+
+    def update(self, x, y):
+        self.max_current = np.nanmax(np.append(np.abs(y), self.max_current))
+
+    def result(self):
+        return {'Max current (A)': self.max_current}
+
+
+
+class MinCurrent(Metric):
+    '''
+    Smallest current above the noise floor, e.g. at the first bias step of the pretest.
+    '''
+    def __init__(self):
+        self.min_current = np.inf
+
+    def update(self, x, y):
+        y = np.abs(y[~np.isnan(y)])
+        y = y[y > CURRENT_FLOOR]
+        if len(y):
+            self.min_current = min(self.min_current, y.min())
+
+    def result(self):
+        return {'Min current (A)': self.min_current if np.isfinite(self.min_current) else np.nan}
+
+
+
+class OnOffRatio(Metric):
+    def __init__(self):
+        self.i_max = 0.
+        self.i_min = np.inf
+
+    def update(self, x, y):
+        y = np.abs(y[~np.isnan(y)])
+        y = y[y > CURRENT_FLOOR]
+        if len(y):
+            self.i_max = max(self.i_max, y.max())
+            self.i_min = min(self.i_min, y.min())
+
+    def result(self):
+        if self.i_max > 0 and np.isfinite(self.i_min):
+            return {'On/off ratio': self.i_max/self.i_min}
+        return {'On/off ratio': np.nan}
+
+
+
+class _DifferenceMetric(Metric):
+    '''
+    Helper base for metrics on derivatives. Keeps the last point of the previous chunk so
+    differences across chunk boundaries are not lost.
+    '''
+    def __init__(self):
+        self._last = None
+
+    def _with_last(self, x, y):
+        if self._last is not None:
+            x = np.concatenate(([self._last[0]], x))
+            y = np.concatenate(([self._last[1]], y))
+        if len(x):
+            self._last = (x[-1], y[-1])
+        return x, y
+
+
+
+class SubthresholdSwing(_DifferenceMetric):
+    '''
+    Steepest slope of the transfer curve on log scale, in mV per decade of current.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.swing = np.inf
+
+    def update(self, x, y):
+        x, y = self._with_last(x, y)
+        if len(x) < 2:
+            return
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_i = np.log10(np.clip(np.abs(y), CURRENT_FLOOR, None))
+            swing = np.abs(np.diff(x)/np.diff(log_i))*1e3
+        valid = (np.isfinite(swing) & (np.diff(x) != 0)
+                 & (np.abs(y[1:]) > CURRENT_FLOOR) & (np.abs(y[:-1]) > CURRENT_FLOOR))
+        if np.any(valid):
+            self.swing = min(self.swing, swing[valid].min())
+
+    def result(self):
+        return {'Subthreshold swing (mV/dec)': self.swing if np.isfinite(self.swing) else np.nan}
+
+
+
+class ThresholdVoltage(_DifferenceMetric):
+    '''
+    Threshold voltage from linear extrapolation at the point of maximum transconductance
+    (V_th = V - I/g_m), separately for the rising and falling gate sweep directions. The
+    hysteresis is the threshold voltage shift between the two directions, so it compares the
+    legs of the down/up/return gate sweep without storing the curves.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.gm_max = {1: 0., -1: 0.}
+        self.vth = {1: np.nan, -1: np.nan}
+
+    def update(self, x, y):
+        x, y = self._with_last(x, y)
+        if len(x) < 2:
+            return
+        dx = np.diff(x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gm = np.diff(y)/dx
+        x_mid = 0.5*(x[1:]+x[:-1])
+        y_mid = 0.5*(y[1:]+y[:-1])
+        for direction in (1, -1):
+            valid = (np.sign(dx) == direction) & np.isfinite(gm)
+            if not np.any(valid):
+                continue
+            i = np.argmax(np.where(valid, np.abs(gm), -1.))
+            if abs(gm[i]) > self.gm_max[direction]:
+                self.gm_max[direction] = abs(gm[i])
+                self.vth[direction] = x_mid[i] - y_mid[i]/gm[i]
+
+    def result(self):
+        vth = self.vth[1] if not np.isnan(self.vth[1]) else self.vth[-1]
+        return {
+            'Threshold voltage (V)': vth,
+            'Hysteresis (V)': self.vth[-1] - self.vth[1],
+        }
+
+
+
+class ContactResistance(Metric):
+    '''
+    Resistance of the pretest IV curve from a streaming least squares fit of I(V).
+    '''
+    def __init__(self):
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.sxy = 0.
+
+    def update(self, x, y):
+        valid = ~(np.isnan(x) | np.isnan(y))
+        x, y = x[valid], y[valid]
+        self.n += len(x)
+        self.sx += x.sum()
+        self.sy += y.sum()
+        self.sxx += (x*x).sum()
+        self.sxy += (x*y).sum()
+
+    def result(self):
+        denominator = self.n*self.sxx - self.sx**2
+        if self.n < 2 or denominator == 0:
+            return {'Contact resistance (Ohm)': np.nan}
+        slope = (self.n*self.sxy - self.sx*self.sy)/denominator
+        return {'Contact resistance (Ohm)': 1./slope if slope != 0 else np.inf}
+
+
+
+PRETEST_METRICS = (MaxCurrent, MinCurrent, ContactResistance)
+GATESWEEP_METRICS = (OnOffRatio, ThresholdVoltage, SubthresholdSwing)
+
+
+
+class DeviceAnalysis(object):
+    '''
+    Listener for Worker.results_listeners. Collects emitted points in a fixed size chunk and
+    passes full chunks to the metrics as arrays, so memory per device is bounded by the chunk
+    size plus the state of the metrics.
+
+    :param metric_classes: Metric subclasses to compute (instantiated per device)
+    :param x_column: data column used as voltage
+    :param y_column: data column used as current
+    :param chunk_size: number of points processed at once
+    '''
+
+    def __init__(self, metric_classes, x_column, y_column='Current (A)', chunk_size=64):
+        self.metrics = [metric_class() for metric_class in metric_classes]
+        self.x_column, self.y_column = x_column, y_column
+        self._chunk = np.empty((2, chunk_size))
+        self._n = 0
+        self._lock = threading.Lock()
+
+
+    def __call__(self, record):
+        try:
+            x, y = float(record[self.x_column]), float(record[self.y_column])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self._lock:
+            self._chunk[0, self._n] = x
+            self._chunk[1, self._n] = y
+            self._n += 1
+            if self._n == self._chunk.shape[1]:
+                self._flush()
+
+
+    def _flush(self):
+        if self._n:
+            x, y = self._chunk[0, :self._n].copy(), self._chunk[1, :self._n].copy()
+            for metric in self.metrics:
+                metric.update(x, y)
+            self._n = 0
+
+
+    def results(self):
+        with self._lock:
+            self._flush()
+            results = {}
+            for metric in self.metrics:
+                results.update(metric.result())
+            return results
+
+
+
+class WaferSummary(object):
+    '''
+    Per-wafer summary table (CSV) with one row per device and one column per extracted metric.
+    Rows are appended as devices finish, so a resumed scan continues the same table.
+
+    :param folder: scan folder
+    :param metric_columns: names of the metric columns
+    '''
+    FILENAME = 'summary.csv'
+    DEVICE_COLUMNS = ['device', 'chipcol', 'chiprow', 'devcol', 'devrow']
+
+    def __init__(self, folder, metric_columns):
+        self.filename = os.path.join(folder, self.FILENAME)
+        self.columns = self.DEVICE_COLUMNS + list(metric_columns)
+        self._lock = threading.Lock()
+        if not os.path.isfile(self.filename):
+            with open(self.filename, 'w', newline='') as f:
+                csv.writer(f).writerow(self.columns)
+
+
+    @staticmethod
+    def metric_columns(metric_classes):
+        columns = []
+        for metric_class in metric_classes:
+            for column in metric_class().result():
+                if column not in columns:
+                    columns.append(column)
+        return columns
+
+
+    def add(self, devicename, indices, results):
+        row = [devicename] + list(indices) + [results.get(column, '') for column in self.columns[len(self.DEVICE_COLUMNS):]]
+        with self._lock:
+            with open(self.filename, 'a', newline='') as f:
+                csv.writer(f).writerow(row)
@@ -0,0 +1,456 @@
+"""
+Scan throughput benchmark for the automated probestation.
+Runs complete wafer scans (AsyncScan with PreTestIV and Gatesweep, Worker, BufferRecorder, journal
+and summary) against simulated stages and source meters, in real time or faster with a time scaling
+factor, and reports devices/hour, a per-phase breakdown, memory growth and file I/O cost. With
+--gui the scan is also displayed (Manager, browser, PlotFrame) and GUI frame times are reported.
+Results can be stored as a baseline, later runs are compared against it to flag regressions.
+
+Run the program by changing to the directory containing this file and calling:
+python benchmark.py [--devices 1 10 100] [--scale 0.01] [--gui] [--save-baseline FILE] [--baseline FILE]
+
+Only simulated time (waits of stages, source meters and procedures) is scaled, overhead of the
+software itself is not. Compare results only between runs with the same scale and grid sizes.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+EXIT_OK = 0
+EXIT_REGRESSION = 1
+
+DEVICE_PITCH = 500          # steps between neighbouring devices
+XY_SPEED = 2000             # steps/s, StageStack.speed_up
+Z_SPEED = 4500
+Z_DEVICE = 5000             # z position of the probes on a device
+BUS_LATENCY = 2e-3          # s, one query to a source meter
+
+
+class ScaledClock(object):
+    '''
+    Simulated time: sleep(t) waits t*scale seconds.
+    '''
+    def __init__(self, scale=1.):
+        self.scale = scale
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds*self.scale)
+
+
+
+class FakeWafer(object):
+    '''
+    Transfer curves of the devices of a simulated wafer. Every device is a p-type transistor with
+    random threshold voltage, a fraction of the devices has no contact (fails the pretest).
+    '''
+    def __init__(self, seed=0, yield_fraction=0.9):
+        self.seed = seed
+        self.yield_fraction = yield_fraction
+        self.probed = None          # device indices under the probes (set by FakeStages)
+
+    def _device(self):
+        rng = random.Random(hash((self.seed, self.probed)))
+        return rng.random() < self.yield_fraction, rng.uniform(-1, 1), 10**rng.uniform(-6, -4)
+
+    def current(self, v_bias, v_gate):
+        if self.probed is None:
+            return 0.
+        contacted, v_th, i_on = self._device()
+        if not contacted:
+            return 1e-12*np.random.randn()
+        # ohmic at the threshold, smooth on/off transition (100 mV/dec below threshold)
+        conduction = i_on*(1 + math.log1p(math.exp(min((v_th - v_gate)/0.0434, 50))))
+        return v_bias*conduction + 1e-12*np.random.randn()
+
+
+
+class FakeSMU(object):
+    '''
+    Simulated Keithley 2450 with the methods and properties the procedures use. Queries take the
+    integration time (NPLC at 50 Hz) plus bus latency, ramps are limited to max_units_per_second.
+    The bias source meter (gate given) measures the channel current of the probed device, the
+    gate source meter only leakage.
+    '''
+    def __init__(self, wafer, clock, gate=None, max_stepsize=10e-3, max_units_per_second=100e-3):
+        self.wafer = wafer
+        self.clock = clock
+        self.gate = gate
+        self.voltage = 0.
+        self.nplc = 1
+        self.source_enabled = False
+        self.max_units_per_second = max_units_per_second
+
+    def apply_voltage(self, voltage_range=None, compliance_current=None):
+        self.clock.sleep(BUS_LATENCY)
+
+    def measure_current(self, nplc=1, current=None, auto_range=True):
+        self.nplc = nplc
+        self.clock.sleep(BUS_LATENCY)
+
+    def write(self, command):
+        # SCPI settings of quality.py, only the integration time is simulated
+        if command.startswith(":SENS:CURR:NPLC"):
+            self.nplc = float(command.split()[1])
+        self.clock.sleep(BUS_LATENCY)
+
+    def enable_source(self):
+        self.source_enabled = True
+        self.clock.sleep(BUS_LATENCY)
+
+    def disable_source(self):
+        self.source_enabled = False
+        self.clock.sleep(BUS_LATENCY)
+
+    def ramp_to_voltage(self, voltage):
+        self.clock.sleep(abs(voltage-self.voltage)/self.max_units_per_second + BUS_LATENCY)
+        self.voltage = voltage
+
+    @property
+    def current(self):
+        self.clock.sleep(self.nplc/50. + BUS_LATENCY)
+        if self.gate is not None:
+            return self.wafer.current(self.voltage, self.gate.voltage)
+        return 1e-12*np.random.randn()
+
+
+
+class FakeStages(object):
+    '''
+    Simulated StageStack (interface of headless.NoStages plus move timing). Moves take the travel
+    distance over the speed of the axis, the wafer is told which device is under the probes.
+    '''
+    def __init__(self, wafer, clock):
+        self.wafer = wafer
+        self.clock = clock
+        self.stage_emergency_stop_call = threading.Event()
+        self.position = {'x': 0, 'y': 0, 'z': 0}
+        self._moving_until = {'x': 0., 'y': 0., 'z': 0.}
+        self._devices = {}
+        self._coordinates_center = [[0, 0], [0, 0], [500, 0]]
+        self._automovement_safe_height = 500
+
+    def restore_registration(self, registration):
+        pass
+
+    def calc_coordinates_delta_hor(self, chipcols, devcols):
+        pass
+
+    def calc_coordinates_delta_vert(self, chiprows, devrows):
+        pass
+
+    def calc_dev_coordinates(self, chipcol, chiprow, devcol, devrow):
+        coords = [[(10*chipcol+devcol)*DEVICE_PITCH, 0], [(10*chiprow+devrow)*DEVICE_PITCH, 0], [Z_DEVICE, 0]]
+        self._devices[(coords[0][0], coords[1][0])] = (chipcol, chiprow, devcol, devrow)
+        return coords
+
+    def move_axis(self, axis, coord):
+        if axis == 'z' and coord[0] < self.position['z']:
+            self.wafer.probed = None            # probes lifted
+        speed = Z_SPEED if axis == 'z' else XY_SPEED
+        duration = abs(coord[0]-self.position[axis])/speed*self.clock.scale
+        self._moving_until[axis] = time.perf_counter()+duration
+        self.position[axis] = coord[0]
+        if axis == 'z' and coord[0] == Z_DEVICE:
+            self.wafer.probed = self._devices.get((self.position['x'], self.position['y']))
+
+    def axis_moving(self, axis):
+        return time.perf_counter() < self._moving_until[axis]
+
+    def goto_coords(self, coords):
+        for axis, coord in zip('xyz', coords):
+            self.move_axis(axis, coord)
+        time.sleep(max(0., max(self._moving_until.values())-time.perf_counter()))
+
+    def speed_up(self):
+        pass
+
+    def slow_down(self):
+        pass
+
+    def stage_movement_emergency_stop(self):
+        self._moving_until = dict.fromkeys(self._moving_until, 0.)
+        self.stage_emergency_stop_call.clear()
+
+
+
+@contextmanager
+def scaled_time(clock):
+    '''
+    Scales the waits of the procedures and of the scan core to simulated time.
+    '''
+    import measurements
+    import orchestrator
+    saved = measurements.sleep, orchestrator.SETTLE_TIME, orchestrator.MOVE_STARTUP
+    measurements.sleep = clock.sleep
+    orchestrator.SETTLE_TIME = saved[1]*clock.scale
+    orchestrator.MOVE_STARTUP = saved[2]*clock.scale
+    try:
+        yield
+    finally:
+        measurements.sleep, orchestrator.SETTLE_TIME, orchestrator.MOVE_STARTUP = saved
+
+
+
+def grid(devices):
+    '''
+    Returns (chipcols, chiprows, devcols, devrows) of a grid with the given number of devices:
+    10x10 devices per chip, as many chips as needed (rounded to complete rows of devices).
+    '''
+    devcols = min(10, devices)
+    devrows = min(10, math.ceil(devices/devcols))
+    chips = math.ceil(devices/(devcols*devrows))
+    chipcols = min(10, chips)
+    chiprows = math.ceil(chips/chipcols)
+    return chipcols, chiprows, devcols, devrows
+
+
+
+class BenchmarkWindow(object):
+    '''
+    The display part of the MainWindow: plot, browser and Manager, fed by the ScanThread signals
+    the same way MainWindow._scan_procedure/_scan_progress/_scan_status do.
+    '''
+    def __init__(self, procedure_class):
+        from pymeasure.display.browser import BrowserItem
+        from widgets import PlotWidget, BrowserWidget
+        from manager import Manager, Experiment
+        self.procedure_class = procedure_class
+        self.widget_plot = PlotWidget(procedure_class.DATA_COLUMNS, 'Gate Voltage (V)', 'Current (A)')
+        self.widget_browser = BrowserWidget(procedure_class, ['devicename'], ['Gate Voltage (V)', 'Current (A)'])
+        self.manager = Manager(self.widget_plot.plot, self.widget_browser.browser)
+        self._BrowserItem, self._Experiment = BrowserItem, Experiment
+
+    def procedure(self, info):
+        from pymeasure.experiment import Procedure, Results
+        procedure = self.procedure_class()
+        procedure.set_parameters(info['parameters'], except_missing=False)
+        results = Results(procedure, info['datafile'])
+        curve = self.widget_plot.new_curve(results)
+        experiment = self._Experiment(results, curve, self._BrowserItem(results, curve))
+        curve.attach(info['buffer'])
+        self.manager.load(experiment)
+        self.manager.experiments.update_status(experiment, Procedure.RUNNING)
+
+    def progress(self, datafile, progress):
+        experiment = self.manager.experiments.with_data_filename(datafile)
+        if experiment is not None:
+            experiment.browser_item.setProgress(progress)
+
+    def status(self, datafile, status):
+        from progress import TERMINAL
+        experiment = self.manager.experiments.with_data_filename(datafile)
+        if experiment is not None:
+            self.manager.experiments.update_status(experiment, status)
+            experiment.browser_item.setStatus(status)
+            if status in TERMINAL and not experiment.curve.is_shared():
+                experiment.curve.evict()
+
+
+
+def folder_size(folder):
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+
+def run_benchmark(devices, clock, folder, gui=False, V_g_steps=50):
+    '''
+    Runs one scan of the given number of devices and returns its metrics as dictionary.
+    '''
+    from headless import HeadlessStation
+    from journal import ScanJournal
+    from measurements import Gatesweep
+    from orchestrator import AsyncScan
+    from tracing import TRACER
+
+    chipcols, chiprows, devcols, devrows = grid(devices)
+    parameters = Gatesweep().parameter_values()
+    parameters.update(wafername='benchmark', savepath=folder, chipcols=chipcols, chiprows=chiprows,
+                      devcols=devcols, devrows=devrows, V_g_steps=V_g_steps)
+    scanfolder = os.path.join(folder, 'scan_%d' % devices)
+    os.makedirs(scanfolder)
+    journal = ScanJournal(scanfolder)
+    journal.write_plan(parameters, {})
+    recipe = {'parameters': parameters, 'registration': {}, 'pretest': 'PreTestIV', 'procedure': 'Gatesweep',
+              'instruments': {}, 'timeout': 3600, 'trace': False}
+
+    wafer = FakeWafer()
+    gate = FakeSMU(wafer, clock, max_stepsize=1e-3, max_units_per_second=20e-3)
+    bias = FakeSMU(wafer, clock, gate=gate, max_stepsize=10e-3, max_units_per_second=100e-3)
+    station = HeadlessStation(bias, gate)
+    scan = AsyncScan(recipe, journal, station, FakeStages(wafer, clock), out=None)
+
+    TRACER.clear()
+    TRACER.enable()
+    tracemalloc.start()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with scaled_time(clock):
+        if gui:
+            code = run_gui(scan)
+        else:
+            code = asyncio.run(scan.run())
+    wall = time.perf_counter()-start
+    memory_end, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    TRACER.disable()
+
+    measured = chipcols*chiprows*devcols*devrows
+    phases = {}
+    for cat, name, count, total, mean, maximum, n in TRACER.summary():
+        if cat != 'gui':
+            phases[cat+'/'+name] = total/measured
+    frames = np.array([(end-begin)/1e6 for name, cat, device, tid, begin, end, args in TRACER.spans
+                       if name == 'plot frame'])
+    io_time = sum(total for cat, name, count, total, mean, maximum, n in TRACER.summary() if cat == 'io')
+    return {
+        'devices': measured,
+        'exit code': code,
+        'scale': clock.scale,
+        'wall (s)': wall,
+        'devices/hour': measured/wall*3600,
+        'phases (s/device)': phases,
+        'frame mean (ms)': float(frames.mean()) if len(frames) else None,
+        'frame p95 (ms)': float(np.percentile(frames, 95)) if len(frames) else None,
+        'frame max (ms)': float(frames.max()) if len(frames) else None,
+        'memory growth (MB)': (memory_end-memory_start)/2**20,
+        'memory peak (MB)': memory_peak/2**20,
+        'file I/O (s/device)': io_time/measured,
+        'data (kB/device)': folder_size(scanfolder)/measured/1024,
+    }
+
+
+
+def run_gui(scan):
+    '''
+    Runs the scan through the Qt bridge (ScanThread) with plot, browser and Manager attached.
+    '''
+    from pymeasure.display.Qt import QtGui
+    from engine import ScanThread
+    from measurements import Gatesweep
+    app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+    window = BenchmarkWindow(Gatesweep)
+    thread = ScanThread(scan)
+    thread.procedure.connect(window.procedure)
+    thread.progress.connect(window.progress)
+    thread.status.connect(window.status)
+    codes = []
+    thread.finished_scan.connect(codes.append)
+    thread.finished_scan.connect(lambda code: app.quit())
+    thread.start()
+    app.exec_()
+    thread.wait()
+    window.manager.clear()
+    return codes[0] if codes else None
+
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns descriptions of the metrics that are worse than the baseline by more than tolerance
+    (relative). Phase durations below 1 ms per device are ignored (timer noise).
+    '''
+    regressions = []
+    def check(label, new, old, higher_is_better=False, floor=0.):
+        if new is None or old is None or max(abs(new), abs(old)) < floor:
+            return
+        worse = new < old*(1-tolerance) if higher_is_better else new > old*(1+tolerance)
+        if worse:
+            regressions.append("%s: %.4g (baseline %.4g)" % (label, new, old))
+    for devices, result in results.items():
+        old = baseline.get(devices)
+        if old is None:
+            continue
+        prefix = "%s devices, " % devices
+        check(prefix+'devices/hour', result['devices/hour'], old['devices/hour'], higher_is_better=True)
+        check(prefix+'frame p95 (ms)', result['frame p95 (ms)'], old['frame p95 (ms)'], floor=1.)
+        check(prefix+'memory growth (MB)', result['memory growth (MB)'], old['memory growth (MB)'], floor=1.)
+        check(prefix+'file I/O (s/device)', result['file I/O (s/device)'], old['file I/O (s/device)'], floor=1e-3)
+        for phase, duration in result['phases (s/device)'].items():
+            check(prefix+phase, duration, old['phases (s/device)'].get(phase), floor=1e-3)
+    return regressions
+
+
+
+def report(results, out=sys.stdout):
+    for devices, result in results.items():
+        out.write("\n%s devices, scale %g: %.1f s, %.0f devices/hour (exit code %s)\n"
+                  % (devices, result['scale'], result['wall (s)'], result['devices/hour'], result['exit code']))
+        for key in ('frame mean (ms)', 'frame p95 (ms)', 'frame max (ms)', 'memory growth (MB)',
+                    'memory peak (MB)', 'file I/O (s/device)', 'data (kB/device)'):
+            if result[key] is not None:
+                out.write("    %-24s %10.4g\n" % (key, result[key]))
+        out.write("    phases (s/device):\n")
+        for phase, duration in sorted(result['phases (s/device)'].items(), key=lambda item: -item[1]):
+            out.write("        %-32s %10.4f\n" % (phase, duration))
+    out.flush()
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark complete scans against simulated stages and source meters.")
+    parser.add_argument('--devices', type=int, nargs='+', default=[1, 10, 100], help="grid sizes (1 to 10000)")
+    parser.add_argument('--scale', type=float, default=0.01, help="time scaling factor of the simulation (1: real time)")
+    parser.add_argument('--gate-step', type=int, default=50, help="gate voltage step of the sweep (mV)")
+    parser.add_argument('--gui', action='store_true', help="display the scan (Manager, browser, plot) and measure frame times")
+    parser.add_argument('--folder', help="folder for the scan data (default: temporary, removed afterwards)")
+    parser.add_argument('--baseline', metavar='FILE', help="compare against the baseline in FILE")
+    parser.add_argument('--save-baseline', metavar='FILE', help="store the results as baseline in FILE")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="relative change counted as regression")
+    args = parser.parse_args(argv)
+
+    if args.gui and not os.environ.get('DISPLAY') and sys.platform.startswith('linux'):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    folder = args.folder or tempfile.mkdtemp(prefix='probestation_benchmark_')
+    from catalog import CATALOG
+    CATALOG.filename = os.path.join(folder, 'catalog.sqlite')      # benchmark scans stay out of the user's catalog
+    clock = ScaledClock(args.scale)
+    results = {}
+    try:
+        for devices in args.devices:
+            results[str(devices)] = run_benchmark(devices, clock, folder, args.gui, args.gate_step)
+    finally:
+        CATALOG.close()
+        if not args.folder:
+            shutil.rmtree(folder, ignore_errors=True)
+    report(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.stdout.write("\nREGRESSIONS (tolerance %g):\n    " % args.tolerance + "\n    ".join(regressions) + "\n")
+            return EXIT_REGRESSION
+        sys.stdout.write("\nno regressions against %s\n" % args.baseline)
+    return EXIT_OK
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,499 @@
+"""
+Catalog of the measurements of all scans.
+A local SQLite database with one entry per device: wafer, scan folder, device indices, status,
+data files with their procedure, the header parameters and the extracted metrics. Scans record
+every device as it finishes (orchestrator.py, headless.py), folders measured before (or by the old
+starter) are added with backfill. Queries run on indexes instead of walking folders and opening
+headers; they are available in the browser of the GUI and as Python API:
+
+    from catalog import CATALOG
+    CATALOG.find(wafer='W1', where=[('Bias Voltage maximum', '=', '100 mV'), ('On/off ratio', '>', 5)])
+    CATALOG.query("wafer=W1; V_bias=100 mV; On/off ratio>5")
+
+Conditions compare fields (wafer, scan, device, status, procedure, chipcol, chiprow, devcol,
+devrow), header parameters (by name or by attribute of the procedure class) or metrics. Values
+with units are compared in SI base units ("100 mV" = "0.1 V").
+
+Run the program by changing to the directory containing this file and calling:
+python catalog.py backfill FOLDER [FOLDER ...]
+python catalog.py find "wafer=W1; Bias Voltage maximum=100 mV" [--limit N]
+"""
+
+import os
+import re
+import sys
+import math
+import sqlite3
+import argparse
+import importlib
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+from consolidate import MEASUREMENTS, parse_header, parse_results, extract_metrics, device_indices
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+CATALOG_FILE = os.path.join(os.path.expanduser('~'), '.probestation', 'catalog.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL UNIQUE,
+    wafer TEXT
+);
+CREATE TABLE IF NOT EXISTS devices (
+    id INTEGER PRIMARY KEY,
+    scan INTEGER NOT NULL REFERENCES scans(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    chipcol INTEGER, chiprow INTEGER, devcol INTEGER, devrow INTEGER,
+    status TEXT,
+    folder TEXT NOT NULL UNIQUE,
+    recorded TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    device INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+    measurement TEXT NOT NULL,
+    path TEXT NOT NULL,
+    procedure TEXT,
+    mtime_ns INTEGER,
+    size INTEGER,
+    PRIMARY KEY (device, measurement)
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    device INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT,
+    number REAL,
+    unit TEXT,
+    PRIMARY KEY (device, name)
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    device INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (device, name)
+);
+CREATE INDEX IF NOT EXISTS scans_wafer ON scans(wafer);
+CREATE INDEX IF NOT EXISTS devices_scan ON devices(scan, chipcol, chiprow, devcol, devrow);
+CREATE INDEX IF NOT EXISTS devices_status ON devices(status);
+CREATE INDEX IF NOT EXISTS files_procedure ON files(procedure);
+CREATE INDEX IF NOT EXISTS parameters_number ON parameters(name, number);
+CREATE INDEX IF NOT EXISTS parameters_value ON parameters(name, value);
+CREATE INDEX IF NOT EXISTS metrics_value ON metrics(name, value);
+'''
+
+# query fields and their columns
+FIELDS = {'wafer': 's.wafer', 'scan': 's.folder', 'device': 'd.name', 'status': 'd.status',
+          'chipcol': 'd.chipcol', 'chiprow': 'd.chiprow', 'devcol': 'd.devcol', 'devrow': 'd.devrow'}
+INDEX_FIELDS = ('chipcol', 'chiprow', 'devcol', 'devrow')
+OPERATORS = ('>=', '<=', '!=', '=', '>', '<')
+TERM = re.compile(r'^\s*(.+?)\s*(%s)\s*(.*?)\s*$' % '|'.join(re.escape(op) for op in OPERATORS))
+NUMBER = re.compile(r'^([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(\S*)$')
+SI_PREFIXES = {'p': 1e-12, 'n': 1e-9, 'u': 1e-6, 'm': 1e-3, 'k': 1e3, 'M': 1e6, 'G': 1e9}
+SI_UNITS = ('V', 'A', 's', 'Ohm', 'Hz', 'W', 'F')
+RELATIVE_TOLERANCE = 1e-9       # of '=' on numbers
+
+
+class CatalogError(Exception):
+    pass
+
+
+
+class CatalogEntry(namedtuple('CatalogEntry', ['wafer', 'scan', 'device', 'indices', 'status', 'folder',
+                                               'files', 'metrics'])):
+    '''
+    Catalogued device: files {measurement: path} (pretest, gatetrace), metrics {name: value}.
+    '''
+
+
+
+def parse_quantity(text):
+    '''
+    Returns (number, unit) of a parameter value, in SI base units ("100 mV": (0.1, 'V')), or
+    (None, None) if it is not a number.
+    '''
+    match = NUMBER.match(text.strip())
+    if not match:
+        return None, None
+    number, unit = float(match.group(1)), match.group(2)
+    if len(unit) > 1 and unit[0] in SI_PREFIXES and unit[1:] in SI_UNITS:
+        number, unit = number*SI_PREFIXES[unit[0]], unit[1:]
+    return number, unit
+
+
+def parse_query(text):
+    '''
+    Splits a query ("wafer=W1; Bias Voltage maximum=100 mV; On/off ratio>5") into conditions
+    [(name, operator, value), ...]. Raises ValueError for terms without operator.
+    '''
+    conditions = []
+    for term in text.split(';'):
+        if not term.strip():
+            continue
+        match = TERM.match(term)
+        if not match:
+            raise ValueError("No comparison in query term '%s'" % term.strip())
+        conditions.append(match.groups())
+    return conditions
+
+
+def read_files(datafolder):
+    '''
+    Reads the headers of the data files of a device. Returns [(measurement, path, procedure,
+    parameters, mtime_ns, size), ...] of the readable files.
+    '''
+    files = []
+    for measurement, filename, _ in MEASUREMENTS:
+        path = os.path.join(datafolder, filename)
+        try:
+            stat = os.stat(path)
+            with open(path, 'r') as f:
+                procedure, parameters = parse_header(f)
+        except (OSError, ValueError, UnicodeDecodeError):
+            continue
+        files.append((measurement, path, procedure, parameters, stat.st_mtime_ns, stat.st_size))
+    return files
+
+
+def scan_folders(folder):
+    '''
+    Yields the scan folders (folders with dev_* device folders) in and below folder.
+    '''
+    for root, dirs, _ in os.walk(folder):
+        if any(name.startswith('dev_') for name in dirs):
+            yield root
+            dirs[:] = []
+        else:
+            dirs.sort()
+
+
+def journal_outcomes(scanfolder):
+    '''
+    Wafer name and {device name: (status, pretest passed or None)} from the scan journal of
+    scanfolder, (None, {}) if it has none.
+    '''
+    from journal import ScanJournal
+    from pymeasure.experiment import Procedure
+    try:
+        journal = ScanJournal.load(scanfolder)
+    except (OSError, ValueError):
+        return None, {}
+    outcomes = {}
+    for name, state in journal.devices.items():
+        passed = state['pretest']['passed'] if 'pretest' in state else None
+        if 'measured' in state:
+            outcomes[name] = (Procedure.STATUS_STRINGS.get(state['measured']['status'], 'unknown').lower(), passed)
+        elif passed is False:
+            outcomes[name] = ('failed pretest', passed)
+        else:
+            outcomes[name] = ('incomplete', passed)
+    return journal.parameters.get('wafername'), outcomes
+
+
+def _folder(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+
+class Catalog(object):
+    '''
+    SQLite catalog of measured devices. The database is opened on first use; one connection is
+    shared by all threads of a process (the scan thread records, the GUI queries), processes
+    share the file (write-ahead log).
+
+    :param filename: database file, created if it does not exist
+    '''
+
+    def __init__(self, filename=CATALOG_FILE):
+        self.filename = filename
+        self._db = None
+        self._aliases = None            # parameter attribute -> parameter name
+        self._procedures = set()        # procedure classes the aliases are collected from
+        self._lock = threading.RLock()
+
+
+    def _connect(self):
+        if self._db is None:
+            if os.path.dirname(self.filename):
+                os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            db = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('PRAGMA foreign_keys=ON')
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            try:
+                db = self._connect()
+                with db:                # commits, or rolls back on exceptions
+                    yield db
+            except (sqlite3.Error, OSError) as e:
+                raise CatalogError("Catalog %s: %s" % (self.filename, e)) from e
+
+
+    def _scan_id(self, db, scanfolder, wafer):
+        db.execute("INSERT INTO scans (folder, wafer) VALUES (?, ?) "
+                   "ON CONFLICT(folder) DO UPDATE SET wafer = COALESCE(excluded.wafer, wafer)", (scanfolder, wafer))
+        return db.execute("SELECT id FROM scans WHERE folder = ?", (scanfolder,)).fetchone()[0]
+
+
+    def record_device(self, scanfolder, datafolder, devicename, indices=None, status=None, metrics=None, wafer=None):
+        '''
+        Records a device of the scan in scanfolder, replacing an earlier record: the headers of its
+        data files in datafolder, status and metrics ({name: value}, NaN are left out). Indices and
+        wafer default to the header parameters. Raises CatalogError.
+        '''
+        files = read_files(datafolder)
+        parameters = {}
+        for _, _, _, file_parameters, _, _ in files:
+            parameters.update(file_parameters)          # measurement after pretest
+        if indices is None:
+            indices = device_indices(devicename, parameters)
+        if wafer is None:
+            wafer = parameters.get('Wafer Name')
+        values = []
+        for name, value in (metrics or {}).items():
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if math.isfinite(value):
+                values.append((name, value))
+
+        with self._transaction() as db:
+            scan = self._scan_id(db, _folder(scanfolder), wafer)
+            db.execute("INSERT INTO devices (scan, name, chipcol, chiprow, devcol, devrow, status, folder, recorded) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(folder) DO UPDATE SET "
+                       "scan = excluded.scan, name = excluded.name, chipcol = excluded.chipcol, chiprow = excluded.chiprow, "
+                       "devcol = excluded.devcol, devrow = excluded.devrow, status = excluded.status, recorded = excluded.recorded",
+                       (scan, devicename)+tuple(int(index) for index in indices)+(status, _folder(datafolder), dt.now().isoformat()))
+            device = db.execute("SELECT id FROM devices WHERE folder = ?", (_folder(datafolder),)).fetchone()[0]
+            for table in ('files', 'parameters', 'metrics'):
+                db.execute("DELETE FROM %s WHERE device = ?" % table, (device,))
+            db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                           [(device, measurement, path, procedure, mtime_ns, size)
+                            for measurement, path, procedure, _, mtime_ns, size in files])
+            db.executemany("INSERT INTO parameters VALUES (?, ?, ?, ?, ?)",
+                           [(device, name, value)+parse_quantity(value) for name, value in parameters.items()])
+            db.executemany("INSERT INTO metrics VALUES (?, ?, ?)", [(device, name, value) for name, value in values])
+            if files and self._aliases is not None and any(procedure not in self._procedures for _, _, procedure, _, _, _ in files):
+                self._aliases = None        # new procedure class, aliases are collected again
+
+
+    def _recorded_files(self, scanfolder):
+        # {device folder: {(measurement, mtime_ns, size), ...}} of the devices of scanfolder
+        recorded = {}
+        with self._transaction() as db:
+            rows = db.execute("SELECT d.folder, f.measurement, f.mtime_ns, f.size FROM devices d "
+                              "JOIN scans s ON s.id = d.scan JOIN files f ON f.device = d.id WHERE s.folder = ?",
+                              (_folder(scanfolder),)).fetchall()
+        for folder, measurement, mtime_ns, size in rows:
+            recorded.setdefault(folder, set()).add((measurement, mtime_ns, size))
+        return recorded
+
+
+    def backfill(self, folder, out=None):
+        '''
+        Records the devices of all scan folders in and below folder that are not catalogued yet or
+        whose data files changed since. Status comes from the scan journal if there is one
+        ('unknown' otherwise), metrics are extracted from the data. Returns the number of devices
+        recorded. Raises CatalogError.
+        '''
+        recorded = 0
+        for scanfolder in scan_folders(folder):
+            wafer, outcomes = journal_outcomes(scanfolder)
+            known = self._recorded_files(scanfolder)
+            count = 0
+            for entry in sorted(os.scandir(scanfolder), key=lambda entry: entry.name):
+                if not entry.is_dir() or not entry.name.startswith('dev_'):
+                    continue
+                current = set()
+                for measurement, filename, _ in MEASUREMENTS:
+                    try:
+                        stat = os.stat(os.path.join(entry.path, filename))
+                    except OSError:
+                        continue
+                    current.add((measurement, stat.st_mtime_ns, stat.st_size))
+                if current and known.get(_folder(entry.path)) == current:
+                    continue
+                name = entry.name[len('dev_'):]
+                status, passed = outcomes.get(name, ('unknown', None))
+                metrics = {} if passed is None else {'Pretest': float(passed)}
+                for measurement, filename, metric_classes in MEASUREMENTS:
+                    try:
+                        _, _, columns, data = parse_results(os.path.join(entry.path, filename))
+                    except (OSError, ValueError, UnicodeDecodeError):
+                        continue
+                    metrics.update(extract_metrics(metric_classes, columns, data))
+                self.record_device(scanfolder, entry.path, name, status=status, metrics=metrics, wafer=wafer)
+                count += 1
+            if out is not None:
+                out.write("%s\t%d devices recorded\n" % (scanfolder, count))
+                out.flush()
+            recorded += count
+        return recorded
+
+
+    def _parameter_name(self, db, name):
+        # parameter attribute of a catalogued procedure class (V_bias) -> parameter name, else name
+        if self._aliases is None:
+            from pymeasure.experiment.parameters import Parameter
+            self._procedures = set(row[0] for row in db.execute("SELECT DISTINCT procedure FROM files"))
+            self._aliases = {}
+            for procedure in self._procedures:
+                module, _, classname = (procedure or '').rpartition('.')
+                try:
+                    procedure_class = getattr(importlib.import_module(module), classname)
+                except (ImportError, AttributeError, ValueError):
+                    continue
+                for attribute in dir(procedure_class):
+                    parameter = getattr(procedure_class, attribute, None)
+                    if isinstance(parameter, Parameter):
+                        self._aliases.setdefault(attribute, parameter.name)
+        return self._aliases.get(name, name)
+
+
+    def _condition(self, db, name, operator, value):
+        # SQL clause and arguments of one condition
+        if operator not in OPERATORS:
+            raise ValueError("Unknown operator '%s'" % operator)
+        if name in FIELDS:
+            if name in INDEX_FIELDS:
+                value = int(value)
+            return "%s %s ?" % (FIELDS[name], operator), [value]
+        if name == 'procedure':     # full name (measurements.Gatesweep) or class name
+            clause = "d.id %s (SELECT device FROM files WHERE procedure = ? OR procedure LIKE ?)"
+            return clause % ('NOT IN' if operator == '!=' else 'IN'), [value, '%.'+value]
+
+        name = self._parameter_name(db, name)
+        if isinstance(value, str):
+            number, unit = parse_quantity(value)
+        else:
+            number, unit = float(value), None
+        if number is None:
+            if operator not in ('=', '!='):
+                raise ValueError("%s %s %s: not a number" % (name, operator, value))
+            return "d.id IN (SELECT device FROM parameters WHERE name = ? AND value %s ?)" % operator, [name, value]
+        if operator in ('=', '!='):
+            tolerance = abs(number)*RELATIVE_TOLERANCE
+            comparison = ("BETWEEN" if operator == '=' else "NOT BETWEEN")+" ? AND ?"
+            numbers = [number-tolerance, number+tolerance]
+        else:
+            comparison, numbers = operator+" ?", [number]
+        units = " AND unit = ?" if unit else ""
+        clause = ("(d.id IN (SELECT device FROM parameters WHERE name = ? AND number %s%s) "
+                  "OR d.id IN (SELECT device FROM metrics WHERE name = ? AND value %s))") % (comparison, units, comparison)
+        return clause, [name]+numbers+([unit] if unit else [])+[name]+numbers
+
+
+    def find(self, where=(), limit=None, **fields):
+        '''
+        Returns the CatalogEntry of the devices matching all conditions, ordered by scan and device.
+        Raises ValueError for invalid conditions, CatalogError.
+
+        :param where: conditions [(name, operator, value), ...], name: field, parameter or metric,
+            operator: = != < <= > >=, value: text ("100 mV") or number (SI base units)
+        :param limit: maximum number of entries
+        :param fields: conditions name=value, e.g. wafer='W1', status='finished'
+        '''
+        conditions = [(name, '=', value) for name, value in fields.items()]+list(where)
+        with self._transaction() as db:
+            clauses, arguments = [], []
+            for name, operator, value in conditions:
+                clause, values = self._condition(db, name, operator, value)
+                clauses.append(clause)
+                arguments.extend(values)
+            sql = ("SELECT d.id, s.wafer, s.folder, d.name, d.chipcol, d.chiprow, d.devcol, d.devrow, d.status, d.folder "
+                   "FROM devices d JOIN scans s ON s.id = d.scan")
+            if clauses:
+                sql += " WHERE "+" AND ".join(clauses)
+            sql += " ORDER BY s.folder, d.name"
+            if limit is not None:
+                sql += " LIMIT %d" % int(limit)
+            rows = db.execute(sql, arguments).fetchall()
+
+            files, metrics = {}, {}
+            ids = [row[0] for row in rows]
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start+500]
+                marks = ",".join("?"*len(chunk))
+                for device, measurement, path in db.execute(
+                        "SELECT device, measurement, path FROM files WHERE device IN (%s)" % marks, chunk):
+                    files.setdefault(device, {})[measurement] = path
+                for device, name, value in db.execute(
+                        "SELECT device, name, value FROM metrics WHERE device IN (%s)" % marks, chunk):
+                    metrics.setdefault(device, {})[name] = value
+        return [CatalogEntry(wafer, scan, name, (chipcol, chiprow, devcol, devrow), status, folder,
+                             files.get(device, {}), metrics.get(device, {}))
+                for device, wafer, scan, name, chipcol, chiprow, devcol, devrow, status, folder in rows]
+
+
+    def query(self, text, limit=None):
+        '''
+        find() with the conditions of a query text, see parse_query().
+        '''
+        return self.find(parse_query(text), limit)
+
+
+    def parameters(self, entry):
+        '''
+        Header parameters {name: value text} of a CatalogEntry.
+        '''
+        with self._transaction() as db:
+            rows = db.execute("SELECT p.name, p.value FROM parameters p JOIN devices d ON d.id = p.device "
+                              "WHERE d.folder = ? ORDER BY p.name", (entry.folder,)).fetchall()
+        return dict(rows)
+
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+
+CATALOG = Catalog()
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Catalog of the measured devices of all scans.")
+    parser.add_argument('--catalog', metavar='FILE', default=CATALOG_FILE, help="catalog database (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    backfill = commands.add_parser('backfill', help="record the devices of existing scan folders")
+    backfill.add_argument('folders', nargs='+', metavar='FOLDER', help="scan folder or folder of scan folders")
+    find = commands.add_parser('find', help="list the devices matching a query")
+    find.add_argument('query', help="conditions separated by ';', e.g. \"wafer=W1; Bias Voltage maximum=100 mV\"")
+    find.add_argument('--limit', type=int, help="maximum number of devices listed")
+    args = parser.parse_args(argv)
+
+    catalog = Catalog(args.catalog)
+    try:
+        if args.command == 'backfill':
+            for folder in args.folders:
+                catalog.backfill(folder, sys.stdout)
+        else:
+            for entry in catalog.query(args.query, args.limit):
+                sys.stdout.write("\t".join([entry.wafer or '', entry.device, entry.status or '', entry.folder])+"\n")
+    except (CatalogError, ValueError) as e:
+        sys.stderr.write(str(e)+"\n")
+        return 1
+    finally:
+        catalog.close()
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
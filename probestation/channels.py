@@ -0,0 +1,249 @@
+# parallel measurement of several devices per landing
+# a probe card can contact several devices of a chip at once, all of them on the same gate. Every
+# contacted device gets a measurement channel: a bias source meter of its own and a fixed offset
+# (device columns, device rows) from the device the stages move to. The devices of a landing are
+# measured concurrently, each with its own procedure, data file and results; the gate source meter
+# is shared and steps the gate for all channels together (SharedGate).
+#
+# recipe (see headless.py):
+#     "channels": [{"name": "A", "bias": "USB0::...", "offset": [0, 0]},
+#                  {"name": "B", "bias": "USB0::...", "offset": [1, 0]}, ...]
+# the first channel is the one the stage registration was captured with
+# no Qt imports in here
+
+import threading
+from collections import Counter
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+SYNC_TIMEOUT = 120          # s, a channel waits at most this long for the other channels at a gate step
+
+
+class ChannelError(Exception):
+    pass
+
+
+
+class Channel(object):
+    '''
+    Measurement channel of a probe card.
+
+    :param name: channel name, used in logs and progress lines
+    :param offset: (device columns, device rows) from the device of the first channel
+    :param sourcemeter: bias source meter of the channel
+    '''
+
+    def __init__(self, name, offset=(0, 0), sourcemeter=None):
+        self.name = name
+        self.offset = tuple(offset)
+        self.sourcemeter = sourcemeter
+
+
+
+def check_channels(config):
+    '''
+    Raises ChannelError if the channels of a recipe ("channels") can not be mapped to devices.
+    '''
+    offsets = []
+    for n, entry in enumerate(config):
+        offset = entry.get('offset', (0, 0))
+        if len(offset) != 2 or not all(isinstance(value, int) for value in offset):
+            raise ChannelError("Offset of channel "+str(n)+" is not [devcols, devrows]")
+        offsets.append(tuple(offset))
+    if len(set(offsets)) != len(offsets):
+        raise ChannelError("Channels with the same offset")
+    names = [str(entry.get('name', n)) for n, entry in enumerate(config)]
+    if len(set(names)) != len(names):
+        raise ChannelError("Channels with the same name")
+
+
+
+def open_channels(config):
+    '''
+    Opens the bias source meters of the channels of a recipe ("channels"), by VISA address or model
+    and serial (instruments.REGISTRY). Returns the list of Channels, empty for a recipe without
+    channels.
+    '''
+    if not config:
+        return []
+    check_channels(config)
+    from headless import BIAS_RAMP
+    from instruments import REGISTRY
+    channels = []
+    for n, entry in enumerate(config):
+        sourcemeter = None
+        if entry.get('bias'):
+            from pymeasure.instruments.keithley import Keithley2450
+            sourcemeter = REGISTRY.instrument(entry['bias'], Keithley2450, **BIAS_RAMP)
+        channels.append(Channel(str(entry.get('name', n)), entry.get('offset', (0, 0)), sourcemeter))
+    return channels
+
+
+
+def landings(plan, channels):
+    '''
+    Groups the pending devices of plan into landings: the stages move to the device of the first
+    channel, the other channels take the devices at their offsets on the same chip if those are
+    pending, within the stage limits and not taken by an earlier landing. Returns a list of
+    landings in scan order, each a list of (channel, plan index) with the first channel first.
+    Devices of a layout plan have no grid neighbours, they get one landing each.
+    '''
+    pending = plan.pending()
+    if plan.layout is not None or len(channels) < 2:
+        return [[(channels[0] if channels else None, int(i))] for i in pending]
+    d = plan.devices
+    free = {}
+    for i in pending:
+        if d['in_bounds'][i]:
+            free[plan.indices(i)] = int(i)
+    first = channels[0].offset
+    groups = []
+    for i in pending:
+        i = int(i)
+        chipcol, chiprow, devcol, devrow = plan.indices(i)
+        if not d['in_bounds'][i]:
+            groups.append([(channels[0], i)])
+            continue
+        if free.pop((chipcol, chiprow, devcol, devrow), None) is None:
+            continue                        # measured by an earlier landing
+        landing = [(channels[0], i)]
+        for channel in channels[1:]:
+            key = (chipcol, chiprow, devcol+channel.offset[0]-first[0], devrow+channel.offset[1]-first[1])
+            if key in free:
+                landing.append((channel, free.pop(key)))
+        groups.append(landing)
+    return groups
+
+
+
+class ChannelStation(object):
+    '''
+    Takes the place of the station as 'parent_window' of the procedures of one channel: the bias
+    source meter of the channel, the view of the shared gate and a pretest result flag of its own.
+    '''
+
+    def __init__(self, sourcemeter, gate=None):
+        self.sourcemeter = sourcemeter
+        self.gate = gate
+        self.current_device_passed_pretest = threading.Event()
+
+
+
+class SharedGate(object):
+    '''
+    Gate source meter shared by the channels of a landing. Each channel gets a view (view()) with
+    the gate methods the procedures call. Configuring and enabling happen once, for the first
+    channel that asks. Gate steps are synchronized: a step is made when every channel still on the
+    gate has requested its next voltage, so all channels measure at the same gate voltage. A channel
+    that requests a different voltage than the others (it stopped early and ramps down for its
+    shutdown, its bias is already at 0 V) is released without moving the gate. A channel leaves the
+    gate when it disables it; the last one ramps the gate to 0 V and disables it.
+
+    :param gate: gate source meter
+    :param names: names of the channels on the gate
+    :param timeout: longest wait of a channel for the others at a step
+    '''
+
+    def __init__(self, gate, names, timeout=SYNC_TIMEOUT):
+        self.gate = gate
+        self.timeout = timeout
+        self._active = set(names)
+        self._requests = {}
+        self._round = 0
+        self._configured = False
+        self._enabled = False
+        self._condition = threading.Condition()
+
+
+    def view(self, name):
+        return GateView(self, name)
+
+
+    def apply_voltage(self, name, **kwargs):
+        with self._condition:
+            if not self._configured:
+                self.gate.apply_voltage(**kwargs)
+                self._configured = True
+
+
+    def enable_source(self, name):
+        with self._condition:
+            if not self._enabled:
+                self.gate.enable_source()
+                self._enabled = True
+
+
+    def ramp_to_voltage(self, name, voltage):
+        with self._condition:
+            if name not in self._active:
+                return
+            self._requests[name] = voltage
+            current = self._round
+            if not self._step():
+                if not self._condition.wait_for(lambda: self._round != current, self.timeout):
+                    self._requests.pop(name, None)
+                    raise ChannelError("Channel "+name+" timed out waiting for the other channels at a gate step")
+
+
+    def _step(self):
+        # makes the step if all channels on the gate have a request, with the lock held
+        if not self._active or not self._active.issubset(self._requests):
+            return False
+        voltages = Counter(self._requests.values())
+        if len(voltages) > 1:
+            # channels ramping down for their shutdown are released, the others get their step
+            voltages = Counter(voltage for voltage in self._requests.values() if voltage != 0) or voltages
+        self.gate.ramp_to_voltage(voltages.most_common(1)[0][0])
+        self._requests = {}
+        self._round += 1
+        self._condition.notify_all()
+        return True
+
+
+    def leave(self, name):
+        '''
+        Takes channel name off the gate (idempotent). The last channel ramps the gate down and
+        disables it.
+        '''
+        with self._condition:
+            if name not in self._active:
+                return
+            self._active.discard(name)
+            self._requests.pop(name, None)
+            if self._active:
+                self._step()
+            elif self._enabled:
+                self.gate.ramp_to_voltage(0)
+                self.gate.disable_source()
+                self._enabled = False
+
+
+
+class GateView(object):
+    '''
+    Gate of one channel (SharedGate.view()), with the methods of the gate source meter used by
+    the procedures.
+    '''
+
+    def __init__(self, shared, name):
+        self.shared = shared
+        self.name = name
+
+
+    def apply_voltage(self, **kwargs):
+        self.shared.apply_voltage(self.name, **kwargs)
+
+
+    def enable_source(self):
+        self.shared.enable_source(self.name)
+
+
+    def ramp_to_voltage(self, voltage):
+        self.shared.ramp_to_voltage(self.name, voltage)
+
+
+    def disable_source(self):
+        self.shared.leave(self.name)
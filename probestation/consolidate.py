@@ -0,0 +1,514 @@
+"""
+Bulk converter for the data of wafer scans.
+Walks a scan folder (dev_<chip>_<chip>_<dev>_<dev>/pretest-IV.dat + gatetrace.dat, as written by
+the GUI, headless.py or the old starter) with a pool of processes, parses the pymeasure headers and
+data of all devices and consolidates them into one columnar dataset and one summary table:
+
+    wafer_dataset.npz       all data points of the wafer (see WaferDataset)
+    wafer_summary.csv       one row per device: indices, number of points, extracted metrics
+
+Converted devices are recorded in .consolidate/ inside the scan folder, an interrupted run
+(Ctrl+C) continues where it stopped and a run over a grown or partly rewritten folder only parses
+the devices that changed. Progress is streamed line by line to stdout (or a file), a throughput
+report is printed at the end.
+
+Run the program by changing to the directory containing this file and calling:
+python consolidate.py SCANFOLDER [SCANFOLDER ...] [--processes N] [--progress FILE] [--restart] [--clean]
+
+Reading the dataset:
+    dataset = WaferDataset(scanfolder)
+    dataset.devices                                 device table (name, indices)
+    dataset.column('gatetrace', 'Current (A)')      the column of all devices
+    dataset.device('0_0_1_0', 'gatetrace')          {column: array} of one device
+"""
+
+import os
+import re
+import sys
+import csv
+import json
+import time
+import signal
+import shutil
+import argparse
+import multiprocessing
+from functools import partial
+from datetime import datetime as dt
+
+import numpy as np
+
+from analysis import PRETEST_METRICS, GATESWEEP_METRICS, WaferSummary
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+EXIT_OK = 0             # all devices converted
+EXIT_FAILED = 1         # dataset written, but at least one data file could not be read
+EXIT_ABORTED = 2        # interrupted (Ctrl+C), continued by the next run
+EXIT_FOLDER = 3         # no scan folder / no device folders
+
+DATASET_FILENAME = 'wafer_dataset.npz'
+SUMMARY_FILENAME = 'wafer_summary.csv'
+PARTS_FOLDER = '.consolidate'
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+# measurements of a device: name in the dataset, data file, metrics extracted from it
+MEASUREMENTS = (('pretest', 'pretest-IV.dat', PRETEST_METRICS),
+                ('gatetrace', 'gatetrace.dat', GATESWEEP_METRICS))
+CURRENT_COLUMN = 'Current (A)'      # y of the metrics, x is the first data column
+INDEX_PARAMETERS = ('Chip columns', 'Chip rows', 'Device columns', 'Device rows')
+DEVICE_NAME = re.compile(r'^(-?\d+)_(-?\d+)_(-?\d+)_(-?\d+)$')
+
+
+def parse_header(f):
+    '''
+    Reads the pymeasure header of the results file open as f, up to the data section. Returns
+    (procedure, parameters): procedure class name and {parameter name: value text}. Raises
+    ValueError if the file has no pymeasure header.
+    '''
+    procedure, parameters, section = None, {}, None
+    for line in f:
+        if not line.startswith('#'):
+            raise ValueError("%s is not a results file" % f.name)
+        line = line[1:].rstrip('\r\n')
+        if line.startswith('Procedure:'):
+            procedure = line.split(':', 1)[1].strip().strip('<>')
+        elif line.startswith('Data:'):
+            return procedure, parameters
+        elif line.startswith('\t'):
+            if section == 'Parameters':
+                name, _, value = line.strip().partition(': ')
+                parameters[name] = value
+        else:
+            section = line.rstrip(':')
+    raise ValueError("%s has no data section" % f.name)
+
+
+def parse_results(filename):
+    '''
+    Reads a pymeasure results file without importing its procedure class (which may have changed
+    since the file was written). Returns (procedure, parameters, columns, data): procedure class
+    name, {parameter name: value text}, data column names and a 2D array (points x columns).
+    Raises ValueError if the file has no pymeasure header.
+    '''
+    with open(filename, 'r') as f:
+        procedure, parameters = parse_header(f)
+        header = f.readline().strip()
+        columns = header.split(',') if header else []
+        if not columns:
+            return procedure, parameters, columns, np.empty((0, 0))
+        data = np.loadtxt(f, delimiter=',', ndmin=2, dtype=float)
+    if data.size == 0:
+        data = np.empty((0, len(columns)))
+    if data.shape[1] != len(columns):
+        raise ValueError("%s has %d columns, %d names" % (filename, data.shape[1], len(columns)))
+    return procedure, parameters, columns, data
+
+
+def extract_metrics(metric_classes, columns, data):
+    results = {}
+    if CURRENT_COLUMN not in columns or len(data) == 0:
+        return results
+    x, y = data[:, 0], data[:, columns.index(CURRENT_COLUMN)]
+    for metric_class in metric_classes:
+        metric = metric_class()
+        metric.update(x, y)
+        results.update(metric.result())
+    return results
+
+
+def device_indices(name, parameters):
+    # indices from the folder name, layout devices (free names) from the header of the measurement
+    match = DEVICE_NAME.match(name)
+    if match:
+        return [int(index) for index in match.groups()]
+    try:
+        return [int(float(parameters[parameter])) for parameter in INDEX_PARAMETERS]
+    except (KeyError, ValueError):
+        return [-1]*len(INDEX_PARAMETERS)
+
+
+def source_key(devicefolder):
+    '''
+    Identifies the version of the data files of a device: [[file name, mtime_ns, size], ...] of
+    the files present.
+    '''
+    key = []
+    for _, filename, _ in MEASUREMENTS:
+        try:
+            stat = os.stat(os.path.join(devicefolder, filename))
+        except OSError:
+            continue
+        key.append([filename, stat.st_mtime_ns, stat.st_size])
+    return key
+
+
+def part_filename(partsfolder, name):
+    return os.path.join(partsfolder, name+'.npz')
+
+
+
+def convert_device(devicefolder, partsfolder):
+    '''
+    Parses the data files of one device and writes them to its part file (runs in the pool).
+    Returns the manifest entry of the device: name, indices, key, points, procedures, metrics,
+    bytes read and errors (unreadable files).
+    '''
+    name = os.path.basename(devicefolder)[len('dev_'):]
+    entry = {'device': name, 'key': source_key(devicefolder), 'points': {}, 'procedures': {},
+             'metrics': {}, 'bytes': 0, 'errors': []}
+    arrays, parameters = {}, {}
+    for measurement, filename, metric_classes in MEASUREMENTS:
+        filename = os.path.join(devicefolder, filename)
+        if not os.path.isfile(filename):
+            continue
+        try:
+            procedure, parameters[measurement], columns, data = parse_results(filename)
+        except (ValueError, OSError, UnicodeDecodeError) as e:
+            entry['errors'].append(str(e))
+            continue
+        entry['bytes'] += os.path.getsize(filename)
+        entry['points'][measurement] = len(data)
+        entry['procedures'][measurement] = procedure
+        entry['metrics'].update(extract_metrics(metric_classes, columns, data))
+        arrays[measurement+'/columns'] = np.array(columns, dtype=str)
+        arrays[measurement+'/data'] = data
+        arrays[measurement+'/parameters'] = np.array(json.dumps(parameters[measurement]))
+    entry['indices'] = device_indices(name, parameters.get('gatetrace', {}))
+
+    filename = part_filename(partsfolder, name)
+    with open(filename+'.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(filename+'.tmp', filename)
+    return entry
+
+
+
+def ignore_interrupt():
+    # Ctrl+C goes to the whole process group, the pool workers are stopped by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+
+class Manifest(object):
+    '''
+    Append-only record of the converted devices of a scan folder (one JSON object per line, the
+    entries returned by convert_device). The last entry of a device wins; a truncated last line
+    (crash while writing) is ignored.
+
+    :param partsfolder: folder of the part files
+    '''
+
+    def __init__(self, partsfolder):
+        self.filename = os.path.join(partsfolder, MANIFEST_FILENAME)
+        self.entries = {}
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[entry['device']] = entry
+        self._file = open(self.filename, 'a')
+
+
+    def is_current(self, name, key, partsfolder):
+        entry = self.entries.get(name)
+        return entry is not None and entry['key'] == key and os.path.isfile(part_filename(partsfolder, name))
+
+
+    def add(self, entry):
+        self.entries[entry['device']] = entry
+        self._file.write(json.dumps(entry)+"\n")
+        self._file.flush()
+
+
+    def close(self):
+        self._file.close()
+
+
+
+class WaferDataset(object):
+    '''
+    Reads the consolidated dataset of a scan folder. Each measurement (pretest, gatetrace) is
+    stored column-wise: the points of all devices one after the other, device i owning the rows
+    offsets[i]:offsets[i+1]. Devices without a measurement own no rows of it.
+
+    Arrays of the file (NumPy .npz):
+        device, chipcol, chiprow, devcol, devrow                device table
+        <measurement>/offsets                                   row ranges of the devices
+        <measurement>/columns                                   data column names
+        <measurement>/<column>                                  one data column
+        <measurement>/procedure, <measurement>/parameters       procedure class, JSON header parameters per device
+
+    :param folder: scan folder (or the dataset file)
+    '''
+
+    def __init__(self, folder):
+        filename = folder if folder.endswith('.npz') else os.path.join(folder, DATASET_FILENAME)
+        self._npz = np.load(filename)
+        self.devices = {field: self._npz[field] for field in WaferSummary.DEVICE_COLUMNS}
+        self._index = {str(name): i for i, name in enumerate(self.devices['device'])}
+
+
+    @property
+    def measurements(self):
+        return [measurement for measurement, _, _ in MEASUREMENTS if measurement+'/offsets' in self._npz]
+
+
+    def columns(self, measurement):
+        return self._npz[measurement+'/columns'].tolist()
+
+
+    def column(self, measurement, column):
+        return self._npz[measurement+'/'+column]
+
+
+    def device(self, name, measurement):
+        '''
+        Returns {column: array} of the measurement of device name (empty arrays if it has none).
+        Raises KeyError for unknown devices.
+        '''
+        i = self._index[name]
+        offsets = self._npz[measurement+'/offsets']
+        start, stop = offsets[i], offsets[i+1]
+        return {column: self.column(measurement, column)[start:stop] for column in self.columns(measurement)}
+
+
+    def parameters(self, name, measurement):
+        return json.loads(str(self._npz[measurement+'/parameters'][self._index[name]]) or '{}')
+
+
+    def close(self):
+        self._npz.close()
+
+
+
+def merge(folder, partsfolder, entries):
+    '''
+    Concatenates the part files of entries (in order) into the dataset file of folder and writes
+    the summary table. Returns the size of the dataset file.
+    '''
+    arrays = {'device': np.array([entry['device'] for entry in entries], dtype=str)}
+    indices = np.array([entry['indices'] for entry in entries], dtype=np.int32).reshape(-1, len(INDEX_PARAMETERS))
+    for j, field in enumerate(WaferSummary.DEVICE_COLUMNS[1:]):
+        arrays[field] = indices[:, j]
+
+    parts = {measurement: [] for measurement, _, _ in MEASUREMENTS}       # (columns, data) per device
+    parameters = {measurement: [] for measurement in parts}
+    for entry in entries:
+        with np.load(part_filename(partsfolder, entry['device'])) as part:
+            for measurement in parts:
+                if measurement+'/data' in part:
+                    parts[measurement].append((part[measurement+'/columns'].tolist(), part[measurement+'/data']))
+                    parameters[measurement].append(str(part[measurement+'/parameters']))
+                else:
+                    parts[measurement].append(([], np.empty((0, 0))))
+                    parameters[measurement].append('')
+
+    for measurement, device_parts in parts.items():
+        columns = []
+        for names, _ in device_parts:
+            columns.extend(name for name in names if name not in columns)
+        if not columns:
+            continue
+        lengths = [len(data) for _, data in device_parts]
+        offsets = np.zeros(len(entries)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        merged = np.full((offsets[-1], len(columns)), np.nan)     # columns a device lacks stay NaN
+        for (names, data), start, stop in zip(device_parts, offsets[:-1], offsets[1:]):
+            for j, name in enumerate(names):
+                merged[start:stop, columns.index(name)] = data[:, j]
+        arrays[measurement+'/offsets'] = offsets
+        arrays[measurement+'/columns'] = np.array(columns, dtype=str)
+        for j, column in enumerate(columns):
+            arrays[measurement+'/'+column] = merged[:, j]
+        arrays[measurement+'/procedure'] = np.array([entry['procedures'].get(measurement) or '' for entry in entries], dtype=str)
+        arrays[measurement+'/parameters'] = np.array(parameters[measurement], dtype=str)
+
+    filename = os.path.join(folder, DATASET_FILENAME)
+    with open(filename+'.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(filename+'.tmp', filename)
+    write_summary(folder, entries)
+    return os.path.getsize(filename)
+
+
+def write_summary(folder, entries):
+    metric_columns = WaferSummary.metric_columns(PRETEST_METRICS+GATESWEEP_METRICS)
+    point_columns = [measurement+' points' for measurement, _, _ in MEASUREMENTS]
+    filename = os.path.join(folder, SUMMARY_FILENAME)
+    with open(filename+'.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(WaferSummary.DEVICE_COLUMNS + point_columns + metric_columns)
+        for entry in entries:
+            writer.writerow([entry['device']] + entry['indices']
+                            + [entry['points'].get(measurement, 0) for measurement, _, _ in MEASUREMENTS]
+                            + [entry['metrics'].get(column, '') for column in metric_columns])
+    os.replace(filename+'.tmp', filename)
+
+
+
+class Consolidation(object):
+    '''
+    Converts one scan folder.
+
+    :param folder: scan folder
+    :param processes: size of the process pool (default: number of CPUs)
+    :param out: stream for progress lines (None: quiet)
+    :param interval: seconds between progress lines
+    '''
+
+    def __init__(self, folder, processes=None, out=sys.stdout, interval=2.0):
+        self.folder = folder
+        self.partsfolder = os.path.join(folder, PARTS_FOLDER)
+        self.processes = processes or os.cpu_count() or 1
+        self.out = out
+        self.interval = interval
+        self.stats = {'devices': 0, 'converted': 0, 'skipped': 0, 'errors': 0, 'files': 0, 'bytes': 0,
+                      'points': 0, 'parse time': 0.0, 'merge time': 0.0, 'dataset bytes': 0}
+
+
+    def progress(self, *fields):
+        if self.out is not None:
+            self.out.write(dt.now().strftime("%H:%M:%S")+"\t"+"\t".join(str(field) for field in fields)+"\n")
+            self.out.flush()
+
+
+    def device_folders(self):
+        return sorted(entry.path for entry in os.scandir(self.folder)
+                      if entry.is_dir() and entry.name.startswith('dev_'))
+
+
+    def _count(self, entry):
+        self.stats['files'] += len(entry['points'])
+        self.stats['bytes'] += entry['bytes']
+        self.stats['points'] += sum(entry['points'].values())
+        self.stats['errors'] += len(entry['errors'])
+        for error in entry['errors']:
+            log.warning("%s: %s", entry['device'], error)
+
+
+    def run(self):
+        '''
+        Converts the devices that are not converted yet, then merges all of them. Returns an exit
+        status. KeyboardInterrupt stops the pool, the devices converted so far are kept.
+        '''
+        folders = self.device_folders()
+        self.stats['devices'] = len(folders)
+        os.makedirs(self.partsfolder, exist_ok=True)
+        manifest = Manifest(self.partsfolder)
+        try:
+            todo = []
+            for devicefolder in folders:
+                name = os.path.basename(devicefolder)[len('dev_'):]
+                if not manifest.is_current(name, source_key(devicefolder), self.partsfolder):
+                    todo.append(devicefolder)
+            self.stats['skipped'] = len(folders)-len(todo)
+            self.progress('scan', self.folder, "%d devices" % len(folders),
+                          "%d converted before" % self.stats['skipped'], "%d processes" % self.processes)
+            start = time.perf_counter()
+            try:
+                self._convert(todo, manifest, start)
+            finally:
+                self.stats['parse time'] = time.perf_counter()-start
+        finally:
+            manifest.close()
+
+        start = time.perf_counter()
+        names = [os.path.basename(devicefolder)[len('dev_'):] for devicefolder in folders]
+        entries = [manifest.entries[name] for name in names]
+        self.stats['dataset bytes'] = merge(self.folder, self.partsfolder, entries)
+        self.stats['merge time'] = time.perf_counter()-start
+        self.progress('merged', DATASET_FILENAME, SUMMARY_FILENAME, "%.2f s" % self.stats['merge time'])
+        return EXIT_FAILED if any(entry['errors'] for entry in entries) else EXIT_OK
+
+
+    def _convert(self, todo, manifest, start):
+        if not todo:
+            return
+        last = time.perf_counter()
+        processes = min(self.processes, len(todo))
+        chunksize = max(1, min(16, len(todo)//(4*processes)))
+        # Pool.__exit__ terminates the workers: part files are replaced atomically and only
+        # entries received here are in the manifest, so an interrupt loses no finished work
+        with multiprocessing.Pool(processes, initializer=ignore_interrupt) as pool:
+            entries = pool.imap_unordered(partial(convert_device, partsfolder=self.partsfolder), todo, chunksize)
+            for done, entry in enumerate(entries, 1):
+                manifest.add(entry)
+                self.stats['converted'] += 1
+                self._count(entry)
+                now = time.perf_counter()
+                if now-last >= self.interval or done == len(todo):
+                    last = now
+                    rate = done/(now-start)
+                    self.progress('converted', "%d/%d" % (done, len(todo)), "%.1f devices/s" % rate,
+                                  "%.1f MB/s" % (self.stats['bytes']/1e6/(now-start)),
+                                  "remaining %.0f s" % ((len(todo)-done)/rate))
+
+
+    def clean(self):
+        shutil.rmtree(self.partsfolder, ignore_errors=True)
+
+
+    def report(self):
+        '''
+        Throughput report of the run.
+        '''
+        stats = self.stats
+        parse_time = max(stats['parse time'], 1e-9)
+        lines = ["%s" % self.folder,
+                 "  devices           %d (%d converted, %d up to date)" % (stats['devices'], stats['converted'], stats['skipped']),
+                 "  files read        %d, %.1f MB, %d points, %d unreadable" % (stats['files'], stats['bytes']/1e6, stats['points'], stats['errors']),
+                 "  parsing           %.2f s, %.1f devices/s, %.1f MB/s, %.0f points/s (%d processes)"
+                 % (stats['parse time'], stats['converted']/parse_time, stats['bytes']/1e6/parse_time,
+                    stats['points']/parse_time, self.processes),
+                 "  merging           %.2f s" % stats['merge time'],
+                 "  dataset           %.1f MB" % (stats['dataset bytes']/1e6)]
+        return "\n".join(lines)
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consolidate the data files of wafer scans into one dataset per scan.")
+    parser.add_argument('folders', nargs='+', metavar='SCANFOLDER', help="scan folder with dev_* device folders")
+    parser.add_argument('--processes', type=int, help="number of parser processes (default: number of CPUs)")
+    parser.add_argument('--progress', metavar='FILE', help="write progress to FILE instead of stdout")
+    parser.add_argument('--restart', action='store_true', help="convert all devices again instead of continuing")
+    parser.add_argument('--clean', action='store_true', help="remove the converted parts after merging "
+                                                              "(the next run parses all devices again)")
+    parser.add_argument('--debug', action='store_true', help="log debug messages")
+    args = parser.parse_args(argv)
+
+    from logs import start_logging
+    logs = start_logging(logging.DEBUG if args.debug else logging.INFO)     # to stderr, progress goes to stdout
+    out = open(args.progress, 'a') if args.progress else sys.stdout
+    status = EXIT_OK
+    try:
+        for folder in args.folders:
+            consolidation = Consolidation(folder, args.processes, out)
+            if not os.path.isdir(folder) or not consolidation.device_folders():
+                sys.stderr.write("No device folders found in %s\n" % folder)
+                status = max(status, EXIT_FOLDER)
+                continue
+            if args.restart:
+                consolidation.clean()
+            status = max(status, consolidation.run())
+            if args.clean:
+                consolidation.clean()
+            sys.stdout.write(consolidation.report()+"\n")
+        return status
+    except KeyboardInterrupt:
+        return EXIT_ABORTED
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        logs.stop()
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
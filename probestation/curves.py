@@ -0,0 +1,320 @@
+# plot curves for the probestation GUI
+# extends the pymeasure ResultsCurve with an in-memory data buffer, so running measurements are
+# plotted from the points the Worker emits instead of re-reading the data file on every refresh:
+# the curve of a running measurement attaches to the shared memory buffer of its Worker
+# (sharedbuffer.SharedColumns, also across the engine process), other curves read their data file
+# once into a ColumnBuffer
+
+import threading
+
+import numpy as np
+
+from pymeasure.display.curves import ResultsCurve
+
+from sharedbuffer import SharedColumns
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class ColumnBuffer(object):
+    '''
+    Growable, preallocated NumPy storage for the data columns of one measurement. Rows are appended
+    one at a time (Worker thread), columns are read as array views (GUI thread). Capacity doubles
+    whenever it is exhausted, so appending is amortised O(1).
+
+    :param columns: names of the data columns (DATA_COLUMNS of the procedure)
+    :param capacity: number of rows to preallocate
+    '''
+
+    def __init__(self, columns, capacity=1024):
+        self.columns = list(columns)
+        self._index = {column: i for i, column in enumerate(self.columns)}
+        self._data = np.full((len(self.columns), max(int(capacity), 1)), np.nan)
+        self.length = 0
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return self.length
+
+
+    def _grow(self, capacity):
+        data = np.full((len(self.columns), capacity), np.nan)
+        data[:, :self.length] = self._data[:, :self.length]
+        self._data = data
+
+
+    def append(self, record):
+        '''
+        Appends one data point given as dictionary {column: value}. Unknown keys are ignored,
+        missing columns are stored as NaN.
+        '''
+        with self.lock:
+            if self.length == self._data.shape[1]:
+                self._grow(2*self._data.shape[1])
+            n = self.length
+            for column, value in record.items():
+                i = self._index.get(column)
+                if i is not None:
+                    try:
+                        self._data[i, n] = value
+                    except (TypeError, ValueError):
+                        pass
+            self.length = n + 1
+
+
+    def load(self, data):
+        '''
+        Replaces the content of the buffer with the columns of a DataFrame (e.g. Results.data).
+        '''
+        with self.lock:
+            length = len(data)
+            if length > self._data.shape[1]:
+                self._data = np.full((len(self.columns), length), np.nan)
+            else:
+                self._data[:] = np.nan
+            for column, i in self._index.items():
+                if column in data:
+                    self._data[i, :length] = np.asarray(data[column], dtype=float)
+            self.length = length
+
+
+    def clear(self):
+        with self.lock:
+            self._data[:] = np.nan
+            self.length = 0
+
+
+    def release(self):
+        '''
+        Frees the storage of the buffer. The buffer stays usable and grows again on append/load.
+        '''
+        with self.lock:
+            self._data = np.full((len(self.columns), 1), np.nan)
+            self.length = 0
+
+
+    def column(self, name):
+        '''
+        Returns a view on the filled part of a column. The view stays valid when the buffer grows.
+        '''
+        with self.lock:
+            return self._data[self._index[name], :self.length]
+
+
+    def nbytes(self):
+        return self._data.nbytes
+
+
+
+class MinMaxPyramid(object):
+    '''
+    Cached min/max decimation of one x/y curve. Level l keeps, for every bucket of 2**l consecutive
+    samples, the samples with the smallest and the largest y value (in sample order), so peaks
+    survive decimation. Levels are built once, each from the previous one in O(n/2**l).
+
+    :param x: x values of the curve
+    :param y: y values of the curve
+    :param min_points: coarsest level that is still built
+    '''
+
+    def __init__(self, x, y, min_points=256):
+        self.x = x
+        self.y = y
+        self.levels = [np.arange(len(y))]       # level 0: all samples
+        mins = maxs = np.arange(len(y))
+        y_low = np.where(np.isnan(y), np.inf, y)        # NaN never wins a bucket
+        y_high = np.where(np.isnan(y), -np.inf, y)
+        while len(mins) > min_points:
+            if len(mins) % 2:
+                mins = np.append(mins, mins[-1])
+                maxs = np.append(maxs, maxs[-1])
+            mins = mins.reshape(-1, 2)
+            maxs = maxs.reshape(-1, 2)
+            rows = np.arange(len(mins))
+            mins = mins[rows, np.argmin(y_low[mins], axis=1)]
+            maxs = maxs[rows, np.argmax(y_high[maxs], axis=1)]
+            self.levels.append(np.sort(np.stack((mins, maxs), axis=1), axis=1).ravel())
+
+
+    def select(self, x_range, max_points):
+        '''
+        Returns the sample indices to draw for the visible x_range (None: everything) with at most
+        about max_points points. Picks the finest level that fits into the budget for the visible
+        part of the curve and clips it to the view (keeping one point beyond each edge).
+        '''
+        coarsest = self.levels[-1]
+        if x_range is None or len(coarsest) == 0:
+            fraction = 1.
+        else:
+            visible = (self.x[coarsest] >= x_range[0]) & (self.x[coarsest] <= x_range[1])
+            fraction = max(np.count_nonzero(visible)/len(coarsest), 1./len(coarsest))
+        for indices in self.levels:
+            if len(indices)*fraction <= max_points:
+                break
+        if x_range is None or fraction >= 1.:
+            return indices
+        visible = (self.x[indices] >= x_range[0]) & (self.x[indices] <= x_range[1])
+        # keep neighbours of visible points so lines continue to the edge of the view
+        visible[:-1] |= visible[1:]
+        visible[1:] |= visible[:-1].copy()
+        return indices[visible]
+
+
+
+class BufferedResultsCurve(ResultsCurve):
+    '''
+    ResultsCurve that plots from a buffer: the shared buffer of the Worker while the measurement
+    runs (attach()), a ColumnBuffer filled from the data file once otherwise. update() (called by
+    the PlotFrame timer) redraws only if new points arrived or the plotted columns (x/y, see
+    PlotFrame.change_x_axis/change_y_axis) changed.
+
+    Curves longer than the point budget given with set_view() are drawn decimated from a cached
+    MinMaxPyramid, clipped to the visible x range. resize_listeners (callables that receive the
+    curve) are called whenever the in-memory size of the curve data (nbytes()) changes.
+    '''
+
+    def __init__(self, results, x, y, **kwargs):
+        super().__init__(results, x, y, **kwargs)
+        self.buffer = ColumnBuffer(results.procedure.DATA_COLUMNS)
+        self._dirty = False
+        self._loaded = False
+        self._drawn_axes = None
+        self._drawn_length = 0
+        self._pyramid = None
+        self._pyramid_key = None
+        self.max_points = None          # None: no decimation
+        self.x_range = None
+        self.resize_listeners = []
+
+
+    def set_view(self, x_range, max_points):
+        '''
+        Sets visible x range and point budget. Only marks the curve for redrawing if that changes
+        what is drawn, i.e. if the curve is (or would be) decimated.
+        '''
+        if max_points == self.max_points and (x_range == self.x_range or self.max_points is None):
+            return
+        if len(self.buffer) > min(max_points or np.inf, self.max_points or np.inf):
+            self._dirty = True
+        self.max_points = max_points
+        self.x_range = x_range
+
+
+    def attach(self, name):
+        '''
+        Plots from the shared buffer name of a running Worker (Worker.buffer.name). If the buffer
+        is gone already (measurement finished a while ago), the curve is read from its data file
+        on the next update instead.
+        '''
+        self._detach()
+        try:
+            self.buffer = SharedColumns.attach(name)
+        except FileNotFoundError:
+            log.info("Shared buffer %s is gone, plotting from the data file", name)
+            self.buffer = ColumnBuffer(self.results.procedure.DATA_COLUMNS)
+            self._loaded = False
+        else:
+            self._loaded = True
+        self._dirty = True
+        self._resized()
+
+
+    def is_shared(self):
+        return isinstance(self.buffer, SharedColumns)
+
+
+    def _detach(self):
+        if self.is_shared():
+            self.buffer.close()
+            self.buffer = ColumnBuffer(self.results.procedure.DATA_COLUMNS)
+            self._resized()
+
+
+    def reload(self):
+        '''
+        Fills the buffer from the data file of the results. The DataFrame of the results is dropped
+        again afterwards, the buffer is the only in-memory copy of the data.
+        '''
+        self.results.reload()
+        self.load(self.results.data)
+        self.results._data = None
+
+
+    def load(self, data):
+        '''
+        Plots the columns of a DataFrame read elsewhere (e.g. a cached preview, see resultscache.py).
+        '''
+        self._detach()
+        self.buffer.load(data)
+        self._loaded = True
+        self._dirty = True
+        self._resized()
+
+
+    def evict(self):
+        '''
+        Frees the in-memory data of the curve (see ExperimentMemory). The data is read from the data
+        file again the next time the curve is updated.
+        '''
+        if self.is_shared():
+            self._detach()
+        else:
+            self.buffer.release()
+        self._pyramid = None
+        self._pyramid_key = None
+        self._loaded = False
+        self._drawn_axes = None
+        self.clear()
+        self._resized()
+
+
+    def is_resident(self):
+        return self._loaded and len(self.buffer) > 0
+
+
+    def nbytes(self):
+        return self.buffer.nbytes()
+
+
+    def _resized(self):
+        for listener in self.resize_listeners:
+            listener(self)
+
+
+    def _decimated(self, x, y):
+        key = (self.x, self.y, len(y))
+        if self._pyramid_key != key:
+            self._pyramid = MinMaxPyramid(x, y, min_points=min(256, self.max_points))
+            self._pyramid_key = key
+        indices = self._pyramid.select(self.x_range, self.max_points)
+        return x[indices], y[indices]
+
+
+    def update(self):
+        '''
+        Redraws the curve if needed. Returns the number of points drawn (0 if nothing changed).
+        '''
+        if self.is_shared() and self.buffer.is_stale():
+            self._loaded = False
+        if not self._loaded:
+            self.reload()
+        axes = (self.x, self.y)
+        length = len(self.buffer)
+        if not self._dirty and axes == self._drawn_axes and length == self._drawn_length:
+            return 0
+        self._dirty = False
+        self._drawn_axes = axes
+        self._drawn_length = length
+        try:
+            x = self.buffer.column(self.x)
+            y = self.buffer.column(self.y)
+        except KeyError:
+            log.debug("Curve has no column %s or %s", self.x, self.y)
+            return 0
+        if self.max_points is not None and len(y) > self.max_points:
+            x, y = self._decimated(x, y)
+        self.setData(x, y)
+        return len(y)
@@ -0,0 +1,216 @@
+# acquisition engine in a separate process
+# the GUI hands a scan (recipe + journal folder) to a child process that owns the stages and
+# instruments and runs the asyncio scan core (orchestrator.AsyncScan). The child only
+# talks to the GUI through a multiprocessing queue, so plotting, browsing and garbage collection
+# in the GUI process can no longer delay stage moves or measurement timing, and a crash of the GUI
+# leaves the scan journal consistent.
+# ScanThread runs the same scan inside the GUI process; both report to the window with the same
+# Qt signals (ScanEvents). Data points do not go through the queue: the plots attach to the shared
+# memory buffers of the measurements (sharedbuffer.py).
+
+import asyncio
+import threading
+import multiprocessing as mp
+from queue import Empty
+
+from PyQt5 import QtCore
+
+from progress import ProgressChannel, FRAME_INTERVAL
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def run_engine(recipe, folder, messages, abort_event):
+    '''
+    Entry point of the engine process. Continues the scan in folder (the journal has been written
+    by the GUI: 'plan' for a new scan, 'resumed' for a resumed one) and puts the events of the
+    scan on messages as tuples (topic, args). The last message is always ('finished', (exit code,)).
+    '''
+    from headless import HeadlessStation, connect_instruments, open_stages, EXIT_ABORTED
+    from orchestrator import AsyncScan
+    from journal import ScanJournal
+    from logs import start_logging
+
+    def listener(topic, *args):
+        messages.put((topic, args))
+
+    logs = start_logging()
+    code = EXIT_ABORTED
+    stages = None
+    try:
+        journal = ScanJournal.load(folder)
+        stages = open_stages(recipe.get('no_stages', False))
+        station = HeadlessStation(*connect_instruments(recipe['instruments']))
+        scan = AsyncScan(recipe, journal, station, stages, out=None, listener=listener)
+
+        # abort requests of the GUI arrive on a process wide event
+        def watch_abort():
+            abort_event.wait()
+            scan.abort()
+        threading.Thread(target=watch_abort, daemon=True).start()
+
+        code = asyncio.run(scan.run())
+    except Exception as e:
+        log.error("Engine failed", exc_info=True)
+        messages.put(('log', ("engine failed: "+repr(e),)))
+    finally:
+        if stages is not None and hasattr(stages, 'close'):
+            stages.close()
+        messages.put(('finished', (code,)))
+        logs.stop()
+
+
+
+class EngineProcess(object):
+    '''
+    Handle of one scan running in the engine process.
+
+    :param recipe: scan recipe (see headless.py) with the plan, the registration, the procedure
+                   class names and the instrument addresses
+    :param folder: scan folder with the journal of the scan
+    '''
+
+    def __init__(self, recipe, folder):
+        context = mp.get_context('spawn')       # no fork of the Qt application
+        self.folder = folder
+        self.messages = context.Queue()
+        self.abort_event = context.Event()
+        self.process = context.Process(target=run_engine, name='ENGINE',
+                                       args=(recipe, folder, self.messages, self.abort_event))
+
+
+    def start(self):
+        self.process.start()
+
+
+    def abort(self):
+        self.abort_event.set()
+
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+
+
+
+class ScanEvents(QtCore.QThread):
+    '''
+    Qt signals of a running scan, emitted in the GUI thread for the events of a scan listener
+    (see HeadlessScan.notify). Progress and status go through a ProgressChannel and are emitted
+    once per frame (latest progress per data file, every terminal status), all other events as
+    they arrive.
+    '''
+    procedure = QtCore.pyqtSignal(object)           # {'datafile': ..., 'parameters': ..., 'buffer': ...}
+    progress = QtCore.pyqtSignal(str, float)        # data file, progress in %
+    status = QtCore.pyqtSignal(str, int)            # data file, procedure status
+    device = QtCore.pyqtSignal(object, object)      # ScanPlan.device_info, figures of merit
+    log = QtCore.pyqtSignal(str)
+    finished_scan = QtCore.pyqtSignal(int)          # exit code (see headless.py)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.channel = ProgressChannel()
+        self.frame_timer = QtCore.QTimer()
+        self.frame_timer.timeout.connect(self.deliver)
+        self.frame_timer.start(int(FRAME_INTERVAL*1000))
+        # connected first: pending statuses reach the window before the end of the scan
+        self.finished_scan.connect(self._stop_delivery)
+
+
+    def dispatch(self, topic, args):
+        if topic == 'progress':
+            self.channel.progress(*args)
+        elif topic == 'status':
+            self.channel.status(*args)
+        else:
+            signal = getattr(self, topic, None)
+            if isinstance(signal, QtCore.pyqtBoundSignal):
+                signal.emit(*args)
+
+
+    def deliver(self):
+        progress, status = self.channel.take()
+        for datafile, value in progress.items():
+            self.progress.emit(datafile, value)
+        for datafile, value in status:
+            self.status.emit(datafile, value)
+
+
+    def _stop_delivery(self, code):
+        self.frame_timer.stop()
+        self.deliver()
+
+
+
+class ScanThread(ScanEvents):
+    '''
+    Thin bridge between the window and the asyncio scan core: runs an AsyncScan in an event loop
+    of its own thread and passes its events on as Qt signals.
+
+    :param scan: AsyncScan, its listener is replaced
+    '''
+
+    def __init__(self, scan, parent=None):
+        super().__init__(parent)
+        self.scan = scan
+        scan.listener = lambda topic, *args: self.dispatch(topic, args)
+
+
+    def run(self):
+        from headless import EXIT_ABORTED
+        try:
+            code = asyncio.run(self.scan.run())
+        except Exception:
+            log.error("Scan failed", exc_info=True)
+            code = EXIT_ABORTED
+        self.finished_scan.emit(code)
+
+
+    def abort(self):
+        self.scan.abort()
+
+
+    def abort_current(self):
+        self.scan.abort_current()
+
+
+    def join(self, timeout=None):
+        if timeout is None:
+            self.wait()
+        else:
+            self.wait(int(timeout*1000))
+
+
+
+class EngineMonitor(ScanEvents):
+    '''
+    Reads the messages of an EngineProcess in the GUI process and re-emits them as Qt signals.
+    Stops after the 'finished' message, or if the engine process died without sending it.
+    '''
+
+    def __init__(self, engine, parent=None):
+        super().__init__(parent)
+        self.engine = engine
+
+
+    def run(self):
+        from headless import EXIT_ABORTED
+        while True:
+            try:
+                topic, args = self.engine.messages.get(timeout=0.2)
+            except Empty:
+                if not self.engine.is_alive():
+                    log.error("Engine process ended unexpectedly")
+                    self.finished_scan.emit(EXIT_ABORTED)
+                    return
+                continue
+            if topic == 'finished':
+                self.engine.join(timeout=10)
+                self.finished_scan.emit(*args)
+                return
+            self.dispatch(topic, args)
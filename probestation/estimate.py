@@ -0,0 +1,314 @@
+# scan duration estimate (dry run)
+# predicts the duration of every phase of a scan from the scan parameters, without moving the stages
+# or touching the instruments: stage moves from the distances between the devices and the ximc move
+# settings (speed, acceleration, deceleration), measurements from the point counts of the voltage
+# lists of the procedures, the delays, NPLC and the ramp limits of the source meters
+# LiveEstimate corrects the prediction with the measured device times while the scan runs
+# no Qt imports in here, used by the GUI, the headless runner and the orchestrator
+
+import math
+import time
+
+import numpy as np
+
+from measurements import bias_voltages, gate_voltages
+from quality import plan_quality, current_range
+from headless import BIAS_RAMP, GATE_RAMP
+from orchestrator import MOVE_STARTUP, POLL_INTERVAL, SETTLE_TIME
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+LINE_FREQUENCY = 50.        # Hz, integration time of a reading is NPLC/LINE_FREQUENCY
+BUS_LATENCY = 2e-3          # s, one command or query to a source meter
+SOURCE_SETTLE = 1.          # s, sleep of the procedures after enabling/disabling a source
+MICROSTEPS = 256            # microsteps per step (see StageStack.coordinates_cleanup)
+
+# move settings used if the controllers can not be read (stages not connected), steps/s and steps/s^2
+DEFAULT_MOVE_SETTINGS = {'x': (2000, 1000, 1000), 'y': (2000, 1000, 1000), 'z': (4500, 1000, 1000)}
+
+MOVE_PHASES = ('Z lift', 'XY move', 'Z descent', 'settle')
+
+
+def move_time(distance, speed, accel, decel):
+    '''
+    Duration of a move over distance (steps) with a trapezoidal speed profile. Short moves that do
+    not reach the speed have a triangular profile.
+    '''
+    distance = abs(distance)
+    if distance == 0:
+        return 0.
+    ramps = speed**2/(2.*accel) + speed**2/(2.*decel)
+    if distance >= ramps:
+        return speed/accel + speed/decel + (distance-ramps)/speed
+    top = math.sqrt(2.*distance*accel*decel/(accel+decel))
+    return top/accel + top/decel
+
+
+def ramp_time(voltages, rate, start=0.):
+    # duration of ramp_to_voltage() through voltages (V) with a ramp limit rate (V/s)
+    return np.abs(np.diff(np.concatenate(([start], voltages)))).sum()/rate
+
+
+def _reading(nplc):
+    # one current reading of a source meter
+    return nplc/LINE_FREQUENCY + BUS_LATENCY
+
+
+# duration models of the procedures in measurements.py, keyed by class name
+# pretests return the durations of setup, points and the shutdown of a passed and of a failed
+# device, sweeps of setup, points and shutdown, in seconds for the parameters of one device
+# (procedure parameters), and the number of data points
+
+def _pretest_iv(p):
+    voltages = bias_voltages(p['V_bias'], p['V_bias_steps'])
+    rate = BIAS_RAMP['max_units_per_second']
+    points = ramp_time(voltages, rate) + len(voltages)*(p['delay'] + _reading(p['NPLC_pretest']) + BUS_LATENCY)
+    failed = abs(voltages[-1])/rate + SOURCE_SETTLE + 2*BUS_LATENCY if len(voltages) else 0.
+    return {'setup': SOURCE_SETTLE + 3*BUS_LATENCY, 'points': points, 'passed': 0., 'failed': failed}, len(voltages)
+
+
+def _random_fake_pretest(p):
+    voltages = bias_voltages(p['V_bias'], p['V_bias_steps'], endpoint=False)
+    return {'setup': 0., 'points': len(voltages)*p['delay'], 'passed': 0., 'failed': 0.}, len(voltages)
+
+
+def _gatesweep(p):
+    voltages = gate_voltages(p['V_g_min'], p['V_g_max'], p['V_g_steps'])
+    bias = abs(p['V_bias']*1e-3)/BIAS_RAMP['max_units_per_second']
+    if p.get('I_noise_target', 0) > 0:          # settings of Gatesweep.plan_measurement
+        reading = plan_quality(current_range(p['I_bias_limit']*1e-6*1.05), p['I_noise_target']*1e-12,
+                               p.get('point_time_budget', 0.2), len(voltages)).point_time + BUS_LATENCY
+    else:
+        reading = _reading(p['NPLC_gatesweep'])
+    points = bias + ramp_time(voltages, GATE_RAMP['max_units_per_second']) \
+             + len(voltages)*(p['delay'] + reading + BUS_LATENCY)
+    return {'setup': SOURCE_SETTLE + 4*BUS_LATENCY, 'points': points, 'shutdown': bias + 6*BUS_LATENCY}, len(voltages)
+
+
+def _test_procedure(p):
+    voltages = gate_voltages(p['V_g_min'], p['V_g_max'], p['V_g_steps'])
+    return {'setup': 0., 'points': len(voltages)*p['delay'], 'shutdown': 0.}, len(voltages)
+
+
+PROCEDURE_MODELS = {
+    'PreTestIV': _pretest_iv,
+    'RandomFakePreTest': _random_fake_pretest,
+    'Gatesweep': _gatesweep,
+    'TestProcedure': _test_procedure,
+}
+
+
+def _position(coords):
+    # stage coordinates [[steps, microsteps], ...] to positions in steps
+    return np.array([c[0] + c[1]/float(MICROSTEPS) for c in coords])
+
+
+def _wait(duration):
+    # AsyncStages._wait_stopped: polls only after MOVE_STARTUP
+    return max(duration, MOVE_STARTUP) + POLL_INTERVAL/2
+
+
+def _move_phases(start, end, safe_height, settings):
+    # Z lift, XY move, Z descent, settle of a move along the path of AsyncStages._move
+    lift = _wait(move_time(safe_height-start[2], *settings['z']))
+    travel = _wait(max(move_time(end[0]-start[0], *settings['x']), move_time(end[1]-start[1], *settings['y'])))
+    descent = _wait(move_time(end[2]-safe_height, *settings['z']))
+    return (lift, travel, descent, SETTLE_TIME)
+
+
+
+class ScanEstimate(object):
+    '''
+    Predicted duration of a scan. Stage moves are predicted per device, procedure times per device
+    and pretest outcome; totals are given for a fraction of devices that pass the pretest (the
+    measurement only runs on those), 1 by default, which is the upper bound.
+
+    :param devices: names of the devices in scan order
+    :param moves: array (devices+1, 4) of the move phases (MOVE_PHASES) to each device, the last
+                  row is the move back to the center
+    :param pretest: duration model result of the pretest
+    :param sweep: duration model result of the measurement
+    :param points: number of data points of pretest and measurement of one device
+    :param out_of_bounds: names of devices with stage coordinates out of bounds, the scan skips them
+    '''
+
+    def __init__(self, devices, moves, pretest, sweep, points=(0, 0), out_of_bounds=()):
+        self.devices = list(devices)
+        self.moves = moves
+        self.pretest = pretest
+        self.sweep = sweep
+        self.points = points
+        self.out_of_bounds = list(out_of_bounds)
+        skipped = set(self.out_of_bounds)
+        self.measured = np.array([name not in skipped for name in self.devices], dtype=bool)
+        # suffix sums of the device times if all / none of the devices pass the pretest, the time
+        # of devices start.. for any pass rate is a mix of the two (remaining_time())
+        n = len(self.devices)
+        base = self.moves[:n].sum(axis=1) + pretest['setup'] + pretest['points']
+        passing = np.where(self.measured, base + pretest['passed'] + sum(sweep.values()), 0.)
+        failing = np.where(self.measured, base + pretest['failed'], 0.)
+        self._passing = np.append(np.cumsum(passing[::-1])[::-1], 0.)
+        self._failing = np.append(np.cumsum(failing[::-1])[::-1], 0.)
+
+
+    def device_time(self, index, passed=1.):
+        '''
+        Predicted duration of device index (scan order), passed: probability the device passes the pretest.
+        '''
+        if not self.measured[index]:
+            return 0.
+        pretest = self.pretest['setup'] + self.pretest['points']
+        sweep = sum(self.sweep.values())
+        return self.moves[index].sum() + pretest + passed*(self.pretest['passed'] + sweep) + (1.-passed)*self.pretest['failed']
+
+
+    def remaining_time(self, start, passed=1.):
+        '''
+        Predicted duration of the devices from index start (scan order) to the end, without the
+        move back to the center; passed: probability a device passes the pretest.
+        '''
+        start = min(start, len(self.devices))
+        return passed*self._passing[start] + (1.-passed)*self._failing[start]
+
+
+    def phases(self, passed=1.):
+        '''
+        Returns the predicted total duration of each phase as rows (category, phase, seconds), the
+        phase names are the span names of the timing trace (tracing.py).
+        '''
+        n = int(self.measured.sum())
+        moves = self.moves.sum(axis=0)
+        rows = [('stages', name, moves[i]) for i, name in enumerate(MOVE_PHASES)]
+        rows.extend([
+            ('procedure', 'pretest setup', n*self.pretest['setup']),
+            ('procedure', 'pretest points', n*self.pretest['points']),
+            ('procedure', 'pretest shutdown', n*(passed*self.pretest['passed'] + (1.-passed)*self.pretest['failed'])),
+            ('procedure', 'sweep setup', n*passed*self.sweep['setup']),
+            ('procedure', 'sweep points', n*passed*self.sweep['points']),
+            ('procedure', 'sweep shutdown', n*passed*self.sweep['shutdown']),
+        ])
+        return rows
+
+
+    def total(self, passed=1.):
+        return sum(seconds for cat, name, seconds in self.phases(passed))
+
+
+    def format(self):
+        lines = [
+            "%d devices, %d pretest and %d measurement points per device" % ((int(self.measured.sum()),)+tuple(self.points)),
+            "estimated duration %s (all devices pass the pretest), %s (none pass)"
+            % (format_duration(self.total(1.)), format_duration(self.total(0.))),
+            "",
+            "%-12s %-20s %12s %10s" % ('category', 'phase', 'total', 'per device'),
+        ]
+        n = max(int(self.measured.sum()), 1)
+        for cat, name, seconds in self.phases():
+            lines.append("%-12s %-20s %12s %10.2f" % (cat, name, format_duration(seconds), seconds/n))
+        lines.append("")
+        if self.out_of_bounds:
+            lines.append("BOUNDS CHECK FAILED: %d devices out of bounds (%s)"
+                         % (len(self.out_of_bounds), ", ".join(self.out_of_bounds[:10])+(", ..." if len(self.out_of_bounds) > 10 else "")))
+        else:
+            lines.append("bounds check ok: all devices within stage limits")
+        return "\n".join(lines)
+
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds//3600, seconds//60 % 60, seconds % 60)
+
+
+
+def estimate_scan(plan, stages, pretest, procedure):
+    '''
+    Dry run of a scan: predicts the duration of all phases for the pending devices of plan.
+
+    :param plan: ScanPlan with the stage coordinates of the devices (ScanPlan.locate)
+    :param stages: StageStack (or NoStages), for the move settings, safe height and center
+    :param pretest: class name of the pretest procedure (see PROCEDURE_MODELS)
+    :param procedure: class name of the measurement procedure
+    '''
+    try:
+        pretest_model, sweep_model = PROCEDURE_MODELS[pretest], PROCEDURE_MODELS[procedure]
+    except KeyError as e:
+        raise ValueError("No duration model for procedure "+str(e))
+    settings = getattr(stages, 'move_settings', lambda: None)() or DEFAULT_MOVE_SETTINGS
+    safe_height = stages._automovement_safe_height
+
+    pending = plan.pending()
+    devices = plan.devices[pending]
+    center = _position(stages._coordinates_center)
+    moves = np.zeros((len(pending)+1, len(MOVE_PHASES)))
+    position = center
+    for row, device in enumerate(devices):
+        if not device['in_bounds']:             # skipped by the scan
+            continue
+        target = _position(device['coords'])
+        moves[row] = _move_phases(position, target, safe_height, settings)
+        position = target
+    moves[-1] = _move_phases(position, center, safe_height, settings)
+
+    if not len(pending):
+        return ScanEstimate([], moves, {'setup': 0., 'points': 0., 'passed': 0., 'failed': 0.},
+                            {'setup': 0., 'points': 0., 'shutdown': 0.})
+    parameters = plan.procedure_parameters(pending[0])
+    pretest, pretest_points = pretest_model(parameters)
+    sweep, sweep_points = sweep_model(parameters)
+    return ScanEstimate(devices['name'].tolist(), moves, pretest, sweep, (pretest_points, sweep_points),
+                        devices['name'][~devices['in_bounds']].tolist())
+
+
+
+class LiveEstimate(object):
+    '''
+    Remaining time of a running scan: the prediction of the remaining devices (ScanEstimate),
+    scaled by the ratio of measured to predicted time of the devices done so far, with the pass
+    rate of the pretest measured so far.
+
+    Usage:
+        eta = LiveEstimate(estimate)
+        eta.device_done(seconds, passed)        # after each device
+        eta.remaining()
+    '''
+
+    def __init__(self, estimate):
+        self.estimate = estimate
+        self.done = 0
+        self.passed = 0
+        self.measured = 0.
+        self.predicted = 0.
+
+
+    def device_done(self, seconds, passed):
+        if self.done < len(self.estimate.devices):
+            self.predicted += self.estimate.device_time(self.done, float(passed))
+        self.done += 1
+        self.passed += bool(passed)
+        self.measured += seconds
+
+
+    def pass_rate(self):
+        return float(self.passed)/self.done if self.done else 1.
+
+
+    def remaining(self):
+        '''
+        Returns the predicted remaining time of the scan in seconds.
+        '''
+        estimate = self.estimate
+        passed = self.pass_rate()
+        remaining = estimate.remaining_time(self.done, passed) + estimate.moves[-1].sum()
+        if self.predicted > 0:
+            remaining *= self.measured/self.predicted
+        return remaining
+
+
+    def format(self):
+        remaining = self.remaining()
+        finish = time.strftime("%H:%M", time.localtime(time.time()+remaining))
+        return "ETA "+format_duration(remaining)+" (done ~"+finish+")"
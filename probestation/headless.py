@@ -0,0 +1,350 @@
+"""
+Headless scan runner for the automated probestation.
+Runs a complete wafer scan from a recipe file without any Qt widgets, e.g. for unattended overnight
+batches or benchmarks. Progress is streamed line by line to stdout (or a file), the exit status
+reports the outcome of the scan.
+
+Run the program by changing to the directory containing this file and calling:
+python headless.py recipe.json [--resume SCANFOLDER] [--progress FILE] [--no-stages] [--trace] [--dry-run] [--debug]
+
+Recipe (JSON):
+{
+    "parameters": {"wafername": ..., "savepath": ..., "chipcols": ..., ...},   procedure parameters
+                                            optional "layout": layout file (see layout.py) and
+                                            "layout_select": {"chip": ..., "type": ..., "tag": ...}
+                                            scan the layout devices instead of the grid
+    "registration": {"dev_00": [[x, ux], [y, uy], [z, uz]], "dev_i0": ..., "dev_0j": ...},
+    "pretest": "RandomFakePreTest",         procedure classes from measurements.py
+    "procedure": "TestProcedure",
+    "instruments": {"bias": "USB0::...", "gate": {"model": "2450", "serial": "..."}},
+                                            optional, VISA address or model/serial (see instruments.py)
+    "channels": [{"name": "A", "bias": "USB0::...", "offset": [0, 0]}, ...],
+                                            optional, several devices per landing (see channels.py)
+    "timeout": 3600,                        optional, seconds per procedure
+    "trace": false                          optional, record timing spans (see --trace)
+}
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from datetime import datetime as dt
+
+from layout import LayoutError
+from channels import ChannelError, check_channels
+from instruments import REGISTRY, InstrumentError
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+EXIT_OK = 0             # all devices processed
+EXIT_FAILED = 1         # scan finished, but at least one procedure failed or timed out
+EXIT_ABORTED = 2        # scan interrupted (Ctrl+C), can be continued with --resume
+EXIT_RECIPE = 3         # recipe could not be loaded or is incomplete, --dry-run: devices out of stage bounds
+
+RECIPE_KEYS = ('parameters', 'registration')
+
+# ramp limits of ramp_to_voltage() of the source meters
+BIAS_RAMP = {'max_stepsize': 10e-3, 'max_units_per_second': 100e-3}
+GATE_RAMP = {'max_stepsize': 1e-3, 'max_units_per_second': 20e-3}
+
+
+class RecipeError(Exception):
+    pass
+
+
+
+class HeadlessStation(object):
+    '''
+    Takes the place of the MainWindow as 'parent_window' of the procedures: provides the
+    instruments and the pretest result flag, but no GUI.
+    '''
+    def __init__(self, sourcemeter=None, gate=None):
+        self.sourcemeter = sourcemeter
+        self.gate = gate
+        self.current_device_passed_pretest = threading.Event()
+
+
+
+def load_recipe(filename):
+    try:
+        with open(filename, 'r') as f:
+            recipe = json.load(f)
+    except (OSError, ValueError) as e:
+        raise RecipeError("Could not read recipe "+filename+": "+str(e))
+    for key in RECIPE_KEYS:
+        if key not in recipe:
+            raise RecipeError("Recipe "+filename+" has no '"+key+"'")
+    layout = recipe['parameters'].get('layout')
+    if layout and not os.path.isfile(layout):
+        raise RecipeError("Layout "+layout+" of recipe "+filename+" not found")
+    try:
+        check_channels(recipe.get('channels', []))
+    except ChannelError as e:
+        raise RecipeError("Recipe "+filename+": "+str(e))
+    recipe.setdefault('pretest', 'RandomFakePreTest')
+    recipe.setdefault('procedure', 'TestProcedure')
+    recipe.setdefault('instruments', {})
+    recipe.setdefault('channels', [])
+    recipe.setdefault('timeout', 3600)
+    recipe.setdefault('trace', False)
+    return recipe
+
+
+
+def connect_instruments(instruments):
+    '''
+    Opens the instruments given in the recipe, by VISA address or by model and serial number (see
+    instruments.py). Only imported if the recipe names any, so recipes with simulated procedures
+    start without touching VISA. Bias and gate on the same instrument share one session.
+    '''
+    sourcemeter, gate = None, None
+    if instruments:
+        from pymeasure.instruments.keithley import Keithley2450
+        if 'bias' in instruments:
+            sourcemeter = REGISTRY.instrument(instruments['bias'], Keithley2450, **BIAS_RAMP)
+        if 'gate' in instruments:
+            gate = REGISTRY.instrument(instruments['gate'], Keithley2450, **GATE_RAMP)
+        if sourcemeter is not None and gate is not None and sourcemeter.adapter is gate.adapter:
+            log.warning("Bias and gate are the same instrument")
+    return sourcemeter, gate
+
+
+
+class NoStages(object):
+    '''
+    Replacement for StageStack if a scan is run without motorised stages (--no-stages).
+    '''
+    def restore_registration(self, registration):
+        pass
+
+    def calc_coordinates_delta_hor(self, chipcols, devcols):
+        pass
+
+    def calc_coordinates_delta_vert(self, chiprows, devrows):
+        pass
+
+    def calc_dev_coordinates(self, chipcol, chiprow, devcol, devrow):
+        return [[0, 0], [0, 0], [0, 0]]
+
+    def goto_coords(self, coords):
+        pass
+
+    def move_axis(self, axis, coord):
+        pass
+
+    def axis_moving(self, axis):
+        return False
+
+    def speed_up(self):
+        pass
+
+    def slow_down(self):
+        pass
+
+    def stage_movement_emergency_stop(self):
+        pass
+
+    @property
+    def _coordinates_center(self):
+        return [[0, 0], [0, 0], [0, 0]]
+
+    @property
+    def _automovement_safe_height(self):
+        return 0
+
+
+
+class HeadlessScan(object):
+    '''
+    State of one scan shared by its runners: recipe, journal, instruments and stages, the progress
+    lines and the events for listeners, and the plan of the devices still to measure. The scan
+    itself (move, pretest, measurement, journal and summary) runs in orchestrator.AsyncScan,
+    which is what the runner, the engine process and the GUI use.
+
+    :param recipe: loaded recipe
+    :param journal: ScanJournal of the scan (new or loaded for resume)
+    :param station: HeadlessStation with the instruments
+    :param stages: StageStack (or NoStages)
+    :param out: stream progress lines are written to (None: no progress lines)
+    :param listener: optional callable listener(topic, *args) that receives the events of the scan
+                     ('log', 'procedure', 'progress', 'status', 'device'), see engine.py; the data
+                     points of a procedure are read from the shared buffer named in its
+                     'procedure' event (sharedbuffer.py)
+    '''
+
+    def __init__(self, recipe, journal, station, stages, out=sys.stdout, listener=None):
+        import measurements
+        self.recipe = recipe
+        self.journal = journal
+        self.station = station
+        self.stages = stages
+        self.out = out
+        self.listener = listener
+        self.procedure_class_pretest = getattr(measurements, recipe['pretest'])
+        self.procedure_class = getattr(measurements, recipe['procedure'])
+        self.failures = 0
+        self._abort = threading.Event()
+
+
+    def notify(self, topic, *args):
+        if self.listener is not None:
+            self.listener(topic, *args)
+
+
+    def progress(self, *fields):
+        line = dt.now().strftime("%H:%M:%S")+"\t"+"\t".join(str(field) for field in fields)
+        if self.out is not None:
+            self.out.write(line+"\n")
+            self.out.flush()
+        self.notify('log', line)
+
+
+    def plan(self):
+        '''
+        Returns the ScanPlan of the devices of the journal not completed yet, with the stage
+        coordinates of the devices.
+        '''
+        from scan import ScanPlan
+        plan = ScanPlan.from_parameters(self.journal.parameters, self.journal.folder, self.journal.completed_devices())
+        plan.locate(self.stages, self.journal.registration)
+        return plan
+
+
+
+def record_device(journal, plan, i, outcome, results):
+    '''
+    Records device i of the scan in the measurement catalog. Failures are logged, a scan never
+    stops for the catalog.
+    '''
+    from catalog import CATALOG, CatalogError
+    try:
+        CATALOG.record_device(journal.folder, plan.datafolder(i), plan.name(i), plan.indices(i), outcome, results,
+                              journal.parameters.get('wafername'))
+    except CatalogError as e:
+        log.warning("Device %s not recorded in the catalog: %s", plan.name(i), e)
+
+
+
+def open_journal(recipe, resume=None):
+    '''
+    Returns the ScanJournal of the interrupted scan in folder resume, or creates a new scan folder
+    with a journal for recipe.
+    '''
+    from journal import ScanJournal
+    if resume:
+        journal = ScanJournal.load(resume)
+        journal.write('resumed', completed=len(journal.completed_devices()))
+    else:
+        p = recipe['parameters']
+        folder = os.path.join(p['savepath'], dt.now().strftime("%Y-%m-%d__%H-%M-%S")+"__"+p['wafername'])
+        os.makedirs(folder)
+        journal = ScanJournal(folder)
+        journal.write_plan(p, recipe['registration'])
+    return journal
+
+
+
+def open_stages(no_stages=False):
+    if no_stages:
+        return NoStages()
+    from stagecommands import StageStack
+    return StageStack()
+
+
+
+def dry_run(recipe, stages, resume=None, out=sys.stdout):
+    '''
+    Prints the duration estimate and bounds check of the scan of recipe (or of the remaining devices
+    of the interrupted scan in folder resume) without running it. Returns the exit code.
+    '''
+    from estimate import estimate_scan
+    from scan import ScanPlan
+    completed = ()
+    if resume:
+        from journal import ScanJournal
+        journal = ScanJournal.load(resume)
+        recipe = dict(recipe, parameters=journal.parameters, registration=journal.registration)
+        completed = journal.completed_devices()
+    plan = ScanPlan.from_parameters(recipe['parameters'], '', completed)
+    plan.locate(stages, recipe['registration'])
+    estimate = estimate_scan(plan, stages, recipe['pretest'], recipe['procedure'])
+    out.write(estimate.format()+"\n")
+    return EXIT_RECIPE if estimate.out_of_bounds else EXIT_OK
+
+
+
+def main(argv=None):
+    start = time.perf_counter()
+    parser = argparse.ArgumentParser(description="Run an automated probestation scan without GUI.")
+    parser.add_argument('recipe', help="scan recipe (JSON)")
+    parser.add_argument('--resume', metavar='SCANFOLDER', help="continue the interrupted scan in SCANFOLDER")
+    parser.add_argument('--progress', metavar='FILE', help="write progress to FILE instead of stdout")
+    parser.add_argument('--no-stages', action='store_true', help="do not move the stages (bench tests)")
+    parser.add_argument('--trace', action='store_true', help="record timing spans, written to trace.json "
+                                                             "(Chrome trace/Perfetto) and timing.csv in the scan folder")
+    parser.add_argument('--dry-run', action='store_true', help="only print the estimated duration of the scan "
+                                                               "and check the stage coordinates of all devices")
+    parser.add_argument('--debug', action='store_true', help="log debug messages (data points sampled)")
+    args = parser.parse_args(argv)
+
+    from logs import start_logging
+    logs = start_logging(logging.DEBUG if args.debug else logging.INFO)     # to stderr, progress goes to stdout
+    try:
+        return run_scan(args, start)
+    finally:
+        logs.stop()
+
+
+
+def run_scan(args, start):
+    if args.dry_run:
+        try:
+            return dry_run(load_recipe(args.recipe), open_stages(args.no_stages), args.resume)
+        except (RecipeError, LayoutError, OSError, ValueError, KeyError) as e:
+            sys.stderr.write(str(e)+"\n")
+            return EXIT_RECIPE
+
+    try:
+        recipe = load_recipe(args.recipe)
+        recipe['trace'] = recipe['trace'] or args.trace
+        journal = open_journal(recipe, args.resume)
+    except (RecipeError, OSError, ValueError, KeyError) as e:
+        sys.stderr.write(str(e)+"\n")
+        return EXIT_RECIPE
+
+    stages = open_stages(args.no_stages)
+    try:
+        station = HeadlessStation(*connect_instruments(recipe['instruments']))
+    except InstrumentError as e:
+        sys.stderr.write(str(e)+"\n")
+        return EXIT_RECIPE
+
+    out = open(args.progress, 'a') if args.progress else sys.stdout
+    try:
+        from orchestrator import AsyncScan
+        scan = AsyncScan(recipe, journal, station, stages, out)
+        if REGISTRY.discovery_time is None:
+            scan.progress('startup', "%.2f s" % (time.perf_counter()-start))
+        else:
+            scan.progress('startup', "%.2f s" % (time.perf_counter()-start), "instrument discovery %.2f s" % REGISTRY.discovery_time)
+        return asyncio.run(scan.run())     # Ctrl+C cancels the scan
+    except InstrumentError as e:            # channel source meters
+        sys.stderr.write(str(e)+"\n")
+        return EXIT_RECIPE
+    except KeyboardInterrupt:
+        return EXIT_ABORTED
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+# registry of the VISA instruments of the station
+# discovery opens all VISA resources concurrently and asks each for its identification (*IDN?),
+# with a timeout per resource, so one instrument that does not answer can not hold up the others.
+# Identifications are cached per resource (in memory and in CACHE_FILE), later discoveries only
+# query resources not seen before. Instruments are addressed by VISA address or by model and serial
+# number ({"model": "2450", "serial": "04305994"}); each physical instrument gets one VISA session,
+# shared by all roles it is used in (bias, gate, channels).
+# the module wide REGISTRY is used by the GUI, the headless runner and the engine process
+
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+DISCOVERY_TIMEOUT = 2.      # s, opening a resource and answering *IDN?
+DISCOVERY_THREADS = 16
+RESOURCE_QUERY = '?*::INSTR'
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.probestation', 'instruments.json')
+
+
+class InstrumentError(Exception):
+    pass
+
+
+
+class Identity(namedtuple('Identity', ['resource', 'manufacturer', 'model', 'serial', 'firmware'])):
+    '''
+    Identification of an instrument, from its answer to *IDN? ("manufacturer,model,serial,firmware").
+    '''
+
+    @classmethod
+    def parse(cls, resource, idn):
+        fields = [field.strip() for field in idn.strip().split(',')]
+        fields += ['']*(4-len(fields))
+        return cls(resource, *fields[:4])
+
+
+    def matches(self, model=None, serial=None):
+        # model: part of the model string ("2450" matches "MODEL 2450"), serial: exact
+        if model is not None and str(model).upper() not in self.model.upper():
+            return False
+        if serial is not None and str(serial).upper() != self.serial.upper():
+            return False
+        return True
+
+
+    def __str__(self):
+        return "%s %s (serial %s) at %s" % (self.manufacturer, self.model, self.serial, self.resource)
+
+
+
+def _identify(resource_manager, resource, timeout):
+    # opens resource, asks for *IDN? and closes it again, in a discovery thread
+    instrument = resource_manager.open_resource(resource, open_timeout=int(timeout*1000))
+    try:
+        instrument.timeout = int(timeout*1000)
+        return Identity.parse(resource, instrument.query('*IDN?'))
+    finally:
+        instrument.close()
+
+
+
+class LockedAdapter(object):
+    '''
+    Shared VISA session of one resource. Instruments of several roles on the same resource (bias
+    and gate on one 2450) are used from several threads at once (channel procedures, SharedGate,
+    InstrumentChannel): every command and query holds the lock of the session, so a write and the
+    read of its reply are not interleaved with those of another thread. Sequences of commands that
+    belong together can hold it too: with adapter.lock: ...
+
+    :param adapter: VISAAdapter of the resource
+    '''
+    LOCKED = ('write', 'read', 'read_bytes', 'ask', 'ask_values', 'values', 'binary_values', 'write_binary_values')
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.lock = threading.RLock()
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self.adapter, name)
+        if name not in self.LOCKED:
+            return attribute
+        def locked(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+        return locked
+
+
+    def __repr__(self):
+        return "<LockedAdapter %r>" % self.adapter
+
+
+
+class InstrumentRegistry(object):
+    '''
+    VISA resources of the station, their identifications and the shared sessions.
+
+    Usage:
+        registry = InstrumentRegistry()
+        registry.discover()
+        sourcemeter = registry.instrument({'model': '2450', 'serial': '04305994'}, Keithley2450, **BIAS_RAMP)
+        ...
+        registry.close()
+
+    :param cache_file: JSON file the identifications are kept in between runs, None: memory only
+    :param timeout: timeout of the identification of one resource
+    '''
+
+    def __init__(self, cache_file=None, timeout=DISCOVERY_TIMEOUT):
+        self.cache_file = cache_file
+        self.timeout = timeout
+        self.identities = {}            # resource -> Identity, None for resources that did not answer
+        self.discovery_time = None
+        self._resource_manager = None
+        self._adapters = {}             # resource -> LockedAdapter
+        self._lock = threading.Lock()
+        self._load_cache()
+
+
+    def _load_cache(self):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                for resource, fields in json.load(f).items():
+                    self.identities[resource] = Identity(resource, *fields)
+        except (OSError, ValueError, TypeError):
+            log.warning("Could not read instrument cache %s", self.cache_file, exc_info=True)
+
+
+    def _save_cache(self):
+        if self.cache_file is None:
+            return
+        known = {resource: list(identity[1:]) for resource, identity in self.identities.items() if identity is not None}
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, 'w') as f:
+                json.dump(known, f, indent=1)
+        except OSError:
+            log.warning("Could not write instrument cache %s", self.cache_file, exc_info=True)
+
+
+    @property
+    def resource_manager(self):
+        if self._resource_manager is None:
+            from pyvisa import ResourceManager
+            self._resource_manager = ResourceManager()
+        return self._resource_manager
+
+
+    def discover(self, query=RESOURCE_QUERY, refresh=False):
+        '''
+        Lists the VISA resources and identifies the ones not in the cache (all of them with
+        refresh=True) concurrently. Returns {resource: Identity or None} of the connected resources,
+        None for resources that could not be opened or did not answer in time.
+        '''
+        start = time.perf_counter()
+        resources = list(self.resource_manager.list_resources(query))
+        unknown = [resource for resource in resources if refresh or self.identities.get(resource) is None]
+        if unknown:
+            executor = ThreadPoolExecutor(max_workers=min(DISCOVERY_THREADS, len(unknown)), thread_name_prefix='discovery')
+            futures = {executor.submit(_identify, self.resource_manager, resource, self.timeout): resource for resource in unknown}
+            done, not_done = wait(futures, timeout=2*self.timeout)
+            for future in done:
+                try:
+                    self.identities[futures[future]] = future.result()
+                except Exception as e:
+                    log.info("No identification from %s: %r", futures[future], e)
+                    self.identities[futures[future]] = None
+            for future in not_done:
+                log.info("No identification from %s within %g s", futures[future], self.timeout)
+                self.identities[futures[future]] = None
+            executor.shutdown(wait=False)   # hung sessions finish in the background
+            self._save_cache()
+        self.discovery_time = time.perf_counter()-start
+        log.info("Discovered %d VISA resources in %.2f s (%d identified, %d from cache)", len(resources),
+                 self.discovery_time, sum(self.identities.get(r) is not None for r in resources), len(resources)-len(unknown))
+        return {resource: self.identities.get(resource) for resource in resources}
+
+
+    def resolve(self, spec):
+        '''
+        Returns the VISA address of an instrument given by its address (str) or by model and/or
+        serial number ({"model": ..., "serial": ...}). Only resources that are listed right now count;
+        discovers the resources if no identification of them matches yet. Raises InstrumentError if
+        there is no or more than one matching instrument.
+        '''
+        if isinstance(spec, str):
+            return spec
+        try:
+            model, serial = spec.get('model'), spec.get('serial')
+        except AttributeError:
+            raise InstrumentError("Instrument "+repr(spec)+" is neither an address nor {'model': ..., 'serial': ...}")
+        listed = set(self.resource_manager.list_resources(RESOURCE_QUERY))
+        matches = self._matches(model, serial, listed)     # cached identities of disconnected resources do not count
+        if not matches:
+            listed = set(self.discover())
+            matches = self._matches(model, serial, listed)
+        if len(matches) != 1:
+            raise InstrumentError("%s instruments match %r: %s" % ("No" if not matches else len(matches), spec,
+                                                                   ", ".join(str(identity) for identity in matches)))
+        return matches[0].resource
+
+
+    def _matches(self, model, serial, listed):
+        return [identity for resource, identity in self.identities.items()
+                if identity is not None and resource in listed and identity.matches(model, serial)]
+
+
+    def adapter(self, resource):
+        '''
+        Returns the LockedAdapter (one VISA session) of resource, opened on first use.
+        '''
+        with self._lock:
+            if resource not in self._adapters:
+                from pymeasure.adapters import VISAAdapter
+                self._adapters[resource] = LockedAdapter(VISAAdapter(resource))
+            else:
+                log.info("Sharing the VISA session of %s", resource)
+            return self._adapters[resource]
+
+
+    def instrument(self, spec, instrument_class, **kwargs):
+        '''
+        Returns a new instrument_class(adapter, **kwargs) on the shared session of the instrument
+        given by spec (see resolve()).
+        '''
+        return instrument_class(self.adapter(self.resolve(spec)), **kwargs)
+
+
+    def close(self):
+        '''
+        Closes all sessions (e.g. before the engine process opens the instruments).
+        '''
+        with self._lock:
+            adapters, self._adapters = self._adapters, {}
+        for resource, adapter in adapters.items():
+            try:
+                adapter.connection.close()
+            except Exception:
+                log.warning("Could not close %s", resource, exc_info=True)
+
+
+
+REGISTRY = InstrumentRegistry(CACHE_FILE)
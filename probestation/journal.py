@@ -0,0 +1,128 @@
+# crash-safe journal for automated wafer scans
+# every scan folder gets an append-only log of what has been done so far, so an interrupted scan
+# can be picked up again at the first device that was not measured completely
+
+import os
+import json
+import threading
+from datetime import datetime as dt
+
+from pymeasure.experiment import Procedure
+
+from tracing import TRACER
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+JOURNAL_FILENAME = 'scan_journal.jsonl'
+
+
+class ScanJournal(object):
+    '''
+    Append-only, fsync'd journal of one automated scan. Each line of the journal file is a JSON
+    object with at least the keys 'event' and 'time'.
+
+    Events written during a scan:
+        'plan'          wafer level parameters of the scan (the procedure parameters)
+        'registration'  captured stage coordinates the device grid is calculated from
+        'moved'         stage arrived at a device
+        'pretest'       pretest finished, with result ('passed') and data file
+        'measured'      measurement finished, with procedure status and data file
+        'resumed'       scan was resumed from this journal
+        'finished'      scan ran through to the end
+
+    :param folder: scan folder the journal lives in (created by the producer)
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.filename = os.path.join(folder, JOURNAL_FILENAME)
+        self.parameters = None
+        self.registration = None
+        self.devices = {}           # devicename -> merged state of all entries of that device
+        self.finished = False
+        self._lock = threading.Lock()
+
+
+    @classmethod
+    def load(cls, folder):
+        '''
+        Rebuilds the state of a scan from the journal file in folder. A truncated last line (crash
+        while writing) is ignored.
+        '''
+        journal = cls(folder)
+        if not os.path.isfile(journal.filename):
+            raise FileNotFoundError("No scan journal found in "+folder)
+        with open(journal.filename, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning("Skipping corrupt line in scan journal %s", journal.filename)
+                    continue
+                journal._apply(entry)
+        if journal.parameters is None:
+            raise ValueError("Scan journal "+journal.filename+" contains no scan plan")
+        return journal
+
+
+    def _apply(self, entry):
+        event = entry.get('event')
+        if event == 'plan':
+            self.parameters = entry['parameters']
+        elif event == 'registration':
+            self.registration = entry['registration']
+        elif event == 'finished':
+            self.finished = True
+        elif 'device' in entry:
+            state = self.devices.setdefault(entry['device'], {})
+            state[event] = entry
+
+
+    def write(self, event, **kwargs):
+        '''
+        Appends one entry to the journal and forces it to disk before returning.
+        '''
+        entry = {'event': event, 'time': dt.now().isoformat()}
+        entry.update(kwargs)
+        line = json.dumps(entry)+"\n"
+        with self._lock, TRACER.span('journal', 'io', event=event):
+            with open(self.filename, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(entry)
+
+
+    def write_plan(self, parameters, registration):
+        self.write('plan', parameters=parameters)
+        self.write('registration', registration=registration)
+
+
+    def device_moved(self, devicename, coordinates):
+        self.write('moved', device=devicename, coordinates=coordinates)
+
+
+    def device_pretest(self, devicename, passed, datafile):
+        self.write('pretest', device=devicename, passed=bool(passed), file=datafile)
+
+
+    def device_measured(self, devicename, status, datafile):
+        self.write('measured', device=devicename, status=status, file=datafile)
+
+
+    def is_complete(self, devicename):
+        '''
+        A device is complete if it failed its pretest or its measurement finished without abort.
+        Everything else (only moved, aborted, crashed during a sweep) is measured again on resume.
+        '''
+        state = self.devices.get(devicename, {})
+        if 'pretest' in state and not state['pretest']['passed']:
+            return True
+        return 'measured' in state and state['measured']['status'] == Procedure.FINISHED
+
+
+    def completed_devices(self):
+        return set(name for name in self.devices if self.is_complete(name))
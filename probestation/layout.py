@@ -0,0 +1,306 @@
+# device layouts of masks with irregular device placement
+# a layout file lists every device of the wafer with its chip, its position on the chip, its type
+# and tags. Positions are mapped to stage coordinates through the wafer registration (the stage
+# coordinates captured at three reference devices of the layout), a spatial index answers
+# neighbourhood queries, and the selected devices feed scan.ScanPlan.
+#
+# JSON layout:
+# {
+#     "chips": {"1": [x, y], ...},                  chip origins on the wafer in um, optional
+#     "reference": {"dev_00": "<id>", "dev_i0": "<id>", "dev_0j": "<id>"},
+#     "devices": [{"id": ..., "chip": ..., "x": ..., "y": ..., "type": ..., "tags": [...]}, ...]
+# }
+# CSV layout: columns id, chip, x, y, type, tags (separated by ';'), optional chip_x, chip_y (chip
+# origin) and reference (dev_00, dev_i0 or dev_0j for the reference devices)
+
+import os
+import csv
+import json
+import math
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+MICROSTEPS = 256            # microsteps per step (see StageStack.coordinates_cleanup)
+REFERENCES = ('dev_00', 'dev_i0', 'dev_0j')
+
+LAYOUT_DTYPE = np.dtype([
+    ('id', 'U32'),
+    ('chip', 'U16'),
+    ('x', np.float64),          # position on the wafer (chip origin + position on the chip), um
+    ('y', np.float64),
+    ('type', 'U16'),
+])
+
+
+def layout_dtype(values):
+    '''
+    LAYOUT_DTYPE with its string fields as wide as the longest of values ({field: [str, ...]}),
+    so loaded ids, chips and types are never truncated.
+    '''
+    fields = []
+    for name in LAYOUT_DTYPE.names:
+        dtype = LAYOUT_DTYPE.fields[name][0]
+        if dtype.kind == 'U':
+            width = max([len(value) for value in values.get(name, ())] + [dtype.itemsize//4])
+            dtype = np.dtype('U%d' % width)
+        fields.append((name, dtype))
+    return np.dtype(fields)
+
+
+class LayoutError(Exception):
+    pass
+
+
+
+class SpatialIndex(object):
+    '''
+    Uniform grid over 2D points: every point is filed under its cell, queries only look at the
+    cells around the query point.
+
+    :param points: array (n, 2) of x, y
+    :param cell: cell size, default: about one point per cell
+    '''
+
+    def __init__(self, points, cell=None):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        n = len(self.points)
+        if cell is None:
+            span = np.ptp(self.points, axis=0).max() if n else 0.
+            cell = span/math.sqrt(n) if span > 0 else 1.
+        self.cell = float(cell)
+        keys = np.floor(self.points/self.cell).astype(np.int64)
+        self._cells = {}
+        if n:
+            order = np.lexsort((keys[:, 1], keys[:, 0]))
+            unique, starts = np.unique(keys[order], axis=0, return_index=True)
+            for key, start, stop in zip(unique.tolist(), starts, np.append(starts[1:], n)):
+                self._cells[tuple(key)] = order[start:stop]
+            self._low, self._high = keys.min(axis=0), keys.max(axis=0)
+
+
+    def _cell(self, x, y):
+        return int(math.floor(x/self.cell)), int(math.floor(y/self.cell))
+
+
+    def within(self, x, y, radius):
+        '''
+        Returns the indices of all points within radius of x, y.
+        '''
+        (x0, y0), (x1, y1) = self._cell(x-radius, y-radius), self._cell(x+radius, y+radius)
+        found = [self._cells[(cx, cy)] for cx in range(x0, x1+1) for cy in range(y0, y1+1) if (cx, cy) in self._cells]
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.concatenate(found)
+        distance = np.hypot(*(self.points[candidates]-(x, y)).T)
+        return np.sort(candidates[distance <= radius])
+
+
+    def nearest(self, x, y, mask=None):
+        '''
+        Returns the index of the point nearest to x, y, only points with mask True if given.
+        None if there is no such point.
+        '''
+        if not self._cells:
+            return None
+        cx, cy = self._cell(x, y)
+        rings = int(max(abs(cx-self._low[0]), abs(cx-self._high[0]), abs(cy-self._low[1]), abs(cy-self._high[1])))
+        best, best_distance = None, np.inf
+        for ring in range(rings+1):
+            if best is not None and best_distance <= (ring-1)*self.cell:
+                break                           # points of this ring and beyond are farther
+            for key in self._ring(cx, cy, ring):
+                candidates = self._cells.get(key)
+                if candidates is None:
+                    continue
+                if mask is not None:
+                    candidates = candidates[mask[candidates]]
+                    if not len(candidates):
+                        continue
+                distance = np.hypot(*(self.points[candidates]-(x, y)).T)
+                i = np.argmin(distance)
+                if distance[i] < best_distance:
+                    best, best_distance = int(candidates[i]), distance[i]
+        return best
+
+
+    @staticmethod
+    def _ring(cx, cy, ring):
+        if ring == 0:
+            yield (cx, cy)
+            return
+        for dx in range(-ring, ring+1):
+            yield (cx+dx, cy-ring)
+            yield (cx+dx, cy+ring)
+        for dy in range(-ring+1, ring):
+            yield (cx-ring, cy+dy)
+            yield (cx+ring, cy+dy)
+
+
+
+class DeviceLayout(object):
+    '''
+    Devices of a mask layout (LAYOUT_DTYPE array, in file order), their tags, the reference
+    devices of the registration and a spatial index of the device positions.
+
+    :param devices: array of LAYOUT_DTYPE (string fields may be wider, see layout_dtype)
+    :param tags: list of the tag sets of the devices
+    :param reference: {'dev_00': id, 'dev_i0': id, 'dev_0j': id}
+    '''
+
+    def __init__(self, devices, tags=None, reference=None):
+        self.devices = devices
+        self.reference = dict(reference or {})
+        tags = tags or [set() for _ in range(len(devices))]
+        self.tags = {}                          # tag -> mask of the devices with that tag
+        for i, device_tags in enumerate(tags):
+            for tag in device_tags:
+                self.tags.setdefault(tag, np.zeros(len(devices), dtype=bool))[i] = True
+        self.chips = sorted(set(devices['chip'].tolist()), key=_natural)
+        self._rows = {name: i for i, name in enumerate(devices['id'].tolist())}
+        if len(self._rows) != len(devices):
+            raise LayoutError("Device ids of the layout are not unique")
+        self.index = SpatialIndex(np.column_stack((devices['x'], devices['y'])))
+
+
+    def __len__(self):
+        return len(self.devices)
+
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Reads a layout from a JSON or CSV file (by extension).
+        '''
+        try:
+            if os.path.splitext(filename)[1].lower() == '.json':
+                with open(filename, 'r') as f:
+                    data = json.load(f)
+                chips = {str(chip): origin for chip, origin in data.get('chips', {}).items()}
+                reference = data.get('reference', {})
+                rows = data['devices']
+            else:
+                with open(filename, 'r', newline='') as f:
+                    rows = list(csv.DictReader(f))
+                chips, reference = {}, {}
+                for row in rows:
+                    if row.get('chip_x') not in (None, ''):
+                        chips[str(row['chip'])] = (float(row['chip_x']), float(row['chip_y']))
+                    if row.get('reference'):
+                        reference[row['reference']] = row['id']
+                    row['tags'] = [tag for tag in (row.get('tags') or '').split(';') if tag]
+            values = [(str(row['id']), str(row['chip']), float(row['x']), float(row['y']), str(row.get('type', '') or ''))
+                      for row in rows]
+            devices = np.zeros(len(rows), dtype=layout_dtype({'id': [v[0] for v in values], 'chip': [v[1] for v in values],
+                                                               'type': [v[4] for v in values]}))
+            tags = []
+            for i, (row, (device_id, chip, x, y, device_type)) in enumerate(zip(rows, values)):
+                origin = chips.get(chip, (0., 0.))
+                devices[i] = (device_id, chip, origin[0]+x, origin[1]+y, device_type)
+                tags.append(set(row.get('tags', ())))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise LayoutError("Could not read layout "+filename+": "+repr(e))
+        return cls(devices, tags, reference)
+
+
+    def row(self, device_id):
+        return self._rows[device_id]
+
+
+    def select(self, chip=None, type=None, tag=None):
+        '''
+        Returns the rows (file order) of the devices on chip, of type and with tag; each of them
+        can be a single value or a list of values, None matches all devices.
+        '''
+        mask = np.ones(len(self.devices), dtype=bool)
+        if chip is not None:
+            mask &= np.isin(self.devices['chip'], [str(c) for c in np.atleast_1d(chip)])
+        if type is not None:
+            mask &= np.isin(self.devices['type'], np.atleast_1d(type))
+        if tag is not None:
+            tags = np.zeros(len(self.devices), dtype=bool)
+            for name in np.atleast_1d(tag):
+                if name in self.tags:
+                    tags |= self.tags[name]
+            mask &= tags
+        return np.flatnonzero(mask)
+
+
+    def nearest(self, x, y, rows=None):
+        '''
+        Returns the row of the device nearest to x, y (um on the wafer), only devices in rows if
+        given (e.g. the unmeasured devices). None if there is none.
+        '''
+        mask = None
+        if rows is not None:
+            mask = np.zeros(len(self.devices), dtype=bool)
+            mask[rows] = True
+        return self.index.nearest(x, y, mask)
+
+
+    def within(self, x, y, radius):
+        return self.index.within(x, y, radius)
+
+
+    def route(self, rows, start=None):
+        '''
+        Scan order of the devices in rows: chip by chip (in chip order), on each chip always on to
+        the nearest device not visited yet.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        mask = np.zeros(len(self.devices), dtype=bool)
+        order = []
+        x, y = start if start is not None else (0., 0.)
+        for chip in self.chips:
+            on_chip = rows[self.devices['chip'][rows] == chip]
+            mask[on_chip] = True
+            for _ in range(len(on_chip)):
+                i = self.index.nearest(x, y, mask)
+                mask[i] = False
+                order.append(i)
+                x, y = self.devices['x'][i], self.devices['y'][i]
+        return np.array(order, dtype=np.int64)
+
+
+    def transform(self, registration):
+        '''
+        Returns the affine transform (3x3 matrix M, stage position in steps = [x, y, 1] @ M) from
+        wafer positions to stage positions of x, y, z, fixed by the stage coordinates of the
+        reference devices in registration (StageStack.registration()).
+        '''
+        try:
+            rows = [self._rows[self.reference[name]] for name in REFERENCES]
+        except KeyError as e:
+            raise LayoutError("Layout has no reference device "+str(e))
+        wafer = np.column_stack((self.devices['x'][rows], self.devices['y'][rows], np.ones(3)))
+        stage = np.array([[c[0] + c[1]/float(MICROSTEPS) for c in registration[name]] for name in REFERENCES])
+        try:
+            return np.linalg.solve(wafer, stage)
+        except np.linalg.LinAlgError:
+            raise LayoutError("Reference devices of the layout are on one line")
+
+
+    def stage_coordinates(self, registration, rows=None):
+        '''
+        Returns the stage coordinates (array (n, 3, 2) of [steps, microsteps] of x, y, z) of the
+        devices in rows (default: all).
+        '''
+        devices = self.devices if rows is None else self.devices[rows]
+        wafer = np.column_stack((devices['x'], devices['y'], np.ones(len(devices))))
+        positions = wafer @ self.transform(registration)
+        steps = np.trunc(positions)
+        microsteps = np.round((positions-steps)*MICROSTEPS)
+        carry = np.abs(microsteps) >= MICROSTEPS   # rounded up to a full step
+        steps[carry] += np.sign(microsteps[carry])
+        microsteps[carry] = 0
+        return np.stack((steps, microsteps), axis=-1).astype(np.int64)
+
+
+
+def _natural(chip):
+    # chip labels in natural order: 2 before 10
+    return (0, int(chip), '') if chip.isdigit() else (1, 0, chip)
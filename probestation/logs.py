@@ -0,0 +1,147 @@
+# logging that stays out of the way of the measurement threads
+# LogQueue puts the records of a logger on a queue, the handlers (console, log widget, ...) format
+# and write them in a listener thread of their own. Messages are formatted lazily: log calls pass
+# format string and arguments, a message is only built if a handler takes the record.
+# Records can carry structured fields (log.info("device done", extra=fields(device=..., s=...))),
+# FieldsFormatter appends them as key=value pairs.
+# PointLog samples the debug messages of measurement loops.
+
+import time
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+
+FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s%(fields_text)s'
+
+# arguments of these types can not change between the log call and the formatting in the listener
+_IMMUTABLE = (str, bytes, int, float, bool, complex, type(None))
+
+
+def fields(**values):
+    '''
+    Structured fields of a record, pass as extra=fields(key=value, ...).
+    '''
+    return {'fields': values}
+
+
+
+class FieldsFormatter(logging.Formatter):
+    '''
+    Formatter that appends the structured fields of a record (see fields()) as key=value pairs,
+    use %(fields_text)s in the format string.
+    '''
+
+    def __init__(self, fmt=FORMAT, datefmt=None):
+        super().__init__(fmt, datefmt)
+
+
+    def format(self, record):
+        values = getattr(record, 'fields', None)
+        record.fields_text = (" "+" ".join("%s=%s" % item for item in values.items())) if values else ""
+        return super().format(record)
+
+
+
+class LazyQueueHandler(QueueHandler):
+    '''
+    QueueHandler that does not format the message in the calling thread (QueueHandler.prepare
+    does), unless an argument is mutable and could change before the listener formats it.
+    '''
+
+    def prepare(self, record):
+        args = record.args
+        if args:
+            if not isinstance(args, tuple):
+                args = (args,)
+            if not all(isinstance(arg, _IMMUTABLE) for arg in args):
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+
+
+class LogQueue(object):
+    '''
+    Background logging for logger (default: the root logger): the handlers run in a listener
+    thread, the logging threads only put records on a queue.
+
+    Usage:
+        logs = LogQueue(handlers=[logging.StreamHandler()])
+        logs.start()
+        ...
+        logs.stop()         # writes the remaining records
+    '''
+
+    def __init__(self, logger=None, handlers=()):
+        self.logger = logging.getLogger() if logger is None else logger
+        self.queue = queue.Queue()
+        self.handler = LazyQueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+
+    def add_handler(self, handler):
+        self.listener.handlers = self.listener.handlers + (handler,)
+
+
+    def start(self):
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+
+
+    def stop(self):
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+
+
+
+class PointLog(object):
+    '''
+    Sampled debug messages of measurement loops: passes at most one message per interval on to
+    the logger and counts the ones left out. While debug messages are off, a call costs one
+    attribute check.
+
+    Usage:
+        points = PointLog(log)
+        for voltage in voltages:
+            points.debug("Measuring current: %g V", voltage)
+    '''
+
+    def __init__(self, logger, interval=1.):
+        self.logger = logger
+        self.interval = interval
+        self.enabled = logger.isEnabledFor(logging.DEBUG)
+        self.skipped = 0
+        self._next = 0.
+
+
+    def debug(self, msg, *args):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now < self._next:
+            self.skipped += 1
+            return
+        self._next = now+self.interval
+        if self.skipped:
+            self.logger.debug(msg+" (%d points not logged)", *(args+(self.skipped,)))
+            self.skipped = 0
+        else:
+            self.logger.debug(msg, *args)
+
+
+
+def start_logging(level=logging.INFO, handlers=(), logger=None):
+    '''
+    Sets the level of logger (default: root) and starts a LogQueue writing to handlers, by
+    default to the console. Returns the LogQueue.
+    '''
+    logger = logging.getLogger() if logger is None else logger
+    logger.setLevel(level)
+    if not handlers:
+        console = logging.StreamHandler()
+        console.setFormatter(FieldsFormatter())
+        handlers = (console,)
+    logs = LogQueue(logger, handlers)
+    logs.start()
+    return logs
@@ -24,13 +24,16 @@
 
 import logging
 
-from os.path import basename
+from collections import OrderedDict, deque
+from os.path import basename, normpath
 from time import sleep
 
 from pymeasure.display.Qt import QtCore
 from pymeasure.display.listeners import Monitor
 from pymeasure.experiment import Procedure
 from workers import Worker
+from curves import BufferedResultsCurve
+from tracing import TRACER
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -57,34 +60,80 @@ class Experiment(QtCore.QObject):
 
 class ExperimentQueue(QtCore.QObject):
     """ Represents a Queue of Experiments and allows queries to
-    be easily preformed
+    be easily preformed. Lookups are indexed: queued experiments are
+    kept in a deque, experiments are indexed by browser item and by the
+    basename of their data file. Browser items (QTreeWidgetItem) are not
+    hashable, they are indexed by id().
     """
 
     def __init__(self):
         super().__init__()
-        self.queue = []
+        self._experiments = {}          # insertion ordered, used as ordered set
+        self._queued = deque()
+        self._in_queued = set()
+        self._by_browser_item = {}
+        self._by_basename = {}
+        self._by_filename = {}
+
+    @property
+    def queue(self):
+        return list(self._experiments)
+
+    def __len__(self):
+        return len(self._experiments)
+
+    def _enqueue(self, experiment):
+        if experiment not in self._in_queued:
+            self._queued.append(experiment)
+            self._in_queued.add(experiment)
 
     def append(self, experiment):
-        self.queue.append(experiment)
+        # all keys first, so an experiment that can not be indexed leaves
+        # no partial entries behind
+        item = id(experiment.browser_item)
+        name = basename(experiment.data_filename)
+        filename = normpath(experiment.data_filename)
+        queued = experiment.procedure.status == Procedure.QUEUED
+        self._experiments[experiment] = None
+        self._by_browser_item[item] = experiment
+        self._by_basename.setdefault(name, set()).add(experiment)
+        self._by_filename[filename] = experiment
+        if queued:
+            self._enqueue(experiment)
 
     def remove(self, experiment):
-        if experiment not in self.queue:
+        if experiment not in self._experiments:
             raise Exception("Attempting to remove an Experiment that is "
                             "not in the ExperimentQueue")
         else:
             if experiment.procedure.status == Procedure.RUNNING:
                 raise Exception("Attempting to remove a running experiment")
             else:
-                self.queue.pop(self.queue.index(experiment))
+                del self._experiments[experiment]
+                if self._by_browser_item.get(id(experiment.browser_item)) is experiment:
+                    del self._by_browser_item[id(experiment.browser_item)]
+                name = basename(experiment.data_filename)
+                self._by_basename[name].discard(experiment)
+                if not self._by_basename[name]:
+                    del self._by_basename[name]
+                if self._by_filename.get(normpath(experiment.data_filename)) is experiment:
+                    del self._by_filename[normpath(experiment.data_filename)]
+                # removed experiments are dropped lazily from the deque by next()
+                self._in_queued.discard(experiment)
+
+    def update_status(self, experiment, status):
+        """ Sets the status of an experiment and keeps the queue index
+        consistent (experiments set back to QUEUED are queued again)
+        """
+        experiment.procedure.status = status
+        if status == Procedure.QUEUED and experiment in self._experiments:
+            self._enqueue(experiment)
 
     def __contains__(self, value):
         if isinstance(value, Experiment):
-            return value in self.queue
+            return value in self._experiments
         if isinstance(value, str):
-            for experiment in self.queue:
-                if basename(experiment.data_filename) == basename(value):
-                    return True
-            return False
+            return basename(value) in self._by_basename
         return False
 
     def __getitem__(self, key):
@@ -93,9 +142,14 @@ class ExperimentQueue(QtCore.QObject):
     def next(self):
         """ Returns the next experiment on the queue
         """
-        for experiment in self.queue:
-            if experiment.procedure.status == Procedure.QUEUED:
+        # experiments that left the QUEUED state (or the queue) are dropped
+        # from the front, so every experiment is skipped at most once
+        while self._queued:
+            experiment = self._queued[0]
+            if experiment in self._in_queued and experiment.procedure.status == Procedure.QUEUED:
                 return experiment
+            self._queued.popleft()
+            self._in_queued.discard(experiment)
         raise StopIteration("There are no queued experiments")
 
     def has_next(self):
@@ -109,10 +163,98 @@ class ExperimentQueue(QtCore.QObject):
         return True
 
     def with_browser_item(self, item):
-        for experiment in self.queue:
-            if experiment.browser_item is item:
-                return experiment
-        return None
+        return self._by_browser_item.get(id(item))
+
+    def with_data_filename(self, filename):
+        return self._by_filename.get(normpath(filename))
+
+
+class ExperimentMemory(QtCore.QObject):
+    """ Keeps the in-memory curve data of all experiments below a budget.
+    Experiments are ordered by last use (loaded, shown, run). If the
+    curve data exceeds the budget, the data of the least recently used
+    hidden experiments that are not running is evicted. Their metadata
+    (procedure, browser item) stays resident and the curve reads its data
+    file again when it is shown the next time.
+
+    The budget only applies to hidden experiments: visible curves are
+    updated by the plot every frame, an evicted visible curve would read
+    its data file again right away. The data of visible and running
+    experiments is counted in the usage but never evicted.
+
+    :param plot: PyQtGraph `PlotItem` the curves are shown in
+    :param budget: memory budget for curve data in bytes
+    """
+    usage_changed = QtCore.QSignal(int, int)
+
+    def __init__(self, plot, budget=256 * 2**20, parent=None):
+        super().__init__(parent)
+        self.plot = plot
+        self.budget = budget
+        self._experiments = OrderedDict()
+        self._visible = set()           # curves shown in the plot
+        self._sizes = {}                # curve -> bytes counted in _usage
+        self._usage = 0
+
+    def touch(self, experiment):
+        """ Marks an experiment as most recently used """
+        if experiment not in self._experiments:
+            curve = experiment.curve
+            if isinstance(curve, BufferedResultsCurve):
+                curve.resize_listeners.append(self._resized)
+                self._resized(curve)
+        self._experiments[experiment] = None
+        self._experiments.move_to_end(experiment)
+
+    def show(self, experiment):
+        """ Marks an experiment as visible and most recently used """
+        self._visible.add(experiment.curve)
+        self.touch(experiment)
+
+    def hide(self, experiment):
+        self._visible.discard(experiment.curve)
+
+    def discard(self, experiment):
+        if experiment not in self._experiments:
+            return
+        del self._experiments[experiment]
+        curve = experiment.curve
+        self._visible.discard(curve)
+        if isinstance(curve, BufferedResultsCurve):
+            curve.resize_listeners.remove(self._resized)
+            self._usage -= self._sizes.pop(curve, 0)
+
+    def _resized(self, curve):
+        nbytes = curve.nbytes()
+        self._usage += nbytes - self._sizes.get(curve, 0)
+        self._sizes[curve] = nbytes
+
+    def usage(self):
+        return self._usage
+
+    def _evictable(self, experiment):
+        return (isinstance(experiment.curve, BufferedResultsCurve)
+                and experiment.curve.is_resident()
+                and experiment.procedure.status != Procedure.RUNNING
+                and experiment.curve not in self._visible)
+
+    def enforce(self):
+        """ Evicts curve data until the usage is below the budget and
+        reports the usage
+        """
+        with TRACER.span('memory enforce', 'gui'):
+            usage = self._enforce()
+        self.usage_changed.emit(usage, self.budget)
+        return usage
+
+    def _enforce(self):
+        for experiment in list(self._experiments):
+            if self._usage <= self.budget:
+                break
+            if self._evictable(experiment):
+                experiment.curve.evict()        # updates the usage through resize_listeners
+                log.debug("Evicted curve data of %s", experiment.data_filename)
+        return self._usage
 
 
 class Manager(QtCore.QObject):
@@ -132,10 +274,15 @@ class Manager(QtCore.QObject):
     abort_returned = QtCore.QSignal(object)
     log = QtCore.QSignal(object)
 
-    def __init__(self, plot, browser, port=5888, log_level=logging.INFO, parent=None):
+    def __init__(self, plot, browser, port=5888, log_level=logging.INFO,
+                 memory_budget=256 * 2**20, parent=None):
         super().__init__(parent)
 
         self.experiments = ExperimentQueue()
+        self.memory = ExperimentMemory(plot, memory_budget, parent=self)
+        self._memory_timer = QtCore.QTimer()
+        self._memory_timer.timeout.connect(self.memory.enforce)
+        self._memory_timer.start(1000)
         self._worker = None
         self._running_experiment = None
         self._monitor = None
@@ -163,7 +310,7 @@ class Manager(QtCore.QObject):
 
     def _update_status(self, status):
         if self.is_running():
-            self._running_experiment.procedure.status = status
+            self.experiments.update_status(self._running_experiment, status)
             self._running_experiment.browser_item.setStatus(status)
 
     def _update_log(self, record):
@@ -175,6 +322,7 @@ class Manager(QtCore.QObject):
         self.plot.addItem(experiment.curve)
         self.browser.add(experiment)
         self.experiments.append(experiment)
+        self.memory.show(experiment)
 
     def queue(self, experiment):
         """ Adds an experiment to the queue.
@@ -191,6 +339,7 @@ class Manager(QtCore.QObject):
         """ Removes an Experiment
         """
         self.experiments.remove(experiment)
+        self.memory.discard(experiment)
         self.browser.takeTopLevelItem(
             self.browser.indexOfTopLevelItem(experiment.browser_item))
         self.plot.removeItem(experiment.curve)
@@ -213,8 +362,12 @@ class Manager(QtCore.QObject):
                 log.debug("Manager is initiating the next experiment")
                 experiment = self.experiments.next()
                 self._running_experiment = experiment
+                self.memory.touch(experiment)
 
                 self._worker = Worker(experiment.results, port=self.port, log_level=self.log_level)
+                if isinstance(experiment.curve, BufferedResultsCurve):
+                    # plot from the buffer the points are emitted to instead of re-reading the data file
+                    experiment.curve.attach(self._worker.buffer.name)
 
                 self._monitor = Monitor(self._worker.monitor_queue)
                 self._monitor.setObjectName('MANAGER_MONITOR')
@@ -234,16 +387,17 @@ class Manager(QtCore.QObject):
             self.running.emit(self._running_experiment)
 
     def _clean_up(self):
-        #print("PROCESS WORKER join")
-        self._worker.join()
-        #print("PROCESS WORKER delete")
-        sleep(0.1)
-        del self._worker
-        #print("PROCESS MONITOR delete")
-        del self._monitor
-        #print("PROCESS WORKER is none")
-        sleep(0.1)
-        self._worker = None
+        with TRACER.span('manager cleanup', 'gui'):
+            #print("PROCESS WORKER join")
+            self._worker.join()
+            #print("PROCESS WORKER delete")
+            sleep(0.1)
+            del self._worker
+            #print("PROCESS MONITOR delete")
+            del self._monitor
+            #print("PROCESS WORKER is none")
+            sleep(0.1)
+            self._worker = None
         #print("MANAGER running experiment is none")
         self._running_experiment = None
         #print("MANAGER cleanup exit")
@@ -264,9 +418,7 @@ class Manager(QtCore.QObject):
     def _finish(self):
         log.debug("Manager's running experiment has finished")
         experiment = self._running_experiment
-        print("MANAGER cleanup")
         self._clean_up()
-        print("MANAGER cleanup return")
         experiment.browser_item.setProgress(100.)
         experiment.curve.update()
         self.finished.emit(experiment)
@@ -8,6 +8,9 @@ import numpy as np
 
 from pymeasure.experiment import Procedure, Results, IntegerParameter, Parameter, FloatParameter
 
+from logs import PointLog, fields
+from quality import plan_quality, default_quality, reset_quality, plan_range, current_range, next_range, OVERRANGE
+
 import logging
 log = logging.getLogger('')
 log.addHandler(logging.NullHandler())
@@ -15,6 +18,34 @@ log.addHandler(logging.NullHandler())
 
 
 
+def bias_voltages(V_bias, V_bias_steps, endpoint=True):
+    # bias voltages of a pretest in V (inputs in mV), from 0 up to V_bias
+    stop = V_bias+V_bias_steps if endpoint else V_bias
+    return np.arange(0, stop, V_bias_steps)*1e-3
+
+
+def gate_voltages(V_g_min, V_g_max, V_g_steps):
+    # gate voltages of a sweep in V (V_g_steps in mV): 0 down to V_g_min, up to V_g_max, back to 0
+    V_gate_list_down = np.linspace(0, V_g_min, num = int(-V_g_min/(V_g_steps*2e-3)+1))
+    V_gate_list_fullrange = np.linspace(V_g_min, V_g_max, num = int((V_g_max-V_g_min)/(V_g_steps*1e-3)+1))
+    V_gate_list_return = np.linspace(V_g_max, 0, num = int(V_g_max/(V_g_steps*2e-3)+1))
+    return np.concatenate((V_gate_list_down, V_gate_list_fullrange, V_gate_list_return)) # Include the reverse
+
+
+
+
+def pretest_values(results):
+    # parameter values of the measurement from the pretest results (analysis.PRETEST_METRICS)
+    values = {}
+    for name, column in (('I_pretest_max', 'Max current (A)'), ('I_pretest_min', 'Min current (A)')):
+        value = results.get(column)
+        if value is not None and np.isfinite(value):
+            values[name] = float(value)
+    return values
+
+
+
+
 class PreTestIV(Procedure):
     # input parameters
     V_bias = FloatParameter('Bias Voltage maximum', units='mV', default=100)
@@ -30,11 +61,13 @@ class PreTestIV(Procedure):
     def __init__(self, parent_window=None):
         super().__init__()
         self.parent_window = parent_window
+        self.instruments_configured = False
     
-    def startup(self):
-        print("\t\t\t\tstarting device pretest")
+    def configure_instruments(self):
+        # ranges and compliance only, the output stays off: the orchestrator runs this while the
+        # stages are still moving to the device
         log.info("Setting up instruments for PreTestIV")
-        current_range = I_bias_limit*1e-6       # to uA from input
+        current_range = self.I_bias_limit*1e-6  # to uA from input
         for limit in (200, 20, 2, 0.2, 0.02):
             if limit > self.V_bias*1e-3:        # to mV from input
                 source_limit = limit
@@ -42,18 +75,25 @@ class PreTestIV(Procedure):
                 break
         self.parent_window.sourcemeter.apply_voltage(voltage_range=source_limit, compliance_current=current_range)
         self.parent_window.sourcemeter.measure_current(nplc=self.NPLC_pretest, current=current_range+0.05*current_range, auto_range=False)
+        reset_quality(self.parent_window.sourcemeter)   # filter and autozero of the previous sweep
+        self.instruments_configured = True
+    
+    def startup(self):
+        log.info("Starting device pretest")
+        if not self.instruments_configured:
+            self.configure_instruments()
         self.parent_window.sourcemeter.enable_source()
         
         sleep(1)
     
     def execute(self):
-        V_bias_list = np.arange(0, self.V_bias+self.V_bias_steps, self.V_bias_steps)
-        V_bias_list *= 1e-3                     # to mV from input
+        V_bias_list = bias_voltages(self.V_bias, self.V_bias_steps)
         steps = len(V_bias_list)
+        points = PointLog(log)
         
         log.info("Starting to ramp up the bias")
         for i, voltage in enumerate(V_bias_list):
-            log.debug("Measuring current: %g mV" % voltage)
+            points.debug("Measuring current: %g V", voltage)
 
             #self.parent_window.sourcemeter.source_current = voltage
             self.parent_window.sourcemeter.ramp_to_voltage(voltage)
@@ -74,9 +114,8 @@ class PreTestIV(Procedure):
             }
             self.emit('results', data)
             self.emit('progress', 100.*i/steps)
-            if current > self.I_bias_limit:
-                log.info("PreTest abort, current too high!")
-                print("PreTest abort, current too high!")
+            if current > self.I_bias_limit*1e-6:     # to uA from input
+                log.warning("PreTest abort, current too high!", extra=fields(voltage=voltage, current=current))
                 break
             if self.should_stop():
                 log.warning("Catch stop command in procedure")
@@ -85,15 +124,14 @@ class PreTestIV(Procedure):
     def shutdown(self):
         if self.max_current < 10e-9:
             self.parent_window.current_device_passed_pretest.clear()
-            print("\t\t\t\t\t\t\t\t\t\tdevice failed")
-            print("\t\t\t\t\t\t\t\t\t\tsafe sweep down")
+            log.info("Device failed pretest, safe sweep down", extra=fields(max_current=self.max_current))
             self.parent_window.sourcemeter.ramp_to_voltage(0)
             sleep(1)
             self.parent_window.sourcemeter.disable_source()
-            print("\t\t\t\t\t\t\t\t\t\tPreTest shutdown finished")
+            log.info("PreTest shutdown finished")
         else:
             self.parent_window.current_device_passed_pretest.set()
-            print("\t\t\t\t\t\t\t\tgood device")
+            log.info("Device passed pretest", extra=fields(max_current=self.max_current))
 
 
 
@@ -117,17 +155,70 @@ class Gatesweep(Procedure):
     delay = FloatParameter('Delay Time', units='s', default=0.2)
     NPLC_pretest = IntegerParameter('Pretest NPLC', default=1)
     NPLC_gatesweep = IntegerParameter('Gatesweep NPLC', default=1)
+    I_noise_target = FloatParameter('Current noise target', units='pA', default=0)    # 0: no planning, NPLC as set by the pretest
+    point_time_budget = FloatParameter('Time budget per point', units='s', default=0.2)
+    resolution = FloatParameter('Resolution target', units='%', default=0)     # of the smallest pretest current, 0: off
+    range_headroom = FloatParameter('Range headroom', default=10)               # range: largest pretest current times this
+    I_pretest_max = FloatParameter('Pretest max current', units='A', default=0)    # set by the scan (pretest_values())
+    I_pretest_min = FloatParameter('Pretest min current', units='A', default=0)
+    measurement_quality = Parameter('Measurement settings', default='')    # chosen by plan_measurement(), recorded in the header
 
     DATA_COLUMNS = ['Gate Voltage (V)', 'Current (A)']
     
     def __init__(self, parent_window=None):
         super().__init__()
         self.parent_window = parent_window
+        self.quality = None
+        self.measure_range = None
+
+    def plan_measurement(self):
+        # range, NPLC, averaging filter and autozero (quality.py), chosen before the data file is
+        # written so its header records them: with a resolution target from the pretest currents
+        # (range from the largest, noise target from the smallest), else for the noise target
+        limit = self.I_bias_limit*1e-6*1.05
+        targets = []
+        if self.I_noise_target > 0:
+            targets.append(self.I_noise_target*1e-12)
+        if self.resolution > 0 and self.I_pretest_max > 0:
+            measure_range = plan_range(self.I_pretest_max, self.range_headroom, limit)
+            if self.I_pretest_min > 0:
+                targets.append(self.resolution*1e-2*self.I_pretest_min)
+        else:
+            measure_range = current_range(limit)
+        if not targets:
+            return
+        V_gate_list = gate_voltages(self.V_g_min, self.V_g_max, self.V_g_steps)
+        self.quality = plan_quality(measure_range, min(targets), self.point_time_budget, len(V_gate_list))
+        q = self.quality
+        self.measurement_quality = "NPLC %g, filter %s, autozero %s, range %g A, expected noise %.3g pA, %.3g s/point" % (
+            q.nplc, q.filter_text(), q.autozero, q.current_range, q.noise*1e12, q.point_time)
+
+    def _measure_current(self):
+        # reading of the current, taken again one range up while it is at the top of the range
+        sourcemeter = self.parent_window.sourcemeter
+        current = sourcemeter.current
+        if self.quality is None:
+            return current
+        top = current_range(self.I_bias_limit*1e-6*1.05)
+        while abs(current) >= OVERRANGE*self.measure_range and self.measure_range < top:
+            self.measure_range = next_range(self.measure_range)
+            log.info("Current range up", extra=fields(range=self.measure_range, current=current))
+            sourcemeter.write(":SENS:CURR:RANG %g" % self.measure_range)
+            current = sourcemeter.current
+        return current
 
     def startup(self):
         log.info("Setting up instruments for Gatesweep")
         #self.parent_window.sourcemeter.apply_voltage(voltage_range=10, compliance_current=0.1)
         #self.parent_window.sourcemeter.measure_current(nplc=self.NPLC, current=1.05e-4, auto_range=False)
+        if self.quality is None:
+            self.plan_measurement()
+        if self.quality is not None:
+            log.info("Measurement settings: %s", self.measurement_quality)
+            self.quality.apply(self.parent_window.sourcemeter)
+            self.measure_range = self.quality.current_range
+        else:                   # not planned: range of the current limit, NPLC of the pretest
+            default_quality(current_range(self.I_bias_limit*1e-6*1.05), self.NPLC_pretest).apply(self.parent_window.sourcemeter)
         if not self.parent_window.sourcemeter.source_enabled:
             self.parent_window.sourcemeter.enable_source()
         
@@ -137,48 +228,45 @@ class Gatesweep(Procedure):
         sleep(1)
 
     def execute(self):
-        V_gate_list_down = np.linspace(0, self.V_g_min, num = int(-self.V_g_min/(self.V_g_steps*2e-3)+1))
-        V_gate_list_fullrange = np.linspace(self.V_g_min, self.V_g_max, num = int((self.V_g_max-self.V_g_min)/(self.V_g_steps*1e-3)+1))
-        V_gate_list_return = np.linspace(self.V_g_max, 0, num = int(self.V_g_max/(self.V_g_steps*2e-3)+1))
-        V_gate_list = np.concatenate((V_gate_list_down, V_gate_list_fullrange, V_gate_list_return)) # Include the reverse
+        V_gate_list = gate_voltages(self.V_g_min, self.V_g_max, self.V_g_steps)
         steps = len(V_gate_list)
+        points = PointLog(log)
         
         log.info("Ramping to bias voltage")
-        self.parent_window.sourcemeter.ramp_to_voltage(self.V_bias)
+        self.parent_window.sourcemeter.ramp_to_voltage(self.V_bias*1e-3)   # to mV from input
         
         log.info("Starting to sweep the gate")
         for i, voltage in enumerate(V_gate_list):
-            log.debug("Measuring current: %g mV" % voltage)
+            points.debug("Measuring current: %g V", voltage)
 
             #self.parent_window.sourcemeter.source_current = voltage
             self.parent_window.gate.ramp_to_voltage(voltage)
             sleep(self.delay)
             
-            current = self.parent_window.sourcemeter.current
+            current = self._measure_current()
             
             data = {
-                'Voltage (V)': voltage,
+                'Gate Voltage (V)': voltage,
                 'Current (A)': current
             }
             self.emit('results', data)
             self.emit('progress', 100.*i/steps)
-            if current > self.I_bias_limit:
-                log.info("Gatesweep abort, current too high!")
-                print("gatesweep abort, current too high!")
+            if current > self.I_bias_limit*1e-6:     # to uA from input
+                log.warning("Gatesweep abort, current too high!", extra=fields(gate_voltage=voltage, current=current))
                 break
             if self.should_stop():
                 log.warning("Catch stop command in procedure")
                 break
 
     def shutdown(self):
-        print("finished measurement, safe sweep down")
+        log.info("Finished measurement, safe sweep down")
         self.parent_window.sourcemeter.ramp_to_voltage(0)
         self.parent_window.gate.ramp_to_voltage(0)
         self.parent_window.sourcemeter.disable_source()
         self.parent_window.gate.disable_source()
-        print("Gatesweep shutdown finished")
-        logmsg = "Finished device "+self.devicename+"\n"
-        log.info(logmsg)
+        reset_quality(self.parent_window.sourcemeter)     # pretests measure without filter, with autozero
+        log.info("Gatesweep shutdown finished")
+        log.info("Finished device %s", self.devicename)
 
 
 
@@ -204,15 +292,14 @@ class RandomFakePreTest(Procedure):
         random.seed(self.seed)
     
     def execute(self):
-        V_bias_list = np.arange(0, self.V_bias, self.V_bias_steps)
-        V_bias_list *= 1e-3 # to mV from input
+        V_bias_list = bias_voltages(self.V_bias, self.V_bias_steps, endpoint=False)
         steps = len(V_bias_list)
+        points = PointLog(log)
         
-        print("running pretest")
         log.info("Starting to ramp up the bias")
         a = random.random()
         for i, voltage in enumerate(V_bias_list):
-            log.debug("Measuring current: %g mV" % voltage)
+            points.debug("Measuring current: %g V", voltage)
 
             sleep(self.delay)
             
@@ -234,17 +321,15 @@ class RandomFakePreTest(Procedure):
             if self.should_stop():
                 log.warning("Catch stop command in procedure")
                 break
-        print("pretest current: ", self.max_current)
+        log.info("Pretest done", extra=fields(max_current=self.max_current))
     
     def shutdown(self):
         if self.max_current < 50*self.V_bias*1e-3 or self.should_stop():
             self.parent_window.current_device_passed_pretest.clear()
-            print("\t--> failed")
-            #print("\t\t\t\t\t\t\t\t\t\tsafe sweep down")
-            print("PreTest shutdown")
+            log.info("Device failed pretest")
         else:
             self.parent_window.current_device_passed_pretest.set()
-            print("\t--> passed")
+            log.info("Device passed pretest")
 
 
 
@@ -281,13 +366,10 @@ class TestProcedure(Procedure):
         random.seed(self.seed)
 
     def execute(self):
-        V_gate_list_down = np.linspace(0, self.V_g_min, num = int(-self.V_g_min/(self.V_g_steps*2e-3)+1))
-        V_gate_list_fullrange = np.linspace(self.V_g_min, self.V_g_max, num = int((self.V_g_max-self.V_g_min)/(self.V_g_steps*1e-3)+1))
-        V_gate_list_return = np.linspace(self.V_g_max, 0, num = int(self.V_g_max/(self.V_g_steps*2e-3)+1))
-        V_gate_list = np.concatenate((V_gate_list_down, V_gate_list_fullrange, V_gate_list_return)) # Include the reverse
+        V_gate_list = gate_voltages(self.V_g_min, self.V_g_max, self.V_g_steps)
         steps = len(V_gate_list)
+        points = PointLog(log)
         
-        print("running measurement")
         log.info("Starting to generate numbers")
         a = random.random()
         b = random.random()
@@ -299,7 +381,7 @@ class TestProcedure(Procedure):
                 'Gate Voltage (V)': voltage,
                 'Current (A)': current
             }
-            log.debug("Produced numbers: %s" % data)
+            points.debug("Produced numbers: %s", data)
             self.emit('results', data)
             self.emit('progress', 100*i/steps)
             sleep(self.delay)
@@ -308,7 +390,5 @@ class TestProcedure(Procedure):
                 break
 
     def shutdown(self):
-        print("Finished device "+self.devicename+", safe sweep down")
-        logmsg = "Finished device "+self.devicename
-        log.info(logmsg)
+        log.info("Finished device %s, safe sweep down", self.devicename)
 
@@ -0,0 +1,471 @@
+# asyncio orchestration of automated scans
+# stage moves, instrument calls and procedures are awaitables with timeouts, an abort cancels the
+# scan task instead of setting flags, and independent steps of a device run concurrently (e.g. the
+# instruments are configured for the pretest while the stages are still moving to the device)
+# no Qt imports in here, the GUI attaches through engine.ScanThread
+
+import os
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from headless import HeadlessScan, record_device, EXIT_OK, EXIT_FAILED, EXIT_ABORTED
+from channels import ChannelStation, SharedGate, open_channels, landings
+from tracing import TRACER
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+MOVE_TIMEOUT = 120          # s, one stage move (lift, travel, lower)
+INSTRUMENT_TIMEOUT = 30     # s, one instrument call outside of a procedure
+STOP_TIMEOUT = 60           # s, for a Worker to shut down its procedure after stop()
+POLL_INTERVAL = 0.02        # s, stage status polling
+MOVE_STARTUP = 0.3          # s, controllers report a speed only after a move has started
+SETTLE_TIME = 1.            # s, probes settle after the stages arrived
+
+
+class MoveInterrupted(Exception):
+    '''
+    The stage movement was stopped by the operator (emergency stop key).
+    '''
+    pass
+
+
+
+class StepTimeout(asyncio.TimeoutError):
+    '''
+    A stage move or an instrument call did not finish in time, the message names which.
+    '''
+    pass
+
+
+
+async def concurrently(*awaitables):
+    '''
+    Runs awaitables concurrently and returns their results in order. If one of them raises, the
+    others are cancelled (a cancelled stage move stops the motors) and its exception is raised.
+    '''
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    if errors:
+        # the error that stopped the others, not the cancellation of the others
+        raise next((e for e in errors if not isinstance(e, asyncio.CancelledError)), errors[0])
+    return outcomes
+
+
+
+class AsyncStages(object):
+    '''
+    Awaitable moves of a StageStack (or NoStages). All libximc calls run one at a time in a thread
+    of their own; waiting for the motors is done by polling the controller status from the event
+    loop, so other operations can run while the stages move.
+
+    :param stages: StageStack
+    :param poll_interval: interval of the status polling while a move is running
+    '''
+
+    def __init__(self, stages, poll_interval=POLL_INTERVAL):
+        self.stages = stages
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stages')
+
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+
+    async def _wait_stopped(self, *axes):
+        emergency = getattr(self.stages, 'stage_emergency_stop_call', None)
+        await asyncio.sleep(MOVE_STARTUP)
+        while True:
+            if emergency is not None and emergency.is_set():
+                raise MoveInterrupted("stage emergency stop")
+            moving = False
+            for axis in axes:
+                moving = moving or await self._call(self.stages.axis_moving, axis)
+            if not moving:
+                return
+            await asyncio.sleep(self.poll_interval)
+
+
+    async def _move(self, coords):
+        stages = self.stages
+        await self._call(stages.speed_up)
+        try:
+            # same path as StageStack.goto_coords: safe height, horizontal, down to the device
+            with TRACER.span('Z lift', 'stages'):
+                await self._call(stages.move_axis, 'z', [stages._automovement_safe_height, 0])
+                await self._wait_stopped('z')
+            with TRACER.span('XY move', 'stages'):
+                await self._call(stages.move_axis, 'x', coords[0])
+                await self._call(stages.move_axis, 'y', coords[1])
+                await self._wait_stopped('x', 'y')
+            with TRACER.span('Z descent', 'stages'):
+                await self._call(stages.move_axis, 'z', coords[2])
+                await self._wait_stopped('z')
+        finally:
+            await self._call(stages.slow_down)
+        with TRACER.span('settle', 'stages'):
+            await asyncio.sleep(SETTLE_TIME)
+
+
+    async def move_to(self, coords, timeout=MOVE_TIMEOUT):
+        '''
+        Moves the stages to coords. Raises StepTimeout if they do not arrive in time and
+        MoveInterrupted on an emergency stop. Cancelling the move (or a timeout) stops all motors.
+        '''
+        try:
+            await asyncio.wait_for(self._move(coords), timeout)
+        except asyncio.TimeoutError:
+            await self.stop()
+            raise StepTimeout("stages did not arrive in time")
+        except (asyncio.CancelledError, MoveInterrupted):
+            await self.stop()
+            raise
+
+
+    async def stop(self):
+        await self._call(self.stages.stage_movement_emergency_stop)
+
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+
+class InstrumentChannel(object):
+    '''
+    Awaitable calls to the instruments outside of procedures. Calls run one at a time in a thread
+    of the channel (VISA sessions must not be used concurrently) and each has a timeout. A call
+    that timed out cannot be interrupted, it finishes in the background before the next one starts.
+
+    :param timeout: default timeout of a call
+    '''
+
+    def __init__(self, timeout=INSTRUMENT_TIMEOUT):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='instruments')
+
+
+    async def call(self, fn, *args, timeout=None):
+        '''
+        Returns fn(*args), called in the thread of the channel. Raises StepTimeout if the call does
+        not return in time.
+        '''
+        future = asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+        try:
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise StepTimeout("instrument call "+getattr(fn, '__qualname__', repr(fn))+" did not return in time")
+
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+
+class AsyncScan(HeadlessScan):
+    '''
+    Runs the devices of one scan on asyncio (HeadlessScan: shared state, progress, events, plan):
+    move, pretest, measurement if the pretest passed, writing the scan journal, the summary table
+    and the catalog. run(), measure_device() and run_procedure() are coroutines. The instruments of the pretest are configured while the stages move to a device and settle
+    (procedures with a configure_instruments() method), procedures are awaited with the recipe
+    timeout, and abort() cancels the scan task, which stops the stages and the running procedure.
+
+    With measurement channels in the recipe (see channels.py) the devices contacted in one landing
+    are measured concurrently (measure_landing()), one procedure and data file per device.
+
+    abort() and abort_current() may be called from any thread.
+    '''
+
+    def __init__(self, recipe, journal, station, stages, out=None, listener=None):
+        super().__init__(recipe, journal, station, stages, out, listener)
+        self.motion = AsyncStages(stages)
+        self.instruments = InstrumentChannel()
+        self.channels = open_channels(recipe.get('channels'))
+        self._workers = set()
+        self._loop = None
+        self._task = None
+
+
+    def abort(self):
+        self._abort.set()
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._cancel)
+
+
+    def _cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+    def abort_current(self):
+        '''
+        Stops the running procedures only, the scan continues with the next device.
+        '''
+        for worker in list(self._workers):
+            worker.stop()
+
+
+    async def _join(self, worker):
+        while worker.is_alive():
+            await asyncio.sleep(0.05)
+
+
+    async def _stop_worker(self, worker):
+        worker.stop()
+        try:
+            await asyncio.wait_for(self._join(worker), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.error("Procedure %s did not stop", worker.results.procedure.__class__.__name__)
+
+
+    async def run_procedure(self, procedure, datafile, listeners=(), stream=False, phase=None):
+        '''
+        Runs one procedure in a Worker and awaits it. Returns the final procedure status, FAILED on
+        timeout. Cancelling stops the procedure. phase names the procedure in the timing trace.
+        '''
+        from pymeasure.experiment import Procedure, Results
+        from workers import Worker
+        if hasattr(procedure, 'plan_measurement'):     # settings go into the header of the data file
+            procedure.plan_measurement()
+        with TRACER.span('results header', 'io'):
+            results = Results(procedure, datafile)
+        worker = Worker(results)
+        worker.trace_name = phase
+        worker.results_listeners.extend(listeners)
+        if stream and self.listener is not None:
+            self.notify('procedure', {'datafile': datafile, 'parameters': procedure.parameter_values(),
+                                       'buffer': worker.buffer.name})
+            worker.progress_listeners.append(lambda progress: self.notify('progress', datafile, progress))
+        self._workers.add(worker)
+        worker.start()
+        try:
+            await asyncio.wait_for(self._join(worker), self.recipe['timeout'])
+            status = procedure.status
+        except asyncio.TimeoutError:
+            log.error("Procedure %s timed out", procedure.__class__.__name__)
+            await self._stop_worker(worker)
+            status = Procedure.FAILED
+        except asyncio.CancelledError:
+            await self._stop_worker(worker)
+            if stream:
+                self.notify('status', datafile, Procedure.ABORTED)
+            raise
+        finally:
+            self._workers.discard(worker)
+        if stream:
+            self.notify('status', datafile, status)
+        return status
+
+
+    async def configure(self, procedure):
+        if hasattr(procedure, 'configure_instruments'):
+            with TRACER.span('configure instruments', 'instruments'):
+                await self.instruments.call(procedure.configure_instruments)
+
+
+    async def measure_device(self, plan, i):
+        from pymeasure.experiment import Procedure
+        from analysis import DeviceAnalysis, PRETEST_METRICS, GATESWEEP_METRICS
+        from measurements import pretest_values
+        from scan import prepare_datafolder
+
+        devicename = plan.name(i)
+        datafolder = plan.datafolder(i)
+        if not plan.devices['in_bounds'][i]:
+            self.failures += 1
+            return 'out of bounds', {}
+        with TRACER.span('prepare folder', 'io'):
+            prepare_datafolder(datafolder)
+        coordinates = plan.coordinates(i)
+
+        procedure = plan.procedure(self.procedure_class_pretest, i, self.station)
+        await concurrently(self.motion.move_to(coordinates), self.configure(procedure))
+        self.journal.device_moved(devicename, coordinates)
+
+        datafile = os.path.join(datafolder, 'pretest-IV.dat')
+        analysis = DeviceAnalysis(PRETEST_METRICS, procedure.DATA_COLUMNS[0])
+        status = await self.run_procedure(procedure, datafile, [analysis], phase='pretest')
+        results = analysis.results()
+        if status != Procedure.FINISHED:
+            if status != Procedure.ABORTED:         # abort_current() is not a failure
+                self.failures += 1
+            return 'pretest '+Procedure.STATUS_STRINGS[status], results
+        passed = self.station.current_device_passed_pretest.is_set()
+        self.journal.device_pretest(devicename, passed, datafile)
+        results['Pretest'] = float(passed)
+        if not passed:
+            return 'failed pretest', results
+
+        procedure = plan.procedure(self.procedure_class, i, self.station, pretest_values(results))
+        datafile = os.path.join(datafolder, 'gatetrace.dat')
+        analysis = DeviceAnalysis(GATESWEEP_METRICS, procedure.DATA_COLUMNS[0])
+        status = await self.run_procedure(procedure, datafile, [analysis], stream=True, phase='sweep')
+        self.journal.device_measured(devicename, status, datafile)
+        results.update(analysis.results())
+        if status not in (Procedure.FINISHED, Procedure.ABORTED):
+            self.failures += 1
+        return Procedure.STATUS_STRINGS[status].lower(), results
+
+
+    async def measure_landing(self, plan, landing):
+        '''
+        Measures the devices of one landing (channels.landings(): [(channel, plan index), ...])
+        concurrently: one move to the device of the first channel, the pretests of all devices on
+        their channels, then the measurement of the devices that passed, on a gate shared by their
+        channels. Returns [(plan index, outcome, results), ...] in channel order.
+        '''
+        from pymeasure.experiment import Procedure
+        from analysis import DeviceAnalysis, PRETEST_METRICS, GATESWEEP_METRICS
+        from measurements import pretest_values
+        from scan import prepare_datafolder
+
+        first = landing[0][1]
+        if not plan.devices['in_bounds'][first]:
+            self.failures += 1
+            return [(first, 'out of bounds', {})]
+        stations, procedures, datafiles, analyses = {}, {}, {}, {}
+        for channel, i in landing:
+            with TRACER.span('prepare folder', 'io'):
+                prepare_datafolder(plan.datafolder(i))
+            stations[i] = ChannelStation(channel.sourcemeter)
+            procedures[i] = plan.procedure(self.procedure_class_pretest, i, stations[i])
+            datafiles[i] = os.path.join(plan.datafolder(i), 'pretest-IV.dat')
+            analyses[i] = DeviceAnalysis(PRETEST_METRICS, procedures[i].DATA_COLUMNS[0])
+        await concurrently(self.motion.move_to(plan.coordinates(first)),
+                           *(self.configure(procedures[i]) for channel, i in landing))
+        for channel, i in landing:
+            self.journal.device_moved(plan.name(i), plan.coordinates(i))
+
+        statuses = await asyncio.gather(*(self.run_procedure(procedures[i], datafiles[i], [analyses[i]], phase='pretest')
+                                          for channel, i in landing))
+        outcomes = {}
+        passed = []
+        for (channel, i), status in zip(landing, statuses):
+            results = analyses[i].results()
+            if status != Procedure.FINISHED:
+                if status != Procedure.ABORTED:     # abort_current() is not a failure
+                    self.failures += 1
+                outcomes[i] = ('pretest '+Procedure.STATUS_STRINGS[status], results)
+                continue
+            device_passed = stations[i].current_device_passed_pretest.is_set()
+            self.journal.device_pretest(plan.name(i), device_passed, datafiles[i])
+            results['Pretest'] = float(device_passed)
+            outcomes[i] = ('failed pretest', results)
+            if device_passed:
+                passed.append((channel, i))
+        if not passed:
+            return [(i,)+outcomes[i] for channel, i in landing]
+
+        gate = SharedGate(self.station.gate, [channel.name for channel, i in passed])
+        for channel, i in passed:
+            stations[i].gate = gate.view(channel.name)
+            procedures[i] = plan.procedure(self.procedure_class, i, stations[i], pretest_values(outcomes[i][1]))
+            datafiles[i] = os.path.join(plan.datafolder(i), 'gatetrace.dat')
+            analyses[i] = DeviceAnalysis(GATESWEEP_METRICS, procedures[i].DATA_COLUMNS[0])
+
+        async def sweep(channel, i):
+            try:
+                return await self.run_procedure(procedures[i], datafiles[i], [analyses[i]], stream=True, phase='sweep')
+            finally:
+                await self.instruments.call(gate.leave, channel.name)  # a failed procedure must not hold up the others
+
+        statuses = await asyncio.gather(*(sweep(channel, i) for channel, i in passed))
+        for (channel, i), status in zip(passed, statuses):
+            self.journal.device_measured(plan.name(i), status, datafiles[i])
+            results = outcomes[i][1]
+            results.update(analyses[i].results())
+            if status not in (Procedure.FINISHED, Procedure.ABORTED):
+                self.failures += 1
+            outcomes[i] = (Procedure.STATUS_STRINGS[status].lower(), results)
+        return [(i,)+outcomes[i] for channel, i in landing]
+
+
+    def write_trace(self):
+        TRACER.disable()
+        TRACER.device = None
+        try:
+            trace, summary = TRACER.write(self.journal.folder)
+        except OSError:
+            log.error("Could not write timing trace", exc_info=True)
+            return
+        self.progress('trace', trace, summary)
+        for line in TRACER.format_summary().splitlines():
+            self.progress('timing', line)
+
+
+    async def run(self):
+        from analysis import WaferSummary, PRETEST_METRICS, GATESWEEP_METRICS
+        from estimate import estimate_scan, LiveEstimate
+
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        if self.recipe.get('trace'):
+            TRACER.clear()
+            TRACER.enable()
+
+        plan = self.plan()
+        total = len(plan)
+        pending = plan.pending()
+        summary = WaferSummary(self.journal.folder, WaferSummary.metric_columns(PRETEST_METRICS+GATESWEEP_METRICS))
+        try:
+            eta = LiveEstimate(estimate_scan(plan, self.stages, self.recipe['pretest'], self.recipe['procedure']))
+        except ValueError:                      # procedures without a duration model
+            eta = None
+
+        done = total-len(pending)
+        fields = ['scan', self.journal.folder, str(done)+"/"+str(total)+" devices already completed"]
+        self.progress(*(fields+[eta.format()] if eta is not None else fields))
+        try:
+            for landing in landings(plan, self.channels):
+                if self._abort.is_set():
+                    raise asyncio.CancelledError()
+                start = time.perf_counter()
+                TRACER.device = plan.name(landing[0][1])
+                with TRACER.span('device', 'device'):
+                    if self.channels:
+                        outcomes = await self.measure_landing(plan, landing)
+                    else:
+                        outcomes = [(landing[0][1],)+await self.measure_device(plan, landing[0][1])]
+                duration = (time.perf_counter()-start)/len(outcomes)
+                for i, outcome, results in outcomes:
+                    devicename = plan.name(i)
+                    with TRACER.span('summary', 'io'):
+                        summary.add(devicename, list(plan.indices(i)), results)
+                    with TRACER.span('catalog', 'io'):
+                        record_device(self.journal, plan, i, outcome, results)
+                    self.notify('device', plan.device_info(i), results)
+                    done += 1
+                    fields = [str(done)+"/"+str(total), devicename, outcome, "%.1f s" % duration]
+                    if eta is not None:
+                        eta.device_done(duration, results.get('Pretest', 0) > 0)
+                        fields.append(eta.format())
+                    self.progress(*fields)
+
+            self.journal.write('finished')
+            await self.motion.move_to(self.stages._coordinates_center)
+        except (asyncio.CancelledError, MoveInterrupted):
+            self.progress('aborted', "resume with --resume", self.journal.folder)
+            return EXIT_ABORTED
+        except asyncio.TimeoutError as e:
+            self.progress('aborted', str(e) or "timed out", self.journal.folder)
+            return EXIT_ABORTED
+        finally:
+            self.motion.close()
+            self.instruments.close()
+            if self.recipe.get('trace'):
+                self.write_trace()
+        self.progress('finished', str(len(pending))+" devices measured", str(self.failures)+" failures")
+        return EXIT_FAILED if self.failures else EXIT_OK
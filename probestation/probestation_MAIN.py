@@ -8,7 +8,7 @@ python gui.py
 
 
 '''------------------------------------------------------------------------------------------------
-instrument addresses
+instrument addresses: VISA address or {'model': ..., 'serial': ...} (see instruments.py)
 ------------------------------------------------------------------------------------------------'''
 bias_source_meter_address = "USB0::0x05E6::0x2450::04305994::INSTR"
 gate_source_address = "USB0::0x05E6::0x2450::04305994::INSTR"
@@ -17,10 +17,9 @@ gate_source_address = "USB0::0x05E6::0x2450::04305994::INSTR"
 
 import sys
 import os
-from time import sleep
+import time
 from datetime import datetime as dt
 import pyqtgraph as pg
-from queue import Queue
 import threading
 
 import random
@@ -37,8 +36,15 @@ from pymeasure.experiment import Results
 from pymeasure.display.Qt import QtGui
 # modified pymeasure modules
 from windows import ManagedWindow
-from workers import QWorker, Worker
 from measurements import TestProcedure, RandomFakePreTest
+from journal import ScanJournal
+from scan import ScanPlan
+from estimate import estimate_scan, LiveEstimate
+from headless import BIAS_RAMP, GATE_RAMP
+from instruments import REGISTRY
+from orchestrator import AsyncScan
+from engine import EngineProcess, EngineMonitor, ScanThread
+from progress import TERMINAL
 
 
 
@@ -60,190 +66,225 @@ class MainWindow(ManagedWindow):
         )
         self.setWindowTitle('probestation')
         
-        self.pipeline = Queue(maxsize=10)       # queue to store tasks between producer and starter
-        
-        self.producer_done = threading.Event()  # thread safe flag: producer has finished creating all measurement tasks for current scan
-        self.producer_done.set()
-        self.starter_done = threading.Event()   # thread safe flag: starter has processed all measurement tasks for current scan
-        self.starter_done.set()
         self.current_device_passed_pretest = threading.Event()  # thread safe flag: decides if measurement is run on device, is set by pretest measurement
         
         # instruments
-        print("\nconnecting to instrument ", sourcemeter_address, " for bias")
-        try:
-            adapter_source = VISAAdapter(sourcemeter_address)
-            self.sourcemeter = Keithley2450(adapter_source, max_stepsize = 10e-3, max_units_per_second = 100e-3)
-        except:
-            print("WARNING: no bias instruments\n")
-        print("\nconnecting to instrument ", gate_address, " for gate")
-        try:
-            adapter_gate = VISAAdapter(gate_address)
-            self.gate = Keithley2450(adapter_gate, max_stepsize = 1e-3, max_units_per_second = 20e-3)
-        except:
-            print("WARNING: no gate instruments\n")
+        self.instrument_addresses = {'bias': sourcemeter_address, 'gate': gate_address}
+        self._connect_instruments()
         
+        self.eta = None                         # LiveEstimate of the running scan
+        self.device_started = None
+    
+    
+    def _connect_instruments(self):
+        '''
+        Opens bias and gate source meter (VISA address or model/serial, see instruments.py), on one
+        shared session if both are the same instrument. A missing instrument leaves its role None.
+        '''
+        from pymeasure.instruments.keithley import Keithley2450
+        for name, role, ramp in (('sourcemeter', 'bias', BIAS_RAMP), ('gate', 'gate', GATE_RAMP)):
+            spec = self.instrument_addresses[role]
+            try:
+                setattr(self, name, REGISTRY.instrument(spec, Keithley2450, **ramp))
+            except Exception:               # not connected, no VISA library, no matching instrument
+                log.warning("No %s instrument %s", role, spec, exc_info=True)
+                setattr(self, name, None)
+        if REGISTRY.discovery_time is not None:
+            log.info("Instrument discovery took %.2f s", REGISTRY.discovery_time)
+        if self.sourcemeter is not None and self.gate is not None and self.sourcemeter.adapter is self.gate.adapter:
+            log.warning("Bias and gate are the same instrument")
+    
+    
+    def _disconnect_instruments(self):
+        '''
+        Closes the VISA sessions of the window, so the engine process can open the instruments.
+        '''
+        REGISTRY.close()
+        self.sourcemeter = None
+        self.gate = None
 
 
-    def queue_experiment(self, procedure):
-        filename = os.path.join(procedure.datafolder, 'gatetrace.dat')
-
-        results = Results(procedure, filename)
-        experiment = self.new_experiment(results)
-
-        self.manager.queue(experiment)
+    def _estimate(self, parameters, completed=()):
+        # duration estimate of a scan with the current stage registration
+        plan = ScanPlan.from_parameters(parameters, '', completed)
+        plan.locate(self.stages)
+        return estimate_scan(plan, self.stages, self.procedure_class_pretest.__name__, self.procedure_class.__name__)
     
     
-    def start_scan(self):
+    def dry_run(self):
         '''
-        Callback for GUI 'Start' button.
-        Spawns two threads (one producer, one starter) for an automated scan of a sample.
+        Callback for GUI 'Dry Run' button.
+        Shows the estimated duration of a scan with the current inputs and the bounds check of the
+        stage coordinates of all devices.
         '''
-        self.event_abort.clear()
-        self._disable_inputs()
-        self.updateProgressBars(0,0)
-        
-        self.producer_done.clear()
-        self.prod_worker = QWorker('producer', self.producer, self.pipeline)
-        self.prod_worker.setObjectName('PRODUCER')
-        self.prod_worker.start()
-        
-        self.starter_done.clear()
-        self.kickoff_worker = QWorker('starter', self.starter, self.pipeline)
-        self.kickoff_worker.setObjectName('STARTER')
-        self.kickoff_worker.signals.procedure.connect(self.queue_experiment)
-        self.kickoff_worker.signals.progress.connect(self.updateProgressBars)
-        self.kickoff_worker.signals.finished.connect(self._enable_inputs)
-        self.kickoff_worker.start()
+        try:
+            estimate = self._estimate(self.make_procedure().parameter_values())
+        except ValueError as e:
+            log.warning("No scan estimate: %s", e)
+            return
+        log.info("Scan estimate:\n%s", estimate.format())
+        QtGui.QMessageBox.information(self, "Scan estimate", "<pre>"+estimate.format()+"</pre>")
     
     
-    def producer(self, queue):
+    def start_scan(self):
         '''
-        One of the two functions that are spawned in new threads once an automated scan of a
-        wafer is triggered.
-        Produces dictionaries of input parameters for the measurements that shall be performed on
-        each sample on the wafer. Each dictionary contains parameters for one sample. Dictionaries
-        are stored in the 'pipline' Queue.
+        Callback for GUI 'Start' button.
+        Creates a new scan folder and journal and starts the automated scan.
         '''
-        # read user input to parameters of tmp_instance of measurement Procedure
         tmpproc = self.make_procedure()
         curr_time = dt.now().strftime("%Y-%m-%d__%H-%M-%S")
         sample_string = curr_time+"__"+tmpproc.wafername
         folder = os.path.join(tmpproc.savepath, sample_string)
         os.makedirs(folder)
         
-        # update movement vectors of StageStack
-        self.stages.calc_coordinates_delta_hor(tmpproc.chipcols, tmpproc.devcols)
-        self.stages.calc_coordinates_delta_vert(tmpproc.chiprows, tmpproc.devrows)
+        journal = ScanJournal(folder)
+        journal.write_plan(tmpproc.parameter_values(), self.stages.registration())
+        self._launch_scan(journal)
+    
+    
+    def resume_scan(self):
+        '''
+        Callback for GUI 'Resume Scan' button.
+        Asks for the folder of an interrupted scan, restores its parameters and stage registration
+        from the scan journal and continues the scan in the same folder with the first device that
+        was not completed.
+        '''
+        folder = QtGui.QFileDialog.getExistingDirectory(self, "Select folder of interrupted scan",
+                                                        self.make_procedure().savepath)
+        if not folder:
+            return
+        try:
+            journal = ScanJournal.load(folder)
+        except (OSError, ValueError):
+            log.error('Could not resume scan', exc_info=True)
+            return
         
-        # produce parameter sets for actual measurements
-        for chipcol in range(tmpproc.chipcols):
-            for chiprow in range(tmpproc.chiprows):
-                for devcol in range(tmpproc.devcols):
-                    for devrow in range(tmpproc.devrows):
-                        #chipindex = str(chipcol)+str(chiprow)
-                        #devicename = self.CHIPSTRINGLIST.get(chipindex)+str(10*devcol+devrow+11)
-                        devicename = str(chipcol)+"_"+str(chiprow)+"_"+str(devcol)+"_"+str(devrow)
-                        device_string = "dev_"+devicename
-                        foldername = os.path.join(folder, device_string)
-                        procdir = {
-                            'wafername': tmpproc.wafername,
-                            'savepath': tmpproc.savepath,
-                            'devicename': devicename,
-                            'datafolder': foldername,
-                            'chipcols': chipcol,
-                            'chiprows': chiprow,
-                            'devcols': devcol,
-                            'devrows': devrow,
-                            'V_bias': tmpproc.V_bias,
-                            'V_bias_steps': tmpproc.V_bias_steps,
-                            'I_bias_limit' :tmpproc.I_bias_limit,
-                            'V_g_min': tmpproc.V_g_min,
-                            'V_g_max': tmpproc.V_g_max,
-                            'V_g_steps': tmpproc.V_g_steps,
-                            'delay': tmpproc.delay,
-                            'seed': 1000*chipcol+100*chiprow+10*devcol+devrow,
-                            'total_devices': [tmpproc.chiprows, tmpproc.chipcols*tmpproc.chiprows, tmpproc.devrows, tmpproc.devcols*tmpproc.devrows],
-                        }
-                        
-                        queue.put(procdir)
-                        
-                        # producer handling of abort
-                        if self.event_abort.is_set():
-                            #print("PRODUCER abort")
-                            del tmpproc
-                            self.producer_done.set()
-                            return False
+        procedure = self.procedure_class()
+        procedure.set_parameters(journal.parameters, except_missing=False)
+        self.set_parameters(procedure.parameter_objects())
+        self.stages.restore_registration(journal.registration)
         
-        del tmpproc
-        self.producer_done.set()
-        return True
-    
-    
-    def starter(self, queue):
-        '''
-        The second ot the two functions that are spawned in new threads once an automated scan of a
-        wafer is triggered.
-        Manages measurements and transitions between measurements. Picks up measurement tasks from
-        the 'pipline' Queue.
-        '''
-        while (not self.producer_done.is_set() or not queue.empty()):
-            procdir = queue.get()
-            os.makedirs(procdir['datafolder'])
-                
-            print("\n\nmoving to device", procdir['devicename'])
-            self.stages.stage_not_moving.clear()
-            self.stage_signals.sig_stage_moveTo_command.emit(self.stages.calc_dev_coordinates(procdir['chipcols'], procdir['chiprows'], procdir['devcols'], procdir['devrows']))
-            self.stages.stage_not_moving.wait()
-            #print("done")
-            sleep(1)
-            #print("STARTER abort check 1")
-            #print(self.event_abort.is_set())
-            if self.event_abort.is_set():
-                #print("STARTER abort after movement")
-                break
-                
-            #print("STARTER pretest")
-            procedure = self.procedure_class_pretest(parent_window=self)
-            procedure.set_parameters(procdir, except_missing=False)
-            datafile = os.path.join(procdir['datafolder'], 'pretest-IV.dat')
-            results = Results(procedure, datafile)
-            self.pretest_worker = Worker(results)
-            self.pretest_worker.start()
-            self.pretest_worker.join(timeout=3600)
-            sleep(1)
-            #print("STARTER abort check 2")
-            if self.event_abort.is_set():
-                #print("STARTER abort after pretest")
-                break
-                
-            #print("STARTER gatesweep")
-            if self.current_device_passed_pretest.isSet():
-                #print("\t\t\t\t\t\t\t\tqueue measurement")
-                procedure = self.procedure_class(parent_window=self)
-                procedure.set_parameters(procdir, except_missing=False)
-                self._has_no_measurement.clear()
-                self.kickoff_worker.signals.procedure.emit(procedure)
-                self._has_no_measurement.wait()
-            
-            progress_current_chip = (procdir['devcols']*procdir['total_devices'][2]+procdir['devrows']+1)/procdir['total_devices'][3]
-            progress_total = (procdir['chipcols']*procdir['total_devices'][0]+procdir['chiprows']+progress_current_chip)/procdir['total_devices'][1]
-            self.kickoff_worker.signals.progress.emit(int(progress_total*100) ,int(progress_current_chip*100))
-            
-            #print("STARTER abort check 3")
-            #print(self.event_abort.is_set())
-            if self.event_abort.is_set():
-                #print("STARTER abort after gatesweep")
-                break
+        completed = journal.completed_devices()
+        log.info("Resuming scan %s with %d devices already completed", folder, len(completed))
+        journal.write('resumed', completed=len(completed))
+        self._launch_scan(journal)
+    
+    
+    def _launch_scan(self, journal):
+        '''
+        Starts the automated scan of journal on the asyncio scan core (orchestrator.AsyncScan),
+        in a thread of the window or, if selected, in the engine process (see engine.py). Both
+        report back through the same signals.
+        '''
+        recipe = {
+            'parameters': journal.parameters,
+            'registration': journal.registration,
+            'pretest': self.procedure_class_pretest.__name__,
+            'procedure': self.procedure_class.__name__,
+            'instruments': self.instrument_addresses,
+            'timeout': 3600,
+            'trace': self.checkbox_trace.isChecked(),
+        }
+        try:
+            self.eta = LiveEstimate(self._estimate(journal.parameters, journal.completed_devices()))
+            self.label_eta.setText(self.eta.format())
+        except ValueError:
+            self.eta = None
+        self.device_started = time.perf_counter()
+        self.event_abort.clear()
+        self._disable_inputs()
+        self.updateProgressBars(0,0)
+        self._layout_wafermap(journal)
         
-        if not self.event_abort.is_set():
-            self.stages.stage_not_moving.clear()
-            self.stage_signals.sig_stage_moveTo_command.emit(self.stages._coordinates_center)
-            self.stages.stage_not_moving.wait()
-        #print("STARTER enable inputs")
-        #self._enable_inputs()
-        #print("STARTER set done flag")
-        self.starter_done.set()
-        return True
+        if self.checkbox_engine_process.isChecked():
+            # the engine process opens stages and instruments itself
+            self.stages.close()
+            self._disconnect_instruments()
+            self.scan = EngineProcess(recipe, journal.folder)
+            self.scan_events = EngineMonitor(self.scan)
+        else:
+            self.scan = ScanThread(AsyncScan(recipe, journal, self, self.stages))
+            self.scan_events = self.scan
+            self.button_abort.setEnabled(True)
+        self.scan_events.procedure.connect(self._scan_procedure)
+        self.scan_events.progress.connect(self._scan_progress)
+        self.scan_events.status.connect(self._scan_status)
+        self.scan_events.device.connect(self._scan_device)
+        self.scan_events.log.connect(log.info)
+        self.scan_events.finished_scan.connect(self._scan_finished)
+        self.scan.start()
+        if self.scan_events is not self.scan:
+            self.scan_events.start()
+    
+    
+    def _scan_procedure(self, info):
+        '''
+        A measurement of the scan started: adds it to browser and plot. The curve plots from the
+        shared buffer of the measurement, the data file is written by the scan.
+        '''
+        procedure = self.procedure_class()
+        procedure.set_parameters(info['parameters'], except_missing=False)
+        results = Results(procedure, info['datafile'])     # file exists: header is read, nothing written
+        experiment = self.new_experiment(results)
+        experiment.curve.attach(info['buffer'])
+        self.manager.load(experiment)
+        self.manager.experiments.update_status(experiment, Procedure.RUNNING)
+        experiment.browser_item.setStatus(Procedure.RUNNING)
+    
+    
+    def _scan_progress(self, datafile, progress):
+        experiment = self.manager.experiments.with_data_filename(datafile)
+        if experiment is not None:
+            experiment.browser_item.setProgress(progress)
+    
+    
+    def _scan_status(self, datafile, status):
+        experiment = self.manager.experiments.with_data_filename(datafile)
+        if experiment is not None:
+            self.manager.experiments.update_status(experiment, status)
+            experiment.browser_item.setStatus(status)
+            if status == Procedure.FINISHED:
+                experiment.browser_item.setProgress(100)
+            if status in TERMINAL and not experiment.curve.is_shared():
+                experiment.curve.evict()        # plotted from the data file, read it again complete
+    
+    
+    def _scan_device(self, device, device_results):
+        for metric, value in device_results.items():
+            self.widget_wafermap.set_value(device['indices'], metric, float(value), device['datafolder'])
+        progress_total, progress_current_chip = device['progress']
+        self.updateProgressBars(int(progress_total*100), int(progress_current_chip*100))
+        now = time.perf_counter()
+        if self.eta is not None:
+            self.eta.device_done(now-self.device_started, device_results.get('Pretest', 0) > 0)
+            self.label_eta.setText(self.eta.format())
+        self.device_started = now
+    
+    
+    def _scan_finished(self, code):
+        log.info("Scan finished with exit code %d", code)
+        self.eta = None
+        self.label_eta.setText("")
+        if self.scan_events is not self.scan:
+            self.stages.open()
+            self._connect_instruments()
+        self.scan = None
+        self.scan_events = None
+        self._enable_inputs()
+    
+    
+    def _layout_wafermap(self, journal):
+        '''
+        Lays out the wafer map for the devices of the scan plan (grid or layout) and fills in the
+        pretest results of devices already in the journal (resumed scan).
+        '''
+        plan = ScanPlan.from_parameters(journal.parameters, journal.folder)
+        self.widget_wafermap.set_layout(*plan.shape)
+        positions = {name: i for i, name in enumerate(plan.devices['name'].tolist())}
+        for devicename, state in journal.devices.items():
+            if 'pretest' in state and devicename in positions:
+                datafolder = os.path.dirname(state['pretest']['file'])
+                self.widget_wafermap.set_value(plan.indices(positions[devicename]), 'Pretest', state['pretest']['passed'], datafolder)
 
 
 
@@ -0,0 +1,73 @@
+# coalescing delivery of procedure progress and status to the GUI
+# procedures report progress after every data point; the GUI only needs the latest value of each
+# experiment once per frame. ProgressChannel keeps the latest progress and status per experiment
+# until the GUI takes them at a fixed frame rate (engine.ScanEvents), terminal statuses are queued
+# and never replaced. ProgressLimiter thins out the progress of a single Worker at the source.
+# no Qt imports in here
+
+import time
+import threading
+
+from pymeasure.experiment import Procedure
+
+
+FRAME_INTERVAL = 0.05       # s, progress/status delivery to the GUI (20 frames/s)
+TERMINAL = (Procedure.FINISHED, Procedure.FAILED, Procedure.ABORTED)
+
+
+class ProgressLimiter(object):
+    '''
+    Passes at most one progress value per interval, but always the first and the final (100) one.
+    '''
+
+    def __init__(self, interval=FRAME_INTERVAL):
+        self.interval = interval
+        self._next = 0.
+
+
+    def due(self, progress):
+        now = time.monotonic()
+        if progress >= 100. or now >= self._next:
+            self._next = now+self.interval
+            return True
+        return False
+
+
+
+class ProgressChannel(object):
+    '''
+    Latest progress and status per experiment key (e.g. the data file), written from any thread
+    and taken by the GUI once per frame. Non-terminal statuses of a key replace each other,
+    terminal statuses (TERMINAL) are always delivered, in order and after the progress of the
+    same frame.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._progress = {}
+        self._status = {}
+        self._terminal = []
+
+
+    def progress(self, key, value):
+        with self._lock:
+            self._progress[key] = value
+
+
+    def status(self, key, status):
+        with self._lock:
+            if status in TERMINAL:
+                self._terminal.append((key, status))
+            else:
+                self._status[key] = status
+
+
+    def take(self):
+        '''
+        Returns the progress values {key: progress} and the statuses [(key, status), ...] since
+        the last call.
+        '''
+        with self._lock:
+            progress, status, terminal = self._progress, self._status, self._terminal
+            self._progress, self._status, self._terminal = {}, {}, []
+        return progress, list(status.items())+terminal
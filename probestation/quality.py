@@ -0,0 +1,167 @@
+# measurement quality of the current readings: NPLC, averaging filter and autozero of the 2450
+# instead of a higher NPLC or a longer delay for every point, the planner picks the combination of
+# integration time (NPLC), the built-in averaging filter (repeat: N readings per point, moving:
+# running mean over the last N readings) and the autozero policy that reaches a target noise in
+# the shortest time per point, within a time budget per point.
+# autozero makes the 2450 measure its reference and zero with every reading, which about doubles
+# the reading time; for sweeps shorter than AUTOZERO_INTERVAL a single autozero at the start of
+# the sweep is enough, the drift over the sweep stays below the noise.
+# the range of a sweep can be planned from the currents of the pretest (plan_range()): the fixed
+# range is set before the sweep, autorange stays off; a reading close to the top of the range is
+# taken again one range up (next_range()) between two points, instead of autorange delays on
+# every reading.
+# the noise model is per reading, relative to the measurement range: white noise falling with the
+# square root of the integration time (NPLC x filter count) plus a floor that averaging does not
+# remove. NOISE_1PLC and NOISE_FLOOR are approximate figures of the 2450 current ranges.
+# no Qt imports in here
+
+import math
+from collections import namedtuple
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+LINE_FREQUENCY = 50.        # Hz, integration time of a reading is NPLC/LINE_FREQUENCY
+READ_OVERHEAD = 1e-3        # s, conversion and trigger overhead of one reading
+AUTOZERO_FACTOR = 2.        # reading time with autozero on every reading / without
+AUTOZERO_INTERVAL = 300.    # s, longest sweep with a single autozero at its start
+
+NOISE_1PLC = 2e-6           # rms noise of one 1 PLC reading, fraction of the range
+NOISE_FLOOR = 1e-7          # rms noise floor of averaged readings, fraction of the range
+
+CURRENT_RANGES = (10e-9, 100e-9, 1e-6, 10e-6, 100e-6, 1e-3, 10e-3, 100e-3, 1.)     # A, 2450
+OVERRANGE = 0.95            # fraction of the range from which a reading is taken again one range up
+NPLC_CHOICES = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+FILTER_COUNTS = (1, 2, 3, 4, 5, 8, 10, 16, 20, 32, 50, 64, 100)
+
+REPEAT = 'REP'
+MOVING = 'MOV'
+
+
+def current_range(current):
+    '''
+    Returns the smallest current range of the 2450 that measures current (A).
+    '''
+    for limit in CURRENT_RANGES:
+        if limit >= abs(current):
+            return limit
+    return CURRENT_RANGES[-1]
+
+
+def plan_range(max_current, headroom, limit):
+    '''
+    Returns the range of a sweep: the range of the largest pretest current (A) times headroom, at
+    most the range of the current limit.
+    '''
+    return min(current_range(max_current*headroom), current_range(limit))
+
+
+def next_range(range_):
+    # next larger current range, None above the largest
+    larger = [limit for limit in CURRENT_RANGES if limit > range_]
+    return larger[0] if larger else None
+
+
+def reading_noise(current_range, nplc, count=1):
+    # rms noise of a point of count averaged readings at nplc, in A
+    return current_range*math.sqrt(NOISE_1PLC**2/(nplc*count) + NOISE_FLOOR**2)
+
+
+def reading_time(nplc, autozero=False):
+    # duration of one reading in s
+    return nplc/LINE_FREQUENCY*(AUTOZERO_FACTOR if autozero else 1.) + READ_OVERHEAD
+
+
+
+class MeasurementQuality(namedtuple('MeasurementQuality', ['nplc', 'filter_type', 'filter_count', 'autozero',
+                                                           'noise', 'point_time', 'current_range'])):
+    '''
+    Settings of the current measurement chosen by plan_quality(), with the expected noise (A) and
+    time (s) of a point.
+
+    filter_type: REPEAT, MOVING or None (filter off); autozero: 'once' (at the start of the sweep)
+    or 'each reading'
+    '''
+
+    def apply(self, sourcemeter):
+        '''
+        Sets range, NPLC, averaging filter and autozero of the current measurement of a 2450.
+        '''
+        sourcemeter.write(":SENS:CURR:RANG:AUTO OFF")
+        sourcemeter.write(":SENS:CURR:RANG %g" % self.current_range)
+        sourcemeter.write(":SENS:CURR:NPLC %g" % self.nplc)
+        if self.filter_type is None:
+            sourcemeter.write(":SENS:CURR:AVER OFF")
+        else:
+            sourcemeter.write(":SENS:CURR:AVER:TCON %s" % self.filter_type)
+            sourcemeter.write(":SENS:CURR:AVER:COUN %d" % self.filter_count)
+            sourcemeter.write(":SENS:CURR:AVER ON")
+        if self.autozero == 'once':
+            sourcemeter.write(":SENS:CURR:AZER OFF")
+            sourcemeter.write(":SENS:AZER:ONCE")
+        else:
+            sourcemeter.write(":SENS:CURR:AZER ON")
+
+
+    def filter_text(self):
+        return "off" if self.filter_type is None else "%s %d" % (self.filter_type, self.filter_count)
+
+
+
+def default_quality(current_range, nplc):
+    '''
+    Settings of a sweep that is not planned: fixed current_range (A), nplc, filter off, autozero on
+    every reading.
+    '''
+    return MeasurementQuality(nplc, None, 1, 'each reading', reading_noise(current_range, nplc),
+                              reading_time(nplc, autozero=True), current_range)
+
+
+def reset_quality(sourcemeter):
+    '''
+    Switches the averaging filter off and autozero on again, the defaults the pretest measures
+    with. The 2450 keeps both across procedures, measure_current() sets neither.
+    '''
+    sourcemeter.write(":SENS:CURR:AVER OFF")
+    sourcemeter.write(":SENS:CURR:AZER ON")
+
+
+def plan_quality(current_range, noise_target, time_budget, points=1, constant_source=False):
+    '''
+    Chooses NPLC, averaging filter and autozero policy for readings in current_range (A): the
+    fastest settings with an expected noise of at most noise_target (A) and a time per point of at
+    most time_budget (s). If no settings within the budget reach the target, the ones with the
+    lowest noise within the budget; if none fit the budget, the fastest ones.
+
+    :param points: number of points of the sweep, decides the autozero policy
+    :param constant_source: the source stays at one value over the points (e.g. a time trace), so
+                            the moving filter can be used; sweeps need the repeat filter, a moving
+                            filter would average over neighbouring source values
+    '''
+    filter_type = MOVING if constant_source else REPEAT
+    quality = None
+    for autozero in (False, True):
+        candidates = []
+        for nplc in NPLC_CHOICES:
+            for count in FILTER_COUNTS:
+                reading = reading_time(nplc, autozero)
+                point_time = reading if filter_type == MOVING else count*reading
+                candidates.append((reading_noise(current_range, nplc, count), point_time, nplc, count))
+        within = [c for c in candidates if c[1] <= time_budget]
+        meeting = [c for c in within if c[0] <= noise_target]
+        if meeting:
+            noise, point_time, nplc, count = min(meeting, key=lambda c: (c[1], c[0]))
+        elif within:
+            noise, point_time, nplc, count = min(within, key=lambda c: (c[0], c[1]))
+        else:
+            noise, point_time, nplc, count = min(candidates, key=lambda c: (c[1], c[0]))
+        sweep_time = points*point_time + (count*reading_time(nplc, autozero) if filter_type == MOVING else 0.)
+        quality = MeasurementQuality(nplc, filter_type if count > 1 else None, count,
+                                     'each reading' if autozero else 'once', noise, point_time, current_range)
+        if autozero or sweep_time <= AUTOZERO_INTERVAL:
+            break
+    if quality.noise > noise_target:
+        log.info("Noise target %g A not reached within %g s per point, expected %g A", noise_target, time_budget, quality.noise)
+    return quality
@@ -0,0 +1,198 @@
+# cached loading of results files for previews (widgets.ResultsDialog)
+# Results.load parses the header, rebuilds the procedure and reads the data of a file; browsing a
+# folder of device files did that again for every selection. Loaded previews are kept in an LRU
+# cache keyed by path, modification time and size (a file written again is loaded again), loading
+# runs in background threads, and the neighbours of the selected file in its directory are loaded
+# ahead while the user looks at it, so scrolling through the listing finds them in the cache.
+# A preview carries everything the dialog shows, prepared off the GUI thread: the results with the
+# procedure, the data as DataFrame and the rows of the parameter tree.
+# no Qt imports in here, results arrive through callbacks in the loader threads
+
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+CACHE_SIZE = 64             # previews kept
+PREFETCH = 4                # neighbours loaded ahead on each side of the selected file
+
+
+class Preview(namedtuple('Preview', ['filename', 'results', 'data', 'parameters'])):
+    '''
+    Loaded results file: results (Results with the procedure, its DataFrame dropped), data
+    (DataFrame of the data columns) and parameters (rows (name, value text) of the parameter tree,
+    sorted by name).
+    '''
+
+
+
+def file_key(filename):
+    # cache key of a file, changes when the file is written again
+    stat = os.stat(filename)
+    return (os.path.normcase(os.path.abspath(filename)), stat.st_mtime_ns, stat.st_size)
+
+
+def load_preview(filename):
+    '''
+    Loads a results file. Raises ValueError if it is not one (no pymeasure header).
+    '''
+    from pymeasure.experiment.results import Results
+    results = Results.load(filename)
+    data = results.data
+    results._data = None
+    rows = sorted((param.name, str(param)) for param in results.procedure.parameter_objects().values())
+    return Preview(filename, results, data, rows)
+
+
+def neighbours(filename, count=PREFETCH):
+    '''
+    Returns the files next to filename in the sorted listing of its directory (files with the same
+    extension only), nearest first, at most count on each side.
+    '''
+    folder, name = os.path.split(os.path.abspath(filename))
+    extension = os.path.splitext(name)[1]
+    try:
+        names = sorted(entry.name for entry in os.scandir(folder)
+                       if entry.is_file() and os.path.splitext(entry.name)[1] == extension)
+    except OSError:
+        return []
+    if name not in names:
+        return []
+    i = names.index(name)
+    ordered = []
+    for step in range(1, count+1):
+        ordered.extend(names[j] for j in (i+step, i-step) if 0 <= j < len(names))
+    return [os.path.join(folder, n) for n in ordered]
+
+
+
+class ResultsCache(object):
+    '''
+    LRU cache of loaded results files (Preview). Files that are not results files are cached as
+    None, so they are not parsed again either.
+
+    Usage:
+        preview = cache.get(filename)               # None: not cached (or not a results file)
+        cache.load(filename, callback)              # callback(filename, preview) in a loader thread
+        cache.prefetch(neighbours(filename))
+
+    Requested files are loaded in a thread of their own, ahead of any prefetching; prefetches that
+    have not started yet are dropped when the next prefetch list comes.
+
+    :param size: number of previews kept
+    '''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._previews = OrderedDict()      # file_key -> Preview or None
+        self._keys = {}                     # path -> file_key of the cached version
+        self._loading = {}                  # file_key -> Future
+        self._prefetching = []
+        self._lock = threading.Lock()
+        self._requests = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preview')
+        self._prefetch = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+
+
+    def get(self, filename):
+        '''
+        Returns the cached Preview of filename, None if it is not cached or not a results file.
+        '''
+        try:
+            key = file_key(filename)
+        except OSError:
+            return None
+        with self._lock:
+            if key not in self._previews:
+                return None
+            self._previews.move_to_end(key)
+            return self._previews[key]
+
+
+    def _load(self, key, filename):
+        try:
+            preview = load_preview(filename)
+        except (ValueError, OSError):
+            log.debug("No preview of %s", filename)
+            preview = None
+        except Exception:
+            log.warning("Could not load %s", filename, exc_info=True)
+            preview = None
+        with self._lock:
+            self._loading.pop(key, None)
+            previous = self._keys.get(key[0])
+            if previous is not None and previous != key:
+                self._previews.pop(previous, None)      # older version of the file
+            self._keys[key[0]] = key
+            self._previews[key] = preview
+            self._previews.move_to_end(key)
+            while len(self._previews) > self.size:
+                old, _ = self._previews.popitem(last=False)
+                if self._keys.get(old[0]) == old:
+                    del self._keys[old[0]]
+        return preview
+
+
+    def _submit(self, executor, filename):
+        # returns the Future of filename, with the lock held
+        key = file_key(filename)
+        if key in self._previews:
+            future = Future()
+            future.set_result(self._previews[key])
+            return future
+        if key not in self._loading:
+            self._loading[key] = executor.submit(self._load, key, filename)
+        return self._loading[key]
+
+
+    def load(self, filename, callback=None):
+        '''
+        Loads filename in the background (unless it is cached or loading already) and returns the
+        Future of its Preview. callback(filename, preview) is called when it is there, in the
+        loader thread (or right away if it is cached). Raises OSError if the file does not exist.
+        '''
+        with self._lock:
+            pending = self._loading.get(file_key(filename))
+            if pending in self._prefetching and pending.cancel():
+                # queued behind other prefetches, load it now
+                self._prefetching.remove(pending)
+                del self._loading[file_key(filename)]
+            future = self._submit(self._requests, filename)
+            if future in self._prefetching:
+                self._prefetching.remove(future)        # prefetch running already, not cancelled later
+        if callback is not None:
+            future.add_done_callback(lambda future: callback(filename, future.result()))
+        return future
+
+
+    def prefetch(self, filenames):
+        '''
+        Loads filenames in the background, in order, after the requested files. Replaces the
+        prefetches of the previous call that have not started yet.
+        '''
+        with self._lock:
+            for future in self._prefetching:
+                future.cancel()
+            self._loading = {key: future for key, future in self._loading.items() if not future.cancelled()}
+            self._prefetching = []
+            for filename in filenames:
+                try:
+                    future = self._submit(self._prefetch, filename)
+                except OSError:
+                    continue
+                if not future.done():
+                    self._prefetching.append(future)
+
+
+    def clear(self):
+        with self._lock:
+            self._previews.clear()
+            self._keys.clear()
+
+
+
+CACHE = ResultsCache()
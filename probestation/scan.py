@@ -0,0 +1,224 @@
+# scan planning shared by the GUI (probestation_MAIN) and the headless runner
+# no Qt imports in here, this module has to stay importable without a display
+
+import os
+
+import numpy as np
+
+from layout import DeviceLayout
+
+
+def device_name(chipcol, chiprow, devcol, devrow):
+    return str(chipcol)+"_"+str(chiprow)+"_"+str(devcol)+"_"+str(devrow)
+
+
+# per-device fields of a scan plan, in scan order
+DEVICE_DTYPE = np.dtype([
+    ('chipcol', np.int16),
+    ('chiprow', np.int16),
+    ('devcol', np.int16),
+    ('devrow', np.int16),
+    ('name', 'U32'),                # device name, data folder is dev_<name>
+    ('type', 'U16'),                # device type of a layout plan
+    ('seed', np.int32),
+    ('coords', np.int64, (3, 2)),   # stage coordinates [[steps, microsteps], ...] of x, y, z
+    ('in_bounds', np.bool_),        # coordinates passed the stage boundary check
+    ('skip', np.bool_),             # completed in an earlier run (resumed scan)
+])
+INDEX_FIELDS = ('chipcol', 'chiprow', 'devcol', 'devrow')
+
+
+def device_dtype(layout):
+    '''
+    DEVICE_DTYPE with name and type at least as wide as the ids and types of layout (the string
+    fields of a loaded layout are sized from its data, see layout.layout_dtype).
+    '''
+    widths = {'name': layout.devices.dtype['id'], 'type': layout.devices.dtype['type']}
+    return np.dtype([(name, max(widths[name], DEVICE_DTYPE[name], key=lambda dtype: dtype.itemsize)
+                      if name in widths else DEVICE_DTYPE[name]) for name in DEVICE_DTYPE.names])
+
+
+
+class ScanPlan(object):
+    '''
+    All devices of a scan: the wafer level parameters are stored once, the per-device fields
+    (grid indices, name, seed, stage coordinates, flags) in a NumPy structured array in scan order
+    (DEVICE_DTYPE). Devices are addressed by their position in the scan order.
+
+    Without a layout the devices are the regular grid of the parameters (chipcols, chiprows,
+    devcols, devrows). With a layout (layout.DeviceLayout) they are the layout devices in rows, in
+    that order (default: all devices, routed chip by chip); chipcol is then the position of the chip
+    in layout.chips, devcol the position of the device on its chip, chiprow and devrow are 0, and
+    the device name is the layout id.
+
+    :param parameters: wafer level parameters of the scan (procedure parameter values)
+    :param folder: scan folder, device data goes into subfolders dev_<devicename>
+    :param completed: names of devices to skip (e.g. completed devices of a resumed scan)
+    :param layout: DeviceLayout of the wafer, optional
+    :param rows: layout rows of the devices to scan, in scan order
+    '''
+
+    def __init__(self, parameters, folder, completed=(), layout=None, rows=None):
+        p = parameters
+        self.parameters = dict(parameters)
+        self.folder = folder
+        self.layout = layout
+        if layout is None:
+            self.rows = None
+            self.shape = (p['chipcols'], p['chiprows'], p['devcols'], p['devrows'])
+            grid = np.indices(self.shape).reshape(4, -1)    # C order: chip column outermost, device row innermost
+            self.devices = np.zeros(grid.shape[1], dtype=DEVICE_DTYPE)
+            for field, values in zip(INDEX_FIELDS, grid):
+                self.devices[field] = values
+            self.devices['name'] = [device_name(*indices) for indices in grid.T.tolist()]
+        else:
+            self.rows = layout.route(np.arange(len(layout))) if rows is None else np.asarray(rows, dtype=np.int64)
+            chips = layout.devices['chip'][self.rows]
+            self.devices = np.zeros(len(self.rows), dtype=device_dtype(layout))
+            self.devices['chipcol'] = [layout.chips.index(chip) for chip in chips.tolist()]
+            for chip in np.unique(chips):
+                on_chip = chips == chip
+                self.devices['devcol'][on_chip] = np.arange(on_chip.sum())
+            self.devices['name'] = layout.devices['id'][self.rows]
+            self.devices['type'] = layout.devices['type'][self.rows]
+            self.shape = (len(layout.chips), 1, max(int(np.bincount(self.devices['chipcol']).max(initial=0)), 1), 1)
+        d = self.devices
+        d['seed'] = 1000*d['chipcol'] + 100*d['chiprow'] + 10*d['devcol'] + d['devrow']
+        d['in_bounds'] = True
+        if completed:
+            d['skip'] = np.isin(d['name'], list(completed))
+        # devices per chip, for the chip progress
+        chips = d['chipcol'].astype(np.int64)*self.shape[1] + d['chiprow']
+        self._chip_sizes = np.bincount(chips, minlength=self.shape[0]*self.shape[1])
+
+
+    @classmethod
+    def from_parameters(cls, parameters, folder, completed=()):
+        '''
+        Plan of the scan parameters: the devices of the layout file in parameters['layout'] if
+        given, selected with the DeviceLayout.select arguments in parameters['layout_select']
+        (e.g. {"chip": 3, "type": "B"}), else the regular grid.
+        '''
+        if not parameters.get('layout'):
+            return cls(parameters, folder, completed)
+        layout = DeviceLayout.load(parameters['layout'])
+        rows = layout.route(layout.select(**parameters.get('layout_select', {})))
+        return cls(parameters, folder, completed, layout, rows)
+
+
+    def __len__(self):
+        return len(self.devices)
+
+
+    def pending(self):
+        '''
+        Returns the positions of the devices still to be measured.
+        '''
+        return np.flatnonzero(~self.devices['skip'])
+
+
+    def locate(self, stages, registration=None):
+        '''
+        Calculates the stage coordinates of all devices and flags the devices outside of the stage
+        limits. registration (StageStack.registration()) is restored on the stages if given, else
+        the current registration of the stages is used.
+        '''
+        d = self.devices
+        if registration is not None:
+            stages.restore_registration(registration)
+        if self.layout is not None:
+            if registration is None:
+                registration = stages.registration()
+            d['coords'] = self.layout.stage_coordinates(registration, self.rows)
+            check = getattr(stages, 'coords_boudary_check', None)
+            if check is not None:
+                for i, coords in enumerate(d['coords'].tolist()):
+                    try:
+                        check(coords)
+                    except Exception:
+                        d['in_bounds'][i] = False
+            return
+        p = self.parameters
+        stages.calc_coordinates_delta_hor(p['chipcols'], p['devcols'])
+        stages.calc_coordinates_delta_vert(p['chiprows'], p['devrows'])
+        for i, indices in enumerate(zip(*(d[field].tolist() for field in INDEX_FIELDS))):
+            try:
+                d['coords'][i] = stages.calc_dev_coordinates(*indices)
+            except Exception:                   # StageStack.coords_boudary_check
+                d['in_bounds'][i] = False
+
+
+    def out_of_bounds(self):
+        return self.devices['name'][~self.devices['in_bounds']].tolist()
+
+
+    def name(self, i):
+        return str(self.devices['name'][i])
+
+
+    def indices(self, i):
+        row = self.devices[i]
+        return tuple(int(row[field]) for field in INDEX_FIELDS)
+
+
+    def coordinates(self, i):
+        return self.devices['coords'][i].tolist()
+
+
+    def datafolder(self, i):
+        return os.path.join(self.folder, "dev_"+self.name(i))
+
+
+    def procedure_parameters(self, i):
+        '''
+        Parameter values of the procedures of device i: the wafer level parameters with the device
+        fields (the procedures take the device indices as chipcols, chiprows, devcols, devrows).
+        '''
+        chipcol, chiprow, devcol, devrow = self.indices(i)
+        return dict(self.parameters, devicename=self.name(i), datafolder=self.datafolder(i),
+                    chipcols=chipcol, chiprows=chiprow, devcols=devcol, devrows=devrow,
+                    seed=int(self.devices['seed'][i]))
+
+
+    def procedure(self, procedure_class, i, parent_window=None, values=None):
+        '''
+        Procedure of device i, values: further parameter values (e.g. pretest results), parameters
+        the procedure does not have are left out.
+        '''
+        procedure = procedure_class(parent_window=parent_window)
+        procedure.set_parameters(dict(self.procedure_parameters(i), **(values or {})), except_missing=False)
+        return procedure
+
+
+    def progress(self, i):
+        '''
+        Returns the scan progress after device i as fractions (wafer, current chip).
+        '''
+        chipcol, chiprow, devcol, devrow = self.indices(i)
+        chipcols, chiprows, devcols, devrows = self.shape
+        chip = (devcol*devrows + devrow + 1)/float(self._chip_sizes[chipcol*chiprows + chiprow])
+        return (i+1)/float(len(self.devices)), chip
+
+
+    def device_info(self, i):
+        '''
+        Summary of device i for the scan listeners ('device' event), picklable for the engine process.
+        '''
+        return {'devicename': self.name(i), 'indices': self.indices(i), 'datafolder': self.datafolder(i),
+                'type': str(self.devices['type'][i]), 'progress': self.progress(i)}
+
+
+
+def prepare_datafolder(datafolder):
+    '''
+    Creates the data folder of a device. If the folder already exists, the device was interrupted
+    in an earlier run of a resumed scan: its incomplete data files are kept, but renamed so the
+    new measurement does not append to them.
+    '''
+    if os.path.isdir(datafolder):
+        for name in os.listdir(datafolder):
+            if name.endswith('.dat'):
+                path = os.path.join(datafolder, name)
+                os.replace(path, path+'.interrupted')
+    else:
+        os.makedirs(datafolder)
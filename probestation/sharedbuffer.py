@@ -0,0 +1,257 @@
+# shared memory data buffer of a running measurement
+# the Worker appends the emitted data points to a SharedColumns buffer; the recorder writes the data
+# file from it in batches and plot curves read the columns from it directly, in the same process or
+# in another one (GUI <-> engine process), by the name of the buffer. No data point is formatted or
+# parsed on the way to the plot, the data file is only a sink.
+# one writer per buffer: a row is written first and published by the row count in the header
+# afterwards, readers never look beyond the row count. A full buffer moves to a new segment of twice
+# the size (name with the next generation); the writer keeps the old segments until the buffer is
+# retired and records the newest generation in their headers, so readers follow. Finished buffers
+# stay available for a while (retire()) so readers that attach late (the GUI gets the name through
+# the event queue) still find them.
+# no Qt imports in here
+
+import os
+import json
+import atexit
+import itertools
+import threading
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+HEADER_SIZE = 4096          # bytes: row count, capacity, column count, next generation, column names
+NAMES_OFFSET = 64
+RETAIN = 16                 # finished buffers kept available for late readers, per process
+
+_LENGTH, _CAPACITY, _COLUMNS, _MOVED = range(4)
+
+_counter = itertools.count()
+_owned = {}                 # name -> SharedMemory of the buffers created in this process
+_retired = deque()
+_lock = threading.Lock()   # creating and opening segments (see _open)
+
+
+def _segment_name(base, generation):
+    return "%s_%d" % (base, generation)
+
+
+def _open(name):
+    # attaches to an existing segment, without registering it with the resource tracker: the
+    # tracker would unlink it when this process exits, and processes started with spawn share the
+    # tracker of their parent, so unregistering afterwards would drop the entry of the writer
+    with _lock:
+        if name in _owned:
+            return _owned[name], False
+        try:
+            return shared_memory.SharedMemory(name=name, track=False), True    # Python 3.13+
+        except TypeError:
+            pass
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name), True
+        finally:
+            resource_tracker.register = register
+
+
+
+class SharedColumns(object):
+    '''
+    Float64 data columns of one measurement in shared memory, column-major, so a column is a
+    contiguous view. Create with create() (writer), attach to it by name with attach() (readers).
+    Non-numeric values are stored as NaN.
+    '''
+
+    def __init__(self, base, generation, segment, owner, attached):
+        self.base = base
+        self.generation = generation
+        self._segment = segment
+        self._owner = owner
+        self._attached = attached         # segment opened by this object (not shared with a writer here)
+        self._history = []                # writer: segments of the earlier generations
+        self._map()
+
+
+    def _map(self):
+        buffer = self._segment.buf
+        self._header = np.ndarray((4,), dtype=np.int64, buffer=buffer)
+        size = int(np.frombuffer(buffer, dtype=np.int32, count=1, offset=NAMES_OFFSET)[0])
+        self.columns = json.loads(bytes(buffer[NAMES_OFFSET+4:NAMES_OFFSET+4+size]).decode())
+        self._index = {column: i for i, column in enumerate(self.columns)}
+        capacity = int(self._header[_CAPACITY])
+        self._data = np.ndarray((len(self.columns), capacity), dtype=np.float64, buffer=buffer, offset=HEADER_SIZE)
+
+
+    @property
+    def name(self):
+        return _segment_name(self.base, self.generation)
+
+
+    @classmethod
+    def create(cls, columns, capacity=1024, base=None, generation=0):
+        columns = list(columns)
+        names = json.dumps(columns).encode()
+        if NAMES_OFFSET+4+len(names) > HEADER_SIZE:
+            raise ValueError("Too many column names for a shared buffer")
+        if base is None:
+            base = "psb%d_%d" % (os.getpid(), next(_counter))
+        capacity = max(int(capacity), 1)
+        name = _segment_name(base, generation)
+        with _lock:
+            segment = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE+8*len(columns)*capacity)
+            _owned[name] = segment
+        header = np.ndarray((4,), dtype=np.int64, buffer=segment.buf)
+        header[:] = (0, capacity, len(columns), 0)
+        np.ndarray((1,), dtype=np.int32, buffer=segment.buf, offset=NAMES_OFFSET)[0] = len(names)
+        segment.buf[NAMES_OFFSET+4:NAMES_OFFSET+4+len(names)] = names
+        buffer = cls(base, generation, segment, True, False)
+        buffer._data[:] = np.nan
+        return buffer
+
+
+    @classmethod
+    def attach(cls, name):
+        '''
+        Opens the buffer of another object (or process) by name, read only by convention.
+        Raises FileNotFoundError if the buffer does not exist (any more).
+        '''
+        base, generation = name.rsplit('_', 1)
+        segment, attached = _open(name)
+        buffer = cls(base, int(generation), segment, False, attached)
+        buffer._follow()
+        return buffer
+
+
+    def _follow(self):
+        # readers: moves on to the current segment if the writer has grown the buffer
+        while self._header[_MOVED]:
+            generation = int(self._header[_MOVED])
+            try:
+                segment, attached = _open(_segment_name(self.base, generation))
+            except FileNotFoundError:
+                return
+            self.close()
+            self._segment, self._attached, self.generation = segment, attached, generation
+            self._map()
+
+
+    def is_stale(self):
+        '''
+        Readers: True if the writer has moved the data on to a segment that is gone already (it was
+        retired, or the writer process ended), the data is then only complete in the data file.
+        '''
+        self._follow()
+        return bool(self._header[_MOVED])
+
+
+    def __len__(self):
+        if not self._owner:
+            self._follow()
+        return int(self._header[_LENGTH])
+
+
+    def _grow(self):
+        grown = SharedColumns.create(self.columns, 2*self._data.shape[1], self.base, self.generation+1)
+        n = int(self._header[_LENGTH])
+        grown._data[:, :n] = self._data[:, :n]
+        grown._header[_LENGTH] = n
+        self._history.append(self._segment)
+        for segment in self._history:
+            np.ndarray((4,), dtype=np.int64, buffer=segment.buf)[_MOVED] = grown.generation
+        self._segment, self.generation = grown._segment, grown.generation
+        self._map()
+
+
+    def append(self, record):
+        '''
+        Appends one data point {column: value} (writer only). Unknown keys are ignored, missing
+        columns are stored as NaN.
+        '''
+        n = int(self._header[_LENGTH])
+        if n == self._data.shape[1]:
+            self._grow()
+        for column, value in record.items():
+            i = self._index.get(column)
+            if i is not None:
+                try:
+                    self._data[i, n] = value
+                except (TypeError, ValueError):
+                    pass
+        self._header[_LENGTH] = n+1          # publishes the row
+
+
+    def column(self, name):
+        '''
+        Returns a view on the filled part of a column.
+        '''
+        n = len(self)
+        return self._data[self._index[name], :n]
+
+
+    def rows(self, start, stop):
+        '''
+        Returns the rows start..stop as array (rows, columns), a copy.
+        '''
+        return self._data[:, start:stop].T.copy()
+
+
+    def nbytes(self):
+        return self._data.nbytes
+
+
+    def close(self):
+        '''
+        Closes the view of a reader. The buffer of the writer is closed with retire().
+        '''
+        self._header = self._data = None
+        if self._attached:
+            try:
+                self._segment.close()
+            except BufferError:             # views handed out are still in use, closed by the GC
+                pass
+
+
+
+def _release(segment):
+    # closes and removes a segment created in this process
+    with _lock:
+        _owned.pop(segment.name.lstrip('/'), None)
+    try:
+        segment.close()
+    except BufferError:
+        pass
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def retire(buffer):
+    '''
+    The writer is done with buffer: it stays available to readers until RETAIN more buffers of
+    this process have been retired, or until the process exits.
+    '''
+    segments = buffer._history+[buffer._segment]
+    buffer._history = []
+    buffer.close()
+    _retired.append(segments)
+    while len(_retired) > RETAIN:
+        for segment in _retired.popleft():
+            _release(segment)
+
+
+@atexit.register
+def _release_all():
+    while _retired:
+        for segment in _retired.popleft():
+            _release(segment)
+    for segment in list(_owned.values()):
+        _release(segment)
@@ -41,6 +41,10 @@ sbuf = create_string_buffer(64)
 lib.ximc_version(sbuf)
 print("Library version: " + sbuf.raw.decode().rstrip("\0") + "\n")
 
+# speeds of automated moves (see speed_up), steps/s
+AUTOMOVE_SPEED_XY = 2000
+AUTOMOVE_SPEED_Z = 4500
+
 
 
 
@@ -59,6 +63,34 @@ class StageStack(QObject):
         self.stage_emergency_stop_call = Event()
         self.stage_emergency_stop_call.clear()
         
+        self.open()
+        
+        """
+        TODO:
+        
+        initialise stage parameters like acceleration, microstep mode
+        check, if speed values are ok
+        """
+        
+        # bit flags for up/down/fast_movemnet/north/east/south/west
+        self._movement_flag = 0b0000000
+        
+        # stored coordinates
+        self._coordinates_center = [[0,0],[0,0],[500,0]]
+        self._coordinates_load = [[0,0],[-14500,0],[500,0]]
+        self._coordinates_dev_00 = [[-8000,0],[-10000,0],[5000,0]]
+        self._coordinates_dev_i0 = [[8000,0],[-11000,0],[4500,0]]
+        self._coordinates_dev_0j = [[-7500,0],[10000,0],[5500,0]]
+        self._coordinates_delta_hor = [[0,0],[0,0],[500,0]]
+        self._coordinates_delta_vert = [[0,0],[0,0],[500,0]]
+        self._automovement_safe_height = 500
+    
+    
+    
+    def open(self):
+        '''
+        Enumerates the motor controllers and assigns them to the axes by serial number.
+        '''
         # Device search and enumeration with probing. It gives more information about devices.
         self.probe_flags = EnumerateFlags.ENUMERATE_PROBE
         self.enum_hints = b"addr=" # Use this hint string for broadcast enumerate
@@ -95,30 +127,25 @@ class StageStack(QObject):
         else:
             self.motorsOk = True
             print("Motors connected\n")
-        
-        
+
         for stage in (self.stage_x, self.stage_y):
             self.change_speed(stage, 500)
         self.change_speed(self.stage_z, 2000)
-        """
-        TODO:
-        
-        initialise stage parameters like acceleration, microstep mode
-        check, if speed values are ok
-        """
-        
-        # bit flags for up/down/fast_movemnet/north/east/south/west
-        self._movement_flag = 0b0000000
-        
-        # stored coordinates
-        self._coordinates_center = [[0,0],[0,0],[500,0]]
-        self._coordinates_load = [[0,0],[-14500,0],[500,0]]
-        self._coordinates_dev_00 = [[-8000,0],[-10000,0],[5000,0]]
-        self._coordinates_dev_i0 = [[8000,0],[-11000,0],[4500,0]]
-        self._coordinates_dev_0j = [[-7500,0],[10000,0],[5500,0]]
-        self._coordinates_delta_hor = [[0,0],[0,0],[500,0]]
-        self._coordinates_delta_vert = [[0,0],[0,0],[500,0]]
-        self._automovement_safe_height = 500
+    
+    
+    
+    def close(self):
+        '''
+        Closes the motor controllers, e.g. while a scan runs in the acquisition process (engine.py),
+        which opens them itself. open() connects them again.
+        '''
+        for attr in ('stage_x', 'stage_y', 'stage_z'):
+            stage = getattr(self, attr)
+            if stage is not None:
+                lib.close_device(byref(cast(stage, POINTER(c_int))))
+                setattr(self, attr, None)
+        self.motorsOk = False
+        print("Motors disconnected\n")
     
     
     
@@ -230,8 +257,8 @@ class StageStack(QObject):
         self._movement_flag += 0b0010000
         if self.motorsOk:
             for stage in (self.stage_x, self.stage_y):
-                self.change_speed(stage, 2000)
-            self.change_speed(self.stage_z, 4500)
+                self.change_speed(stage, AUTOMOVE_SPEED_XY)
+            self.change_speed(self.stage_z, AUTOMOVE_SPEED_Z)
         else:
             print("speed up")
     
@@ -246,6 +273,38 @@ class StageStack(QObject):
             print("slow down")
     
     
+    def move_settings(self):
+        '''
+        Returns speed, acceleration and deceleration (steps/s, steps/s^2) of the axes during
+        automated moves as {'x': (speed, accel, decel), ...}, None if the motors are not connected.
+        '''
+        if not self.motorsOk:
+            return None
+        settings = {}
+        for axis, speed in (('x', AUTOMOVE_SPEED_XY), ('y', AUTOMOVE_SPEED_XY), ('z', AUTOMOVE_SPEED_Z)):
+            mvst = move_settings_t()
+            lib.get_move_settings(getattr(self, 'stage_'+axis), byref(mvst))
+            settings[axis] = (speed, mvst.Accel, mvst.Decel)
+        return settings
+    
+    
+    def move_axis(self, axis, coord):
+        '''
+        Starts a move of one axis ('x', 'y' or 'z') to coord [steps, microsteps] and returns
+        immediately, see axis_moving().
+        '''
+        if self.motorsOk:
+            lib.command_move(getattr(self, 'stage_'+axis), coord[0], coord[1])
+    
+    
+    def axis_moving(self, axis):
+        if not self.motorsOk:
+            return False
+        stage_status = status_t()
+        lib.get_status(getattr(self, 'stage_'+axis), byref(stage_status))
+        return abs(stage_status.CurSpeed) > 0
+    
+    
     def read_stage_position(self, stage):
         if self.motorsOk:
             x_pos = get_position_t()
@@ -296,6 +355,27 @@ class StageStack(QObject):
         self._calc_new_safe_height()
     
     
+    def registration(self):
+        '''
+        Returns the captured device coordinates that define the scan grid (e.g. for the scan journal).
+        '''
+        return {
+            'dev_00': [list(c) for c in self._coordinates_dev_00],
+            'dev_i0': [list(c) for c in self._coordinates_dev_i0],
+            'dev_0j': [list(c) for c in self._coordinates_dev_0j],
+        }
+
+
+    def restore_registration(self, registration):
+        '''
+        Reverse of registration(). Restores previously captured device coordinates.
+        '''
+        self._coordinates_dev_00 = [list(c) for c in registration['dev_00']]
+        self._coordinates_dev_i0 = [list(c) for c in registration['dev_i0']]
+        self._coordinates_dev_0j = [list(c) for c in registration['dev_0j']]
+        self._calc_new_safe_height()
+
+
     def goto_coords(self, coords):
         print("moving to corrds ", coords)
         self.stage_not_moving.clear()
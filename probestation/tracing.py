@@ -0,0 +1,176 @@
+# timing spans of the phases of a scan (stage moves, procedure phases, file I/O, ...)
+# spans are recorded by the module wide TRACER only while it is enabled; disabled, span() returns
+# a shared no-op context manager, so instrumented code costs one attribute lookup and call
+# recorded spans export to Chrome trace / Perfetto JSON (chrome://tracing, ui.perfetto.dev) and to
+# a summary table per phase
+
+import os
+import csv
+import json
+import threading
+from time import perf_counter_ns
+
+import logging
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+TRACE_FILENAME = 'trace.json'
+SUMMARY_FILENAME = 'timing.csv'
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, key, value):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+
+class _Span(object):
+    __slots__ = ('tracer', 'name', 'cat', 'device', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, device, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.device = device
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer._record(self, perf_counter_ns())
+        return False
+
+    def set(self, key, value):
+        '''
+        Adds an argument to the span (shown with the span in the trace viewer).
+        '''
+        self.args[key] = value
+
+
+
+class Tracer(object):
+    '''
+    Collects timing spans from all threads of the process. Each span has a name (the phase), a
+    category, the device it belongs to (the current device of the scan unless given) and the
+    thread it ran in.
+
+    Usage:
+        with TRACER.span('XY move', 'stages'):
+            ...
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.device = None          # device id the spans are tagged with
+        self.spans = []
+        self._origin = perf_counter_ns()
+        self._threads = {}
+
+
+    def enable(self):
+        self.enabled = True
+
+
+    def disable(self):
+        self.enabled = False
+
+
+    def clear(self):
+        self.spans = []
+        self._threads = {}
+        self._origin = perf_counter_ns()
+
+
+    def span(self, name, cat='scan', device=None, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, cat, device or self.device, args)
+
+
+    def _record(self, span, end):
+        thread = threading.current_thread()
+        self._threads.setdefault(thread.ident, thread.name)
+        # list.append is atomic, no lock needed for spans from several threads
+        self.spans.append((span.name, span.cat, span.device, thread.ident, span.start, end, span.args))
+
+
+    def chrome_trace(self):
+        '''
+        Returns the spans in the Chrome trace event format (complete events, times in us).
+        '''
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in self._threads.items()]
+        for name, cat, device, tid, start, end, args in self.spans:
+            args = dict(args, device=device) if device is not None else args
+            events.append({
+                'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': (start-self._origin)/1e3, 'dur': (end-start)/1e3, 'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+    def write_chrome_trace(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f, default=str)
+
+
+    def summary(self):
+        '''
+        Returns one row per phase (category, name, count, total, mean and max duration in
+        seconds, number of devices), ordered by total duration.
+        '''
+        phases = {}
+        for name, cat, device, tid, start, end, args in self.spans:
+            phase = phases.setdefault((cat, name), [0, 0, 0, set()])
+            duration = end-start
+            phase[0] += 1
+            phase[1] += duration
+            phase[2] = max(phase[2], duration)
+            phase[3].add(device)
+        rows = [(cat, name, count, total/1e9, total/count/1e9, maximum/1e9, len(devices - {None}))
+                for (cat, name), (count, total, maximum, devices) in phases.items()]
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows
+
+
+    def write_summary(self, filename):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['category', 'phase', 'count', 'total (s)', 'mean (s)', 'max (s)', 'devices'])
+            writer.writerows(self.summary())
+
+
+    def format_summary(self):
+        lines = ["%-12s %-24s %8s %10s %10s %10s %8s" % ('category', 'phase', 'count', 'total s', 'mean s', 'max s', 'devices')]
+        for row in self.summary():
+            lines.append("%-12s %-24s %8d %10.3f %10.4f %10.4f %8d" % row)
+        return "\n".join(lines)
+
+
+    def write(self, folder):
+        '''
+        Writes trace and summary table into folder, returns the file names.
+        '''
+        trace = os.path.join(folder, TRACE_FILENAME)
+        summary = os.path.join(folder, SUMMARY_FILENAME)
+        self.write_chrome_trace(trace)
+        self.write_summary(summary)
+        return trace, summary
+
+
+
+TRACER = Tracer()
@@ -26,15 +26,20 @@ import logging
 
 import os
 import re
+from collections import deque
+import numpy as np
 import pyqtgraph as pg
 
 from pymeasure.display.browser import Browser
 from pymeasure.display.curves import ResultsCurve, Crosshairs
 from pymeasure.display.inputs import BooleanInput, IntegerInput, ListInput, ScientificInput, StringInput
-from pymeasure.display.log import LogHandler
 from pymeasure.display.Qt import QtCore, QtGui
 from pymeasure.experiment import parameters, Procedure
-from pymeasure.experiment.results import Results
+# modified pymeasure modules
+from curves import BufferedResultsCurve
+from tracing import TRACER
+from logs import FieldsFormatter
+from resultscache import CACHE, neighbours
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -47,6 +52,10 @@ class PlotFrame(QtGui.QFrame):
     """
 
     LABEL_STYLE = {'font-size': '10pt', 'font-family': 'Arial', 'color': '#000000'}
+    # level of detail: points drawn per refresh in total and per curve (BufferedResultsCurve only)
+    MAX_POINTS_PER_FRAME = 200000
+    MAX_POINTS_PER_CURVE = 5000
+    MIN_POINTS_PER_CURVE = 200
     updated = QtCore.QSignal()
     x_axis_changed = QtCore.QSignal(str)
     y_axis_changed = QtCore.QSignal(str)
@@ -96,13 +105,34 @@ class PlotFrame(QtGui.QFrame):
         self.coordinates.setText("(%g, %g)" % (x, y))
 
     def update_curves(self):
-        for item in self.plot.items:
-            if isinstance(item, ResultsCurve):
-                if self.check_status:
-                    if item.results.procedure.status == Procedure.RUNNING:
-                        item.update()
-                else:
+        with TRACER.span('plot frame', 'gui') as span:
+            span.set('points', self._update_curves())
+
+    def _update_curves(self):
+        """ Redraws the curves, returns the number of points drawn
+        """
+        curves = [item for item in self.plot.items if isinstance(item, ResultsCurve)]
+        buffered = [item for item in curves if isinstance(item, BufferedResultsCurve)]
+        drawn = 0
+        if buffered:
+            # share the point budget between all visible curves, decimate inside the view range
+            max_points = min(self.MAX_POINTS_PER_CURVE,
+                             max(self.MIN_POINTS_PER_CURVE, self.MAX_POINTS_PER_FRAME // len(buffered)))
+            x_range = tuple(self.plot.viewRange()[0])
+            for item in buffered:
+                item.set_view(x_range, max_points)
+                # curves left dirty are drawn on the next refresh (progressive drawing)
+                if drawn < self.MAX_POINTS_PER_FRAME:
+                    drawn += item.update()
+        for item in curves:
+            if isinstance(item, BufferedResultsCurve):
+                continue
+            if self.check_status:
+                if item.results.procedure.status == Procedure.RUNNING:
                     item.update()
+            else:
+                item.update()
+        return drawn
 
     def parse_axis(self, axis):
         """ Returns the units of an axis by searching the string
@@ -124,7 +154,8 @@ class PlotFrame(QtGui.QFrame):
         for item in self.plot.items:
             if isinstance(item, ResultsCurve):
                 item.x = axis
-                item.update()
+                if not isinstance(item, BufferedResultsCurve):     # redrawn by update_curves
+                    item.update()
         label, units = self.parse_axis(axis)
         self.plot.setLabel('bottom', label, units=units, **self.LABEL_STYLE)
         self.x_axis = axis
@@ -134,7 +165,8 @@ class PlotFrame(QtGui.QFrame):
         for item in self.plot.items:
             if isinstance(item, ResultsCurve):
                 item.y = axis
-                item.update()
+                if not isinstance(item, BufferedResultsCurve):     # redrawn by update_curves
+                    item.update()
         label, units = self.parse_axis(axis)
         self.plot.setLabel('left', label, units=units, **self.LABEL_STYLE)
         self.y_axis = axis
@@ -212,11 +244,11 @@ class PlotWidget(QtGui.QWidget):
             kwargs['pen'] = pg.mkPen(color=color, width=2)
         if 'antialias' not in kwargs:
             kwargs['antialias'] = False
-        curve = ResultsCurve(results,
-                             x=self.plot_frame.x_axis,
-                             y=self.plot_frame.y_axis,
-                             **kwargs
-                             )
+        curve = BufferedResultsCurve(results,
+                                     x=self.plot_frame.x_axis,
+                                     y=self.plot_frame.y_axis,
+                                     **kwargs
+                                     )
         curve.setSymbol(None)
         curve.setSymbolBrush(None)
         return curve
@@ -245,6 +277,12 @@ class BrowserWidget(QtGui.QWidget):
         self.hide_button.setEnabled(False)
         self.show_button = QtGui.QPushButton('Show all', self)
         self.show_button.setEnabled(False)
+        self.memory_label = QtGui.QLabel(self)
+        self.catalog_input = QtGui.QLineEdit(self)
+        self.catalog_input.setPlaceholderText("wafer=W1; Bias Voltage maximum=100 mV; On/off ratio>5")
+        self.catalog_input.setToolTip("Query of the measurement catalog: conditions on wafer, device, status, procedure,\n"
+                                      "chipcol, chiprow, devcol, devrow, header parameters or metrics, separated by ';'")
+        self.find_button = QtGui.QPushButton('Find', self)
         #self.open_button = QtGui.QPushButton('Open', self)
         #self.open_button.setEnabled(True)
 
@@ -259,12 +297,24 @@ class BrowserWidget(QtGui.QWidget):
         hbox.addWidget(self.hide_button)
         hbox.addWidget(self.clear_button)
         hbox.addStretch()
+        hbox.addWidget(self.memory_label)
         #hbox.addWidget(self.open_button)
 
+        catalog_hbox = QtGui.QHBoxLayout()
+        catalog_hbox.setSpacing(10)
+        catalog_hbox.setContentsMargins(-1, 0, -1, 6)
+        catalog_hbox.addWidget(QtGui.QLabel('Catalog:', self))
+        catalog_hbox.addWidget(self.catalog_input)
+        catalog_hbox.addWidget(self.find_button)
+
         vbox.addLayout(hbox)
+        vbox.addLayout(catalog_hbox)
         vbox.addWidget(self.browser)
         self.setLayout(vbox)
 
+    def update_memory(self, usage, budget):
+        self.memory_label.setText("Curve data: %.1f / %.0f MB" % (usage / 2**20, budget / 2**20))
+
 
 class InputsWidget(QtGui.QWidget):
     # tuple of Input classes that do not need an external label
@@ -497,21 +547,62 @@ class InputsWidget(QtGui.QWidget):
         return self._procedure
 
 
+class BatchLogHandler(logging.Handler):
+    """ Collects formatted log lines from any thread until LogWidget takes
+    them. Keeps at most maxlen lines, older ones are dropped.
+    """
+
+    def __init__(self, maxlen):
+        super().__init__()
+        self.lines = deque(maxlen=maxlen)
+
+    def emit(self, record):
+        try:
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def take(self):
+        lines = []
+        try:
+            while True:
+                lines.append(self.lines.popleft())
+        except IndexError:
+            return lines
+
+
 class LogWidget(QtGui.QWidget):
-    def __init__(self, parent=None):
+    """ Log view that takes the records of its handler in batches, one
+    appendPlainText() per refresh instead of one per record, and keeps the
+    last MAX_LINES lines only.
+    """
+
+    MAX_LINES = 5000
+
+    def __init__(self, refresh_time=0.2, parent=None):
         super().__init__(parent)
+        self.refresh_time = refresh_time
         self._setup_ui()
         self._layout()
 
     def _setup_ui(self):
         self.view = QtGui.QPlainTextEdit()
         self.view.setReadOnly(True)
-        self.handler = LogHandler()
-        self.handler.setFormatter(logging.Formatter(
-            fmt='%(asctime)s : %(message)s (%(levelname)s)',
+        self.view.setMaximumBlockCount(self.MAX_LINES)
+        self.handler = BatchLogHandler(self.MAX_LINES)
+        self.handler.setFormatter(FieldsFormatter(
+            fmt='%(asctime)s : %(message)s%(fields_text)s (%(levelname)s)',
             datefmt='%m/%d/%Y %I:%M:%S %p'
         ))
-        self.handler.record.connect(self.view.appendPlainText)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(int(self.refresh_time * 1e3))
+
+    def flush(self):
+        lines = self.handler.take()
+        if lines:
+            self.view.appendPlainText("\n".join(lines))
 
     def _layout(self):
         vbox = QtGui.QVBoxLayout(self)
@@ -521,13 +612,196 @@ class LogWidget(QtGui.QWidget):
         self.setLayout(vbox)
 
 
+class WaferMapWidget(QtGui.QWidget):
+    """ Spatial view of a scan. Every device of the chip/device grid is
+    one pixel of a single ImageItem (chips are separated by a one pixel
+    gap). Values arrive per device with set_value(), which only changes
+    that pixel; the image is redrawn by a timer if anything changed.
+    Clicking a measured device emits device_clicked with its data folder.
+    """
+
+    # metric name -> plotted on log scale
+    METRICS = {'Pretest': False, 'Max current (A)': True, 'Contact resistance (Ohm)': True,
+               'On/off ratio': True, 'Threshold voltage (V)': False, 'Hysteresis (V)': False,
+               'Subthreshold swing (mV/dec)': False}
+    COLOR_PENDING = (200, 200, 200, 255)
+    COLOR_PASSED = (0, 170, 0, 255)
+    COLOR_FAILED = (220, 0, 0, 255)
+    COLORMAP = pg.ColorMap([0., 0.5, 1.], [(0, 0, 255, 255), (0, 200, 0, 255), (255, 0, 0, 255)])
+    device_clicked = QtCore.QSignal(str)
+
+    def __init__(self, refresh_time=0.2, parent=None):
+        super().__init__(parent)
+        self.refresh_time = refresh_time
+        self.metric = 'Pretest'
+        self._shape = (0, 0)
+        self._values = {}
+        self._levels = {}
+        self._folders = {}
+        self._dirty = False
+        self._setup_ui()
+        self._layout()
+        self.set_layout(1, 1, 1, 1)
+
+    def _setup_ui(self):
+        self.metric_label = QtGui.QLabel(self)
+        self.metric_label.setText('Colour:')
+        self.metric_box = QtGui.QComboBox(self)
+        for metric in self.METRICS:
+            self.metric_box.addItem(metric)
+        self.metric_box.activated.connect(
+            lambda index: self.change_metric(self.metric_box.itemText(index)))
+        self.info = QtGui.QLabel(self)
+
+        self.plot_widget = pg.PlotWidget(self, background='#ffffff')
+        self.plot_widget.setAspectLocked(True)
+        self.plot_widget.hideAxis('left')
+        self.plot_widget.hideAxis('bottom')
+        self.image = pg.ImageItem()
+        self.plot_widget.addItem(self.image)
+        self.plot_widget.scene().sigMouseClicked.connect(self._mouse_clicked)
+
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self._refresh)
+        self.timer.start(int(self.refresh_time * 1e3))
+
+    def _layout(self):
+        vbox = QtGui.QVBoxLayout(self)
+        vbox.setSpacing(0)
+
+        hbox = QtGui.QHBoxLayout()
+        hbox.setSpacing(10)
+        hbox.setContentsMargins(-1, 6, -1, 6)
+        hbox.addWidget(self.metric_label)
+        hbox.addWidget(self.metric_box)
+        hbox.addStretch()
+        hbox.addWidget(self.info)
+
+        vbox.addLayout(hbox)
+        vbox.addWidget(self.plot_widget)
+        self.setLayout(vbox)
+
+    def set_layout(self, chipcols, chiprows, devcols, devrows):
+        """ Clears the map and lays it out for a new chip/device grid """
+        self._grid = (chipcols, chiprows, devcols, devrows)
+        self._shape = (chipcols * (devcols + 1) - 1, chiprows * (devrows + 1) - 1)
+        self._values = {metric: np.full(self._shape, np.nan) for metric in self.METRICS}
+        self._levels = {metric: None for metric in self.METRICS}
+        self._folders = {}
+        self._device_mask = np.zeros(self._shape, dtype=bool)
+        for chipcol in range(chipcols):
+            for chiprow in range(chiprows):
+                x, y = self._pixel(chipcol, chiprow, 0, 0)
+                self._device_mask[x:x + devcols, y:y + devrows] = True
+        self._recolor()
+
+    def _pixel(self, chipcol, chiprow, devcol, devrow):
+        chipcols, chiprows, devcols, devrows = self._grid
+        return chipcol * (devcols + 1) + devcol, chiprow * (devrows + 1) + devrow
+
+    def _normalised(self, metric, values):
+        if self.METRICS[metric]:
+            values = np.log10(np.clip(np.abs(values), 1e-15, None))
+        low, high = self._levels[metric]
+        if high <= low:
+            return np.full(np.shape(values), 0.5)
+        return np.clip((values - low) / (high - low), 0., 1.)
+
+    def _color(self, metric, value):
+        if np.isnan(value):
+            return self.COLOR_PENDING
+        if metric == 'Pretest':
+            return self.COLOR_PASSED if value else self.COLOR_FAILED
+        return self.COLORMAP.map(np.array([self._normalised(metric, value)]), mode='byte')[0]
+
+    def _extend_levels(self, metric, value):
+        """ Returns True if the colour scale of metric had to be changed """
+        if metric == 'Pretest' or np.isnan(value):
+            return False
+        if self.METRICS[metric]:
+            value = np.log10(max(abs(value), 1e-15))
+        levels = self._levels[metric]
+        if levels is None:
+            self._levels[metric] = (value, value)
+        elif levels[0] <= value <= levels[1]:
+            return False
+        else:
+            self._levels[metric] = (min(levels[0], value), max(levels[1], value))
+        return True
+
+    def _recolor(self):
+        self._rgba = np.zeros(self._shape + (4,), dtype=np.ubyte)
+        self._rgba[self._device_mask] = self.COLOR_PENDING
+        values = self._values[self.metric]
+        measured = ~np.isnan(values)
+        if self.metric == 'Pretest':
+            self._rgba[measured & (values > 0)] = self.COLOR_PASSED
+            self._rgba[measured & (values <= 0)] = self.COLOR_FAILED
+        elif np.any(measured):
+            self._rgba[measured] = self.COLORMAP.map(
+                self._normalised(self.metric, values[measured]), mode='byte')
+        self._dirty = True
+
+    def set_value(self, indices, metric, value, datafolder=None):
+        """ Sets the value of metric for the device at indices
+        (chipcol, chiprow, devcol, devrow). O(1) unless the colour scale
+        of the displayed metric has to be extended.
+        """
+        x, y = self._pixel(*indices)
+        if metric not in self._values or x >= self._shape[0] or y >= self._shape[1]:
+            return
+        value = float(value)
+        self._values[metric][x, y] = value
+        if datafolder is not None:
+            self._folders[(x, y)] = datafolder
+        rescaled = self._extend_levels(metric, value)
+        if metric == self.metric:
+            if rescaled:
+                self._recolor()
+            else:
+                self._rgba[x, y] = self._color(metric, value)
+                self._dirty = True
+
+    def change_metric(self, metric):
+        self.metric = metric
+        self._recolor()
+
+    def _refresh(self):
+        if self._dirty:
+            self._dirty = False
+            self.image.setImage(self._rgba, autoLevels=False)
+
+    def _mouse_clicked(self, event):
+        pos = self.image.mapFromScene(event.scenePos())
+        x, y = int(np.floor(pos.x())), int(np.floor(pos.y()))
+        if not (0 <= x < self._shape[0] and 0 <= y < self._shape[1]) or not self._device_mask[x, y]:
+            return
+        chipcols, chiprows, devcols, devrows = self._grid
+        name = "%d_%d_%d_%d" % (x // (devcols + 1), y // (devrows + 1), x % (devcols + 1), y % (devrows + 1))
+        value = self._values[self.metric][x, y]
+        self.info.setText("dev_%s: %s = %g" % (name, self.metric, value))
+        if (x, y) in self._folders:
+            self.device_clicked.emit(self._folders[(x, y)])
+
+
 class ResultsDialog(QtGui.QFileDialog):
+    """ File dialog with a preview of the selected results file.
+    Files are loaded in the background through the results cache
+    (resultscache.CACHE), together with their neighbours in the
+    directory, so previews of files browsed before or next to the
+    selection show up without parsing the file again.
+    """
+    preview_loaded = QtCore.QSignal(str, object)    # file name, Preview (None: no results file)
+
     def __init__(self, columns, x_axis=None, y_axis=None, parent=None):
         super().__init__(parent)
         self.columns = columns
         self.x_axis, self.y_axis = x_axis, y_axis
+        self._selected = None
         self.setOption(QtGui.QFileDialog.DontUseNativeDialog, True)
         self._setup_ui()
+        # loader threads emit, the preview is shown in the GUI thread
+        self.preview_loaded.connect(self.show_preview)
 
     def _setup_ui(self):
         preview_tab = QtGui.QTabWidget()
@@ -560,26 +834,33 @@ class ResultsDialog(QtGui.QFileDialog):
 
     def update_plot(self, filename):
         self.plot.clear()
-        if not os.path.isdir(filename) and filename != '':
+        self.preview_param.clear()
+        filename = str(filename)
+        self._selected = filename
+        if os.path.isdir(filename) or filename == '':
+            return
+        preview = CACHE.get(filename)
+        if preview is not None:
+            self.show_preview(filename, preview)
+        else:
             try:
-                results = Results.load(str(filename))
-            except ValueError:
+                CACHE.load(filename, self.preview_loaded.emit)
+            except OSError:
                 return
-            except Exception as e:
-                raise e
-
-            curve = ResultsCurve(results,
-                                 x=self.plot_widget.plot_frame.x_axis,
-                                 y=self.plot_widget.plot_frame.y_axis,
-                                 pen=pg.mkPen(color=(255, 0, 0), width=1.75),
-                                 antialias=True
-                                 )
-            curve.update()
-
-            self.plot.addItem(curve)
-
-            self.preview_param.clear()
-            for key, param in results.procedure.parameter_objects().items():
-                new_item = QtGui.QTreeWidgetItem([param.name, str(param)])
-                self.preview_param.addTopLevelItem(new_item)
-            self.preview_param.sortItems(0, QtCore.Qt.AscendingOrder)
+        CACHE.prefetch(neighbours(filename))
+
+    def show_preview(self, filename, preview):
+        if filename != self._selected or preview is None:
+            return      # selection moved on, or not a results file
+        self.plot.clear()
+        curve = self.plot_widget.new_curve(preview.results,
+                                           pen=pg.mkPen(color=(255, 0, 0), width=1.75),
+                                           antialias=True
+                                           )
+        curve.load(preview.data)
+        curve.update()
+        self.plot.addItem(curve)
+
+        self.preview_param.clear()
+        self.preview_param.addTopLevelItems([QtGui.QTreeWidgetItem([name, value])
+                                             for name, value in preview.parameters])
@@ -1,8 +1,10 @@
 # Modified version of the pymeasure.windows module.
 # The main window of the probestation GUI is built on top of this.
 
+import os
 from datetime import datetime as dt
 from time import sleep
+from collections import deque
 
 import logging
 
@@ -17,8 +19,10 @@ from pymeasure.display.curves import ResultsCurve
 from pymeasure.display.Qt import QtCore, QtGui
 from pymeasure.experiment.results import Results
 # modified pymeasure modules
-from widgets import PlotWidget, BrowserWidget, InputsWidget, LogWidget, ResultsDialog
+from widgets import PlotWidget, BrowserWidget, InputsWidget, LogWidget, ResultsDialog, WaferMapWidget
 from manager import Manager, Experiment
+from logs import LogQueue, FieldsFormatter
+from catalog import CATALOG, CatalogError
 
 # PyQt5 threading elements
 from PyQt5.QtCore import QObject, QThread, pyqtSignal
@@ -146,7 +150,7 @@ class ManagedWindow(QtGui.QMainWindow):
     EDITOR = 'gedit'
 
     def __init__(self, procedure_class_pretest, procedure_class, inputs_list=(), displays=(), x_axis=None, y_axis=None,
-                 log_channel='', log_level=logging.INFO, parent=None):
+                 log_channel='', log_level=logging.INFO, curve_memory_budget=256*2**20, parent=None):
         print("Building main window\n")
         super().__init__(parent)
         app = QtCore.QCoreApplication.instance()
@@ -164,6 +168,7 @@ class ManagedWindow(QtGui.QMainWindow):
         self.inputs_list = inputs_list
         self.displays = displays
         self.x_axis, self.y_axis = x_axis, y_axis
+        self.curve_memory_budget = curve_memory_budget
         
         # GUI
         self._create_widgets()
@@ -190,11 +195,18 @@ class ManagedWindow(QtGui.QMainWindow):
         self.stage_signals.sig_stage_capture_command.connect(self.stages.capture_coords)
         self.stage_signals.sig_stage_moveTo_command.connect(self.stages.goto_coords)
         
+        # browser items waiting to be shown by show_experiments (progressive drawing)
+        self._pending_show = deque()
+        self._show_timer = QtCore.QTimer()
+        self._show_timer.timeout.connect(self._show_next_experiments)
+        
         # flags
         self._has_no_measurement = threading.Event()
         self._has_no_measurement.set()
         self.event_abort = threading.Event()    # thread safe flag: abort automated scan
         self.event_abort.clear()
+        self.scan = None                        # running scan: ScanThread, or EngineProcess in the engine process
+        self.scan_events = None                 # ScanEvents of the running scan
     
     
     def _create_widgets(self):
@@ -221,11 +233,23 @@ class ManagedWindow(QtGui.QMainWindow):
         #       automated scan kickoff and abort
         self.button_start = QtGui.QPushButton("Start Scan")
         self.button_start.setEnabled(False)
+        self.button_resume_scan = QtGui.QPushButton("Resume Scan")
         self.button_abort = QtGui.QPushButton("Abort current")
         self.button_abort.setEnabled(False)
         self.button_abort_all = QtGui.QPushButton("Abort all")
         self.button_abort_all.setEnabled(False)
-        self.BUTTONS.extend([self.button_start, self.button_abort, self.button_abort_all])
+        self.BUTTONS.extend([self.button_start, self.button_resume_scan, self.button_abort, self.button_abort_all])
+        self.button_dry_run = QtGui.QPushButton("Dry Run")
+        self.button_dry_run.setToolTip("Estimates the duration of a scan with the current inputs and checks the\n"
+                                       "stage coordinates of all devices, without moving or measuring")
+        self.BUTTONS.append(self.button_dry_run)
+        self.label_eta = QtGui.QLabel("")
+        self.checkbox_trace = QtGui.QCheckBox("Record timing trace")
+        self.checkbox_trace.setToolTip("Writes the duration of every phase of the scan to trace.json (chrome://tracing,\n"
+                                       "ui.perfetto.dev) and timing.csv in the scan folder")
+        self.checkbox_engine_process = QtGui.QCheckBox("Run acquisition in separate process")
+        self.checkbox_engine_process.setToolTip("Stages and instruments are controlled by a separate process during the scan,\n"
+                                                "the window only displays the data. 'Abort current' is not available.")
         
         # input lines
         self.widget_inputlines = InputsWidget(
@@ -238,9 +262,14 @@ class ManagedWindow(QtGui.QMainWindow):
         #       plot
         self.widget_plot = PlotWidget(self.procedure_class.DATA_COLUMNS, self.x_axis, self.y_axis)
         self.plot = self.widget_plot.plot
+        #       wafer map
+        self.widget_wafermap = WaferMapWidget()
         #       log
         self.widget_log = LogWidget()
-        self.log.addHandler(self.widget_log.handler)  # needs to be in Qt context?
+        console = logging.StreamHandler()
+        console.setFormatter(FieldsFormatter())
+        self.log_queue = LogQueue(self.log, [self.widget_log.handler, console])   # handlers run in a thread of the queue
+        self.log_queue.start()
         log.info("ManagedWindow connected to logging")
         #       browser
         self.widget_browser = BrowserWidget(
@@ -260,7 +289,8 @@ class ManagedWindow(QtGui.QMainWindow):
         self.progressbar_wafer.setValue(0)
         
         # background stuff (manager)
-        self.manager = Manager(self.plot, self.browser, log_level=self.log_level, parent=self)
+        self.manager = Manager(self.plot, self.browser, log_level=self.log_level,
+                               memory_budget=self.curve_memory_budget, parent=self)
     
     
     def _connect_widgets(self):
@@ -280,12 +310,19 @@ class ManagedWindow(QtGui.QMainWindow):
         self.button_goto_0j.clicked.connect(lambda : self.stage_signals.sig_stage_moveTo_command.emit(self.stages._coordinates_dev_0j))
         #       automated scan kickoff and abort
         self.button_start.clicked.connect(self.start_scan)
+        self.button_resume_scan.clicked.connect(self.resume_scan)
         self.button_abort.clicked.connect(self.abort)
         self.button_abort_all.clicked.connect(self.abort_all)
+        self.button_dry_run.clicked.connect(self.dry_run)
         #       browser buttons
         self.widget_browser.show_button.clicked.connect(self.show_experiments)
         self.widget_browser.hide_button.clicked.connect(self.hide_experiments)
         self.widget_browser.clear_button.clicked.connect(self.clear_experiments)
+        self.widget_browser.find_button.clicked.connect(self.find_in_catalog)
+        self.widget_browser.catalog_input.returnPressed.connect(self.find_in_catalog)
+        
+        #       wafer map
+        self.widget_wafermap.device_clicked.connect(self.show_device)
         
         # browser events
         self.browser.customContextMenuRequested.connect(self.browser_item_menu)
@@ -298,6 +335,7 @@ class ManagedWindow(QtGui.QMainWindow):
         #self.manager.aborted.connect(self.experiment_finished)
         self.manager.abort_returned.connect(self.resume)
         self.manager.log.connect(self.log.handle)
+        self.manager.memory.usage_changed.connect(self.widget_browser.update_memory)
     
     
     def _layout_widgets(self):
@@ -351,9 +389,20 @@ class ManagedWindow(QtGui.QMainWindow):
         layout_h_automation_buttons.setSpacing(10)
         layout_h_automation_buttons.setContentsMargins(-1, 6, -1, 6)
         layout_h_automation_buttons.addWidget(self.button_start)
+        layout_h_automation_buttons.addWidget(self.button_resume_scan)
         layout_h_automation_buttons.addWidget(self.button_abort)
         layout_h_automation_buttons.addWidget(self.button_abort_all)
         layout_h_automation_buttons.addStretch()
+        layout_h_dry_run = QtGui.QHBoxLayout()
+        layout_h_dry_run.setSpacing(10)
+        layout_h_dry_run.addWidget(self.button_dry_run)
+        layout_h_dry_run.addWidget(self.label_eta)
+        layout_h_dry_run.addStretch()
+        layout_v_automation = QtGui.QVBoxLayout()
+        layout_v_automation.addLayout(layout_h_automation_buttons)
+        layout_v_automation.addLayout(layout_h_dry_run)
+        layout_v_automation.addWidget(self.checkbox_engine_process)
+        layout_v_automation.addWidget(self.checkbox_trace)
         
         # fill layout for "Sample Info" tab widgets
         layout_v_input_sample.addWidget(self.widget_inputlines)
@@ -378,7 +427,7 @@ lost focus)""")
         layout_v_input_stages.addSpacing(15)
         label = QtGui.QLabel("Run automated stage scan and measurements", self)
         layout_v_input_stages.addWidget(label)
-        layout_v_input_stages.addLayout(layout_h_automation_buttons)
+        layout_v_input_stages.addLayout(layout_v_automation)
         layout_v_input_stages.addSpacing(20)
         label = QtGui.QLabel("Scan progress wafer")
         layout_v_input_stages.addWidget(label)
@@ -401,6 +450,7 @@ lost focus)""")
         #       output tabs
         output_tabs = QtGui.QTabWidget(main)
         output_tabs.addTab(self.widget_plot, "Results Graph")
+        output_tabs.addTab(self.widget_wafermap, "Wafer Map")
         output_tabs.addTab(self.widget_log, "Experiment Log")
         
         # arrange everything and put in main frame
@@ -429,6 +479,8 @@ lost focus)""")
         print("start time: ", self.start_time)
         '''self.frame_input_stages.removeEventFilter(self)'''
         self.widget_inputlines.setEnabled(False)
+        self.checkbox_engine_process.setEnabled(False)
+        self.checkbox_trace.setEnabled(False)
         for button in self.BUTTONS:
             button.setEnabled(False)
             button.update()
@@ -445,6 +497,8 @@ lost focus)""")
         '''
         '''self.frame_input_stages.installEventFilter(self)'''
         self.widget_inputlines.setEnabled(True)
+        self.checkbox_engine_process.setEnabled(True)
+        self.checkbox_trace.setEnabled(True)
         for button in self.BUTTONS:
             button.setEnabled(True)
         self.button_abort.setEnabled(False)
@@ -536,8 +590,16 @@ lost focus)""")
             self.abort_all()
         except:
             pass
+        if self.scan is not None:
+            engine = self.scan_events is not self.scan
+            self.scan.join(timeout=60)
+            self.scan = None
+            self.scan_events = None
+            if engine:
+                self.stages.open()
         self.stages.goto_coords(self.stages._coordinates_center)
         print("exit")
+        self.log_queue.stop()
         self.close()
 
 
@@ -557,10 +619,12 @@ lost focus)""")
             experiment = self.manager.experiments.with_browser_item(item)
             if state == 0:
                 self.plot.removeItem(experiment.curve)
+                self.manager.memory.hide(experiment)
             else:
+                self.manager.memory.show(experiment)
+                # curve is drawn (decimated to the current view) by the next plot refresh
                 experiment.curve.x = self.widget_plot.plot_frame.x_axis
                 experiment.curve.y = self.widget_plot.plot_frame.y_axis
-                experiment.curve.update()
                 self.plot.addItem(experiment.curve)
 
 
@@ -639,15 +703,72 @@ lost focus)""")
             experiment.curve.setPen(pg.mkPen(color=color, width=2))
 
 
+    SHOW_BATCH_SIZE = 20
+
     def show_experiments(self):
         '''
         Callback for GUI browser button "Show".
-        Makes all datacurves visible in the plot.
+        Makes all datacurves visible in the plot. Curves are added in batches of SHOW_BATCH_SIZE per
+        event loop iteration, so the GUI stays responsive with hundreds of experiments.
         '''
         root = self.browser.invisibleRootItem()
+        self._pending_show.clear()
         for i in range(root.childCount()):
             item = root.child(i)
-            item.setCheckState(0, QtCore.Qt.Checked)
+            if item.checkState(0) != QtCore.Qt.Checked:
+                self._pending_show.append(item)
+        self._show_timer.start(0)
+
+
+    def _show_next_experiments(self):
+        for n in range(min(self.SHOW_BATCH_SIZE, len(self._pending_show))):
+            self._pending_show.popleft().setCheckState(0, QtCore.Qt.Checked)
+        if not self._pending_show:
+            self._show_timer.stop()
+
+
+    def show_device(self, datafolder):
+        '''
+        Callback for wafer map clicks.
+        Shows the curve of the measurement in datafolder, loading it from disk if it is not in the
+        browser (yet).
+        '''
+        filename = os.path.join(datafolder, 'gatetrace.dat')
+        experiment = self.manager.experiments.with_data_filename(filename)
+        if experiment is None:
+            if not os.path.isfile(filename):
+                log.info("No measurement in %s", datafolder)
+                return
+            results = Results.load(filename)
+            experiment = self.new_experiment(results)
+            self.manager.load(experiment)
+        experiment.browser_item.setCheckState(0, QtCore.Qt.Checked)
+        self.browser.setCurrentItem(experiment.browser_item)
+
+
+    CATALOG_LIMIT = 100
+
+    def find_in_catalog(self):
+        '''
+        Callback for the catalog query of the browser.
+        Loads the measurements of the devices matching the query into the browser, at most
+        CATALOG_LIMIT of them.
+        '''
+        text = self.widget_browser.catalog_input.text().strip()
+        if not text:
+            return
+        try:
+            entries = CATALOG.query(text, limit=self.CATALOG_LIMIT+1)
+        except (CatalogError, ValueError) as e:
+            log.error("Catalog query failed: %s", e)
+            return
+        if len(entries) > self.CATALOG_LIMIT:
+            log.warning("More than %d devices match '%s', showing the first %d", self.CATALOG_LIMIT, text, self.CATALOG_LIMIT)
+            entries = entries[:self.CATALOG_LIMIT]
+        log.info("%d devices match '%s'", len(entries), text)
+        for entry in entries:
+            if 'gatetrace' in entry.files:
+                self.show_device(os.path.dirname(entry.files['gatetrace']))
 
 
     def hide_experiments(self):
@@ -655,6 +776,8 @@ lost focus)""")
         Callback for GUI browser button "Hide".
         Makes all datacurves invisible in the plot.
         '''
+        self._pending_show.clear()
+        self._show_timer.stop()
         root = self.browser.invisibleRootItem()
         for i in range(root.childCount()):
             item = root.child(i)
@@ -688,25 +811,16 @@ lost focus)""")
     def abort_all(self):
         '''
         Callback for GUI abort all button.
-        Stops all stage movement.
-        Sets break flag for producer and kickoff workers and aborts running measurement, if there exists one.
-        Removes all queued procdirs from the producer->starter Queue.
-        Gives control back to the user (i.e. enables inputs).
+        Cancels the running scan, which stops all stage movement and the running measurement.
+        Inputs are enabled again once the scan has stopped.
         '''
         print("ABORT")
         self.event_abort.set()
+        if self.scan is not None:
+            self.scan.abort()
+            return
         self.stage_signals.sig_stage_emergency_stop.emit()
         sleep(0.1)
-        # clear producer pipeline
-        while not self.pipeline.empty() or not self.producer_done.is_set():
-            self.pipeline.get()
-            sleep(0.01)
-        # abort PreTest if running
-        try:
-            self.pretest_worker.stop()
-            log.info('PreTest aborted')
-        except:
-            log.info('No PreTest to abort', exc_info=True)
         self.current_device_passed_pretest.clear()
         # abort Measurement if running
         man_abort = self.abort()
@@ -721,6 +835,9 @@ lost focus)""")
         Callback for GUI abort button.
         Stops current measurement. Automated scan is continued with next device.
         '''
+        if hasattr(self.scan, 'abort_current'):
+            self.scan.abort_current()
+            return True
         self.button_abort.setEnabled(False)
         #self.button_abort.setText("Resume")
         #self.button_abort.clicked.disconnect()
@@ -29,14 +29,17 @@ import traceback
 from logging.handlers import QueueHandler
 from importlib.machinery import SourceFileLoader
 from queue import Queue
+from threading import Thread, Event
 
-from pymeasure.experiment.listeners import Recorder
 from pymeasure.experiment.procedure import Procedure, ProcedureWrapper
 from pymeasure.experiment.results import Results
 from pymeasure.log import TopicQueueHandler
 from pymeasure.thread import StoppableThread
 
-import PyQt5.QtCore as qt5
+from tracing import TRACER
+from logs import PointLog
+from progress import ProgressLimiter
+from sharedbuffer import SharedColumns, retire
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
@@ -50,10 +53,57 @@ except ImportError:
     log.warning("ZMQ and cloudpickle are required for TCP communication")
 
 
+class BufferRecorder(Thread):
+    """ Writes the rows of a SharedColumns buffer to the data file(s)
+    of the results in batches. The buffer is the live data path, the
+    files are only its sink: rows are formatted once, here, and never
+    parsed again while the measurement runs.
+
+    :param results: :class:`.Results` with the data file(s), the header
+                    is written already
+    :param buffer: SharedColumns the Worker appends the data points to
+    :param interval: time between two batches in seconds
+    """
+
+    def __init__(self, results, buffer, interval=0.2):
+        super().__init__(name='RECORDER')
+        self.results = results
+        self.buffer = buffer
+        self.interval = interval
+        self.written = 0
+        self._stop_event = Event()
+
+    def flush(self):
+        n = len(self.buffer)
+        if n == self.written:
+            return
+        columns = self.buffer.columns
+        with TRACER.span('data file', 'io'):
+            lines = [self.results.format(dict(zip(columns, row)))
+                     for row in self.buffer.rows(self.written, n).tolist()]
+            text = Results.LINE_BREAK.join(lines) + Results.LINE_BREAK
+            for filename in self.results.data_filenames:
+                with open(filename, 'a') as f:
+                    f.write(text)
+        self.written = n
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def stop(self):
+        """ Writes the remaining rows and ends the thread, join() to wait
+        for the last batch """
+        self._stop_event.set()
+
+
 class Worker(StoppableThread):
     """ Worker runs the procedure and emits information about
-    the procedure and its status over a ZMQ TCP port. In a child
-    thread, a Recorder is run to write the results to
+    the procedure and its status over a ZMQ TCP port. The data points
+    go into a shared memory buffer (SharedColumns, attached to by name
+    from plots in this or another process), in a child thread a
+    BufferRecorder writes them from there to the data file.
     """
 
     def __init__(self, results, log_queue=None, log_level=logging.INFO, port=None):
@@ -69,10 +119,16 @@ class Worker(StoppableThread):
         self.results.procedure.check_parameters()
         self.results.procedure.status = Procedure.QUEUED
 
+        self.buffer = SharedColumns.create(self.results.procedure.DATA_COLUMNS)
         self.recorder = None
-        self.recorder_queue = Queue()
 
         self.monitor_queue = Queue()
+        self.results_listeners = []     # callables that receive every emitted data point
+        self.progress_listeners = []    # callables that receive the progress, at most once per frame
+        self._progress_limiter = ProgressLimiter()
+        self.trace_name = None          # name of the procedure in the timing trace (default: class name)
+        self.points = 0
+        self.point_log = PointLog(log)  # data points are logged sampled
         if log_queue is None:
             log_queue = Queue()
         self.log_queue = log_queue
@@ -91,17 +147,32 @@ class Worker(StoppableThread):
 
     def emit(self, topic, record):
         """ Emits data of some topic over TCP """
-        log.debug("Emitting message: %s %s", topic, record)
+        if topic == 'results':
+            self.point_log.debug("Emitting message: %s %s", topic, record)
+        else:
+            log.debug("Emitting message: %s %s", topic, record)
 
         try:
             self.publisher.send_serialized((topic, record), serialize=cloudpickle.dumps)
         except (NameError, AttributeError):
             pass  # No dumps defined
         if topic == 'results':
-            self.recorder.handle(record)
-        elif topic == 'status' or topic == 'progress':
+            self.points += 1
+            self.buffer.append(record)
+            for listener in self.results_listeners:
+                listener(record)
+        elif topic == 'progress':
+            # procedures report progress per point, pass it on at most once per frame
+            if self._progress_limiter.due(record):
+                self.monitor_queue.put((topic, record))
+                for listener in self.progress_listeners:
+                    listener(record)
+        elif topic == 'status':
             self.monitor_queue.put((topic, record))
 
+    def _phase(self):
+        return self.trace_name or self.results.procedure.__class__.__name__
+
     def handle_abort(self):
         log.exception("User stopped Worker execution prematurely")
         self.update_status(Procedure.ABORTED)
@@ -117,7 +188,12 @@ class Worker(StoppableThread):
         self.emit('status', status)
 
     def shutdown(self):
-        self.procedure.shutdown()
+        with TRACER.span(self._phase()+' shutdown', 'procedure'):
+            self.procedure.shutdown()
+
+        # the data file is complete before the final status goes out
+        self.recorder.stop()
+        self.recorder.join()
 
         if self.should_stop() and self.procedure.status == Procedure.RUNNING:
             self.update_status(Procedure.ABORTED)
@@ -125,13 +201,14 @@ class Worker(StoppableThread):
             self.update_status(Procedure.FINISHED)
             self.emit('progress', 100.)
 
-        self.recorder.enqueue_sentinel()
         self.monitor_queue.put(None)
+        retire(self.buffer)
 
     def run(self):
         global log
         log = logging.getLogger()
         log.setLevel(self.log_level)
+        self.point_log = PointLog(log)
         # log.handlers = []  # Remove all other handlers
         # log.addHandler(TopicQueueHandler(self.monitor_queue))
         # log.addHandler(QueueHandler(self.log_queue))
@@ -139,7 +216,7 @@ class Worker(StoppableThread):
 
         self.procedure = self.results.procedure
 
-        self.recorder = Recorder(self.results, self.recorder_queue)
+        self.recorder = BufferRecorder(self.results, self.buffer)
         self.recorder.start()
 
         #locals()[self.procedures_file] = __import__(self.procedures_file)
@@ -164,8 +241,11 @@ class Worker(StoppableThread):
         self.emit('progress', 0.)
 
         try:
-            self.procedure.startup()
-            self.procedure.execute()
+            with TRACER.span(self._phase()+' setup', 'procedure'):
+                self.procedure.startup()
+            with TRACER.span(self._phase()+' points', 'procedure') as span:
+                self.procedure.execute()
+                span.set('points', self.points)
         except (KeyboardInterrupt, SystemExit):
             self.handle_abort()
         except Exception:
@@ -180,40 +260,3 @@ class Worker(StoppableThread):
             self.procedure.__class__.__name__,
             self.should_stop()
         )
-
-
-
-class QWorkerSignals(qt5.QObject):
-    procedure = qt5.pyqtSignal(object)
-    movecommand = qt5.pyqtSignal(object)
-    progress = qt5.pyqtSignal(int, int)
-    finished = qt5.pyqtSignal()
-
-
-
-class QWorker(qt5.QThread):
-    '''
-    Worker thread
-
-    Inherits from QRunnable to handle worker thread setup, signals and wrap-up.
-
-    :param callback: The function callback to run on this worker thread. Supplied args and 
-                     kwargs will be passed through to the runner.
-    :type callback: function
-    :param args: Arguments to pass to the callback function
-    :param kwargs: Keywords to pass to the callback function
-    '''
-    def __init__(self, name, fn, *args, **kwargs):
-        super().__init__()
-        #self.name = name
-        self.fn = fn
-        self.args = args
-        self.kwargs = kwargs
-        self.signals = QWorkerSignals()
-    
-    @qt5.pyqtSlot()
-    def run(self):
-        self.fn(*self.args, **self.kwargs)
-        #print(self.name, "EMIT: finished")
-        self.signals.finished.emit()
-